@@ -43,12 +43,16 @@ from flask.views import MethodView
 from sqlalchemy import or_, not_
 
 from pyfarm.core.logger import getLogger
-from pyfarm.core.enums import WorkState, AgentState, _AgentState, STRING_TYPES
+from pyfarm.core.enums import (
+    WorkState, AgentState, _AgentState, STRING_TYPES, INTEGER_TYPES,
+    NUMERIC_TYPES)
 from pyfarm.scheduler.tasks import (
-    assign_tasks, update_agent, assign_tasks_to_agent, send_tasks_to_agent)
+    update_agent, assign_tasks_to_agent, send_tasks_to_agent, stop_task)
+from pyfarm.scheduler.triggers import request_scheduling
 from pyfarm.models.agent import (
     Agent, AgentMacAddress, AgentSoftwareVersionAssociation)
 from pyfarm.models.gpu import GPU
+from pyfarm.models.statistics.task_event_count import TaskEventCount
 from pyfarm.models.task import Task
 from pyfarm.models.software import Software, SoftwareVersion
 from pyfarm.master.config import config
@@ -64,12 +68,30 @@ logger = getLogger("api.agents")
 MAC_RE = re.compile("^([0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2}$")
 OUR_FARM_NAME = config.get("farm_name")
 
+# The keys an update sent to TaskUpdatesInAgentAPI may have
+TASK_UPDATE_KEYS = ("task_id", "state", "progress", "last_error")
+
+# The columns of TaskEventCount counting the transitions to each state
+TASK_EVENT_COLUMNS = {"queued": "num_restarted",
+                      "running": "num_started",
+                      "done": "num_done",
+                      "failed": "num_failed"}
+
 
 def fail_missing_assignments(agent, current_assignments):
     known_task_ids = []
     for assignment in current_assignments.values():
         for task in assignment["tasks"]:
             known_task_ids.append(task["id"])
+    return fail_missing_tasks(agent, known_task_ids)
+
+
+def fail_missing_tasks(agent, known_task_ids):
+    """
+    Fails the tasks of `agent` which were sent to it but are not among
+    `known_task_ids`, the tasks the agent says it has, and makes sure the
+    ones which were not sent yet will be.  Returns the failed tasks.
+    """
     tasks_query = Task.query.filter(Task.agent == agent,
                                     or_(Task.state == None,
                                         ~Task.state.in_(
@@ -97,6 +119,29 @@ def fail_missing_assignments(agent, current_assignments):
 
     return failed_tasks
 
+
+def requeue_agent_tasks(agent):
+    """
+    Takes all unfinished tasks, including the ones which have not been
+    started yet, away from `agent` so they can be assigned to other agents
+    """
+    for task in agent.tasks.filter(
+            or_(Task.state == None,
+                ~Task.state.in_([WorkState.DONE, WorkState.FAILED]))):
+        task.agent = None
+        task.state = None
+        task.job.update_state()
+        db.session.add(task)
+
+
+def sent_from_other_address(agent):
+    """
+    Returns True if the current request was sent by an agent, but not from
+    the address `agent` is known under
+    """
+    return (request.headers.get("User-Agent", "") == "PyFarm/1.0 (agent)" and
+            request.remote_addr != agent.remote_ip)
+
 def schema():
     """
     Returns the basic schema of :class:`.Agent`
@@ -327,7 +372,7 @@ class AgentIndexAPI(MethodView):
             else:
                 agent_data = agent.to_dict(unpack_relationships=["tags"])
                 logger.info("Created agent %r: %r", agent.id, agent_data)
-                assign_tasks.delay()
+                request_scheduling(agent_ids=[agent.id])
                 return jsonify(agent_data), CREATED
 
         else:
@@ -425,7 +470,10 @@ class AgentIndexAPI(MethodView):
                     for task in failed_tasks:
                         task.job.update_state()
                     db.session.commit()
-                    assign_tasks.delay()
+                    request_scheduling(
+                        agent_ids=[agent.id],
+                        queue_ids=set(task.job.job_queue_id
+                                      for task in failed_tasks))
                     return jsonify(agent_data), OK
 
     def get(self):
@@ -815,12 +863,7 @@ class SingleAgentAPI(MethodView):
         for task in failed_tasks:
             task.job.update_state()
         if agent.state == _AgentState.OFFLINE:
-            for task in agent.tasks.filter(Task.state != WorkState.DONE,
-                                           Task.state != WorkState.FAILED):
-                task.agent = None
-                task.state = None
-                task.job.update_state()
-                db.session.add(task)
+            requeue_agent_tasks(agent)
         db.session.commit()
 
         assign_tasks_to_agent.delay(agent_id)
@@ -855,10 +898,132 @@ class SingleAgentAPI(MethodView):
         else:
             db.session.delete(agent)
             db.session.commit()
-            assign_tasks.delay()
+            request_scheduling()
             return jsonify(None), NO_CONTENT
 
 
+class AgentHeartbeatAPI(MethodView):
+    def post(self, agent_id):
+        """
+        A heartbeat from an agent.  Unlike a ``POST`` to
+        ``/api/v1/agents/(str:agent_id)`` it only carries what changes while
+        the agent is running, so it is cheap enough to be sent often.  An
+        agent which sends heartbeats is not polled by the master as long as
+        they keep coming, see ``agent_heartbeat_timeout``.
+
+        .. http:post:: /api/v1/agents/(str:agent_id)/heartbeat HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                POST /api/v1/agents/29d466a5-34f8-408a-b613-e6c2715077a0/heartbeat HTTP/1.1
+                Accept: application/json
+
+                {
+                    "state": "running",
+                    "free_ram": 133,
+                    "task_ids": [2, 3]
+                }
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 204 NO CONTENT
+
+        `task_ids` are the ids of all the tasks the agent currently has,
+        whether they are running yet or not.  Tasks which were sent to the
+        agent but are missing from it are failed, tasks which were not sent
+        yet are sent and tasks the agent should not have are stopped.  All
+        keys are optional.
+
+        :statuscode 204:
+            no error
+
+        :statuscode 400:
+            something within the request is invalid
+
+        :statuscode 404:
+            no agent could be found using the given id, the agent has to
+            register itself again
+        """
+        farm_name = g.json.pop("farm_name", None)
+        if farm_name and farm_name != OUR_FARM_NAME:
+            return jsonify(error="Wrong farm name"), BAD_REQUEST
+
+        state = g.json.pop("state", None)
+        free_ram = g.json.pop("free_ram", None)
+        task_ids = g.json.pop("task_ids", None)
+        if g.json:
+            return jsonify(error="Unknown keys in request: %s" %
+                                 ", ".join(g.json)), BAD_REQUEST
+
+        if (task_ids is not None and
+            (not isinstance(task_ids, list) or
+             not all(isinstance(x, INTEGER_TYPES) for x in task_ids))):
+            return jsonify(error="task_ids must be a list of task ids"), \
+                   BAD_REQUEST
+
+        agent = Agent.query.filter_by(id=agent_id).first()
+        if agent is None:
+            return jsonify(error="Agent %s not found" % agent_id), NOT_FOUND
+
+        if sent_from_other_address(agent):
+            logger.error("Agent with IP address %s tried to send a "
+                         "heartbeat for agent %s (id %s) with IP address "
+                         "%s. Request rejected.", request.remote_addr,
+                         agent.hostname, agent.id, agent.remote_ip)
+            return jsonify(error="Heartbeats can only be sent by the agent "
+                                 "itself"), BAD_REQUEST
+
+        try:
+            if state and agent.state != _AgentState.DISABLED:
+                agent.state = state
+            if free_ram is not None:
+                agent.free_ram = free_ram
+        except ValueError as e:
+            return jsonify(error=str(e)), BAD_REQUEST
+
+        agent.last_heard_from = agent.last_heartbeat = datetime.utcnow()
+        db.session.add(agent)
+
+        # The state may still be the string from the request, which only
+        # compares correctly with ==
+        offline = agent.state == AgentState.OFFLINE
+        failed_tasks = []
+        superfluous_task_ids = set()
+        if task_ids is not None and not offline:
+            failed_tasks = fail_missing_tasks(agent, task_ids)
+            assigned_task_ids = db.session.query(Task.id).filter(
+                or_(Task.agent_id == agent.id,
+                    Task.speculative_agent_id == agent.id),
+                or_(Task.state == None,
+                    ~Task.state.in_([WorkState.FAILED, WorkState.DONE])))
+            superfluous_task_ids = set(task_ids) - set(
+                x[0] for x in assigned_task_ids)
+
+        db.session.commit()
+
+        for task in failed_tasks:
+            task.job.update_state()
+        if offline:
+            requeue_agent_tasks(agent)
+        db.session.commit()
+
+        for task_id in superfluous_task_ids:
+            logger.warning("Agent %s (id %s) has task %s which it should "
+                           "not have, stopping it.", agent.hostname,
+                           agent.id, task_id)
+            stop_task.delay(task_id, agent.id, dissociate_agent=False)
+
+        if failed_tasks or (task_ids == [] and
+                            agent.state == AgentState.ONLINE):
+            request_scheduling(agent_ids=[agent.id])
+
+        return jsonify(None), NO_CONTENT
+
+
 class TasksInAgentAPI(MethodView):
     def get(self, agent_id):
         """
@@ -1004,11 +1169,250 @@ class TasksInAgentAPI(MethodView):
         logger.info("Assigned task %s (frame %s, job %s) to agent %s (%s)",
                     task.id, task.frame, task.job.title,
                     agent.id, agent.hostname)
-        assign_tasks.delay()
+        request_scheduling()
 
         return jsonify(task.to_dict()), OK
 
 
+class TaskUpdatesInAgentAPI(MethodView):
+    def post(self, agent_id):
+        """
+        A ``POST`` to this endpoint updates several tasks of the agent at
+        once, in a single transaction.  It accepts the same changes to
+        `state`, `progress` and `last_error` as
+        ``/api/v1/jobs/(str:job)/tasks/(int:task_id)``, but the state of
+        each affected job is only updated once per request.  An agent
+        running a speculative copy of a task may only report that the copy
+        is done or that it failed.
+
+        .. http:post:: /api/v1/agents/(str:agent_id)/tasks/updates HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                POST /api/v1/agents/29d466a5-34f8-408a-b613-e6c2715077a0/tasks/updates HTTP/1.1
+                Accept: application/json
+
+                [
+                    {"task_id": 2, "state": "done"},
+                    {"task_id": 3, "progress": 0.5},
+                    {"task_id": 4, "state": "failed",
+                     "last_error": "Segmentation fault"}
+                ]
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                [
+                    {"task_id": 2, "state": "done"},
+                    {"task_id": 3, "state": "running"},
+                    {"task_id": 4, "error": "Task not found"}
+                ]
+
+        The results are in the order of the updates.  Updates which could
+        not be applied have an `error` instead of a `state` and do not keep
+        the other updates from being applied.
+
+        :statuscode 200:
+            the updates were processed
+
+        :statuscode 400:
+            the request is not a list of updates or was not sent by the agent
+
+        :statuscode 404:
+            no agent could be found using the given id
+        """
+        updates = g.json
+        if (not isinstance(updates, list) or
+            not all(isinstance(x, dict) and
+                    isinstance(x.get("task_id"), INTEGER_TYPES)
+                    for x in updates)):
+            return jsonify(error="Expected a list of updates with a task_id "
+                                 "each"), BAD_REQUEST
+
+        agent = Agent.query.filter_by(id=agent_id).first()
+        if agent is None:
+            return jsonify(error="Agent %s not found" % agent_id), NOT_FOUND
+
+        if sent_from_other_address(agent):
+            logger.error("Agent with IP address %s tried to update tasks of "
+                         "agent %s (id %s) with IP address %s. Request "
+                         "rejected.", request.remote_addr, agent.hostname,
+                         agent.id, agent.remote_ip)
+            return jsonify(error="Tasks can only be updated by the agent "
+                                 "they belong to"), BAD_REQUEST
+
+        tasks = {}
+        for task in Task.query.filter(
+                Task.id.in_(set(x["task_id"] for x in updates))):
+            tasks[task.id] = task
+
+        results = []
+        transitions = {}
+        lost_copies = set()
+        for update in updates:
+            task = tasks.get(update["task_id"])
+            if task is None:
+                error = "Task not found"
+            elif (task.agent_id != agent.id and
+                  task.speculative_agent_id != agent.id):
+                error = "Task is not assigned to this agent"
+            else:
+                error = self.validate_update(task, update)
+
+            if error is not None:
+                results.append({"task_id": update["task_id"],
+                                "error": error})
+                continue
+
+            if task.agent_id != agent.id:
+                self.update_speculative_copy(
+                    task, agent, update, transitions, lost_copies)
+            else:
+                self.update_task(task, update, transitions, lost_copies)
+
+            if task.state is None and task.agent_id is None:
+                results.append({"task_id": task.id, "state": "queued"})
+            elif task.state is None:
+                results.append({"task_id": task.id, "state": "assigned"})
+            else:
+                results.append({"task_id": task.id, "state": str(task.state)})
+
+        db.session.commit()
+        logger.info("Applied %s task updates from agent %s (id %s)",
+                    len(updates), agent.hostname, agent.id)
+
+        for lost_agent_id, task_id in lost_copies:
+            stop_task.delay(task_id, lost_agent_id, dissociate_agent=False)
+
+        # As in JobSingleTaskAPI, the job states are updated in a transaction
+        # of their own so they see the results of other updates which were
+        # committed concurrently
+        jobs = dict((task.job_id, task.job) for task in tasks.values()
+                    if task.id in transitions)
+        job_done = False
+        for job in jobs.values():
+            old_state = job.state
+            job.update_state()
+            job_done |= (job.state != old_state and
+                         job.state == WorkState.DONE)
+        db.session.commit()
+
+        if config.get("enable_statistics") and transitions:
+            event_counts = {}
+            for task_id, new_state in transitions.items():
+                queue_id = tasks[task_id].job.job_queue_id
+                if queue_id not in event_counts:
+                    event_counts[queue_id] = TaskEventCount(
+                        job_queue_id=queue_id, num_restarted=0,
+                        num_started=0, num_done=0, num_failed=0)
+                column = TASK_EVENT_COLUMNS.get(new_state)
+                if column is not None:
+                    setattr(event_counts[queue_id], column,
+                            getattr(event_counts[queue_id], column) + 1)
+
+            now = datetime.utcnow()
+            for task_event_count in event_counts.values():
+                task_event_count.time_start = now
+                task_event_count.time_end = now
+                db.session.add(task_event_count)
+            db.session.commit()
+
+        task_count = Task.query.filter(
+            Task.agent_id == agent.id,
+            or_(Task.state == None,
+                Task.state == WorkState.RUNNING)).count()
+        if task_count == 0:
+            assign_tasks_to_agent.delay(agent.id)
+
+        if job_done:
+            request_scheduling()
+        elif lost_copies:
+            request_scheduling(agent_ids=set(x[0] for x in lost_copies))
+
+        return jsonify(results), OK
+
+    def validate_update(self, task, update):
+        """Returns an error message if `update` is invalid for `task`"""
+        new_state = update.get("state")
+        progress = update.get("progress")
+        last_error = update.get("last_error")
+        unknown_keys = set(update) - set(TASK_UPDATE_KEYS)
+        if unknown_keys:
+            return "Unknown keys in update: %s" % ", ".join(
+                sorted(unknown_keys))
+        if (new_state is not None and new_state != "queued" and
+            new_state not in Task.STATE_ENUM):
+            return "`%s` is not a valid state" % new_state
+        if progress is not None and (
+                not isinstance(progress, NUMERIC_TYPES) or
+                not 0.0 <= progress <= 1.0):
+            return "`progress` must be a number between 0.0 and 1.0"
+        if last_error is not None and not isinstance(last_error,
+                                                     STRING_TYPES):
+            return "`last_error` must be a string"
+        if (task.state == WorkState.DONE and progress is not None and
+            progress != 1.0):
+            return "Cannot set progress: task is already in state `done`"
+
+    def update_task(self, task, update, transitions, lost_copies):
+        """
+        Applies the valid `update` to `task`.  `transitions` and
+        `lost_copies` collect the state transitions and the speculative
+        copies which have to be stopped.
+        """
+        new_state = update.get("state")
+        progress = update.get("progress")
+        if new_state is not None and new_state != task.state:
+            logger.info("Task %s of job %s: state transition \"%s\" -> "
+                        "\"%s\"", task.id, task.job_id, task.state,
+                        new_state)
+            task.state = None if new_state == "queued" else new_state
+            transitions[task.id] = new_state
+        if progress is not None:
+            task.progress = progress
+        if "last_error" in update:
+            task.last_error = update["last_error"]
+
+        # The original is not running anymore, so neither should the copy
+        if (task.speculative_agent_id is not None and
+                task.state not in (WorkState.RUNNING, )):
+            lost_copies.add((task.end_speculation(), task.id))
+
+        db.session.add(task)
+
+    def update_speculative_copy(self, task, agent, update, transitions,
+                                lost_copies):
+        """
+        Applies the valid `update` to the speculative copy of `task` running
+        on `agent`.  Only the copy finishing or failing is acted upon, see
+        :meth:`.JobSingleTaskAPI.update_speculative_copy`.
+        """
+        new_state = update.get("state")
+        if new_state == "done":
+            logger.info("The speculative copy of task %s on agent %s "
+                        "finished first", task.id, agent.hostname)
+            lost_agent_id = task.promote_speculation()
+            task.agent = agent
+            if lost_agent_id is not None:
+                lost_copies.add((lost_agent_id, task.id))
+            self.update_task(task, update, transitions, lost_copies)
+
+        elif new_state == "failed":
+            logger.info("The speculative copy of task %s on agent %s failed",
+                        task.id, agent.hostname)
+            task.end_speculation()
+            if task not in agent.failed_tasks:
+                agent.failed_tasks.append(task)
+            db.session.add(task)
+            db.session.add(agent)
+
+
 class SoftwareInAgentIndexAPI(MethodView):
     def get(self, agent_id):
         """
@@ -31,13 +31,11 @@ except ImportError:  # pragma: no cover
 from flask.views import MethodView
 from flask import g
 
-from sqlalchemy import func, asc
+from sqlalchemy import asc
 from pyfarm.core.logger import getLogger
-from pyfarm.core.enums import WorkState
 from pyfarm.models.user import User
 from pyfarm.models.jobtype import JobType
 from pyfarm.models.job import Job
-from pyfarm.models.task import Task
 from pyfarm.models.jobgroup import JobGroup
 from pyfarm.master.config import config
 from pyfarm.master.utility import jsonify, validate_with_model
@@ -407,41 +405,9 @@ class JobsInJobGroupIndexAPI(MethodView):
             return (jsonify(error="Requested job group %s not found" % group_id),
                     NOT_FOUND)
 
-        queued_count_query = db.session.query(
-            Task.job_id, func.count('*').label('t_queued')).\
-                filter(Task.state == None).group_by(Task.job_id).subquery()
-        running_count_query = db.session.query(
-            Task.job_id, func.count('*').label('t_running')).\
-                filter(Task.state == WorkState.RUNNING).\
-                    group_by(Task.job_id).subquery()
-        done_count_query = db.session.query(
-            Task.job_id, func.count('*').label('t_done')).\
-                filter(Task.state == WorkState.DONE).\
-                    group_by(Task.job_id).subquery()
-        failed_count_query = db.session.query(
-            Task.job_id, func.count('*').label('t_failed')).\
-                filter(Task.state == WorkState.FAILED).\
-                    group_by(Task.job_id).subquery()
         jobs_query = db.session.query(
-            Job,
-            func.coalesce(
-                queued_count_query.c.t_queued,
-                0).label('t_queued'),
-            func.coalesce(
-                running_count_query.c.t_running,
-                0).label('t_running'),
-            func.coalesce(
-                done_count_query.c.t_done,
-                0).label('t_done'),
-            func.coalesce(
-                failed_count_query.c.t_failed,
-                0).label('t_failed')).\
-            outerjoin(queued_count_query,
-                      Job.id == queued_count_query.c.job_id).\
-            outerjoin(running_count_query,
-                      Job.id == running_count_query.c.job_id).\
-            outerjoin(done_count_query, Job.id == done_count_query.c.job_id).\
-            outerjoin(failed_count_query, Job.id == failed_count_query.c.job_id).\
+            Job, Job.num_tasks_queued, Job.num_tasks_running,
+            Job.num_tasks_done, Job.num_tasks_failed).\
             filter(Job.group == jobgroup).\
             order_by(asc(Job.time_submitted)).all()
 
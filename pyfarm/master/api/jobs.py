@@ -41,12 +41,14 @@ from sqlalchemy.sql import func, or_
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import STRING_TYPES, NUMERIC_TYPES, WorkState, _WorkState
 from pyfarm.scheduler.tasks import (
-    assign_tasks_to_agent, assign_tasks, delete_job)
+    assign_tasks_to_agent, delete_job, stop_task)
+from pyfarm.scheduler.triggers import request_scheduling
 from pyfarm.models.statistics.task_event_count import TaskEventCount
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.task import Task
 from pyfarm.models.user import User
 from pyfarm.models.job import Job, JobNotifiedUser
+from pyfarm.models.runtimestatistics import TaskRuntimeStatistics
 from pyfarm.models.software import (
     Software, SoftwareVersion, JobSoftwareRequirement)
 from pyfarm.models.tag import Tag, JobTagRequirement
@@ -504,7 +506,7 @@ class JobIndexAPI(MethodView):
                 job_data["state"] = "queued"
 
         logger.info("Created new job %r", job_data)
-        assign_tasks.delay()
+        request_scheduling(queue_ids=[job.job_queue_id])
 
         return jsonify(job_data), CREATED
 
@@ -970,7 +972,7 @@ class SingleJobAPI(MethodView):
                 job_data["state"] = "queued"
 
         logger.info("Job %s has been updated to: %r", job.id, job_data)
-        assign_tasks.delay()
+        request_scheduling(queue_ids=[job.job_queue_id])
 
         return jsonify(job_data), OK
 
@@ -1106,6 +1108,9 @@ class JobSingleTaskAPI(MethodView):
         in the request.  Columns not specified in the request will be left as
         they are.
         The agent will use this endpoint to inform the master of its progress.
+        An agent running a speculative copy of the task may only report that
+        the copy is done, which makes it the agent owning the task, or that
+        it failed.
 
         .. http:post:: /api/v1/jobs/[<str:name>|<int:id>]/tasks/<int:task_id> HTTP/1.1
 
@@ -1185,8 +1190,23 @@ class JobSingleTaskAPI(MethodView):
         if "frame" in g.json:
             return jsonify(error="`frame` cannot be changed"), BAD_REQUEST
 
+        from_agent = (
+            request.headers.get("User-Agent", "") == "PyFarm/1.0 (agent)")
+        speculative_agent = None
+        if (from_agent and task.speculative_agent_id is not None and
+            (task.agent is None or
+             request.remote_addr != task.agent.remote_ip)):
+            speculative_agent = Agent.query.filter_by(
+                id=task.speculative_agent_id).first()
+            if (speculative_agent is not None and
+                request.remote_addr != speculative_agent.remote_ip):
+                speculative_agent = None
+
+        if speculative_agent is not None and g.json.get("state") != "done":
+            return self.update_speculative_copy(task, speculative_agent)
+
         if (("state" in g.json or "progress" in g.json) and
-            request.headers.get("User-Agent", "") == "PyFarm/1.0 (agent)" and
+            from_agent and speculative_agent is None and
             (task.agent is None or
              request.remote_addr != task.agent.remote_ip)):
             logger.error("Agent with IP address %s tried to set state or "
@@ -1204,6 +1224,13 @@ class JobSingleTaskAPI(MethodView):
                                  "state `done`"), BAD_REQUEST
 
         new_state = g.json.pop("state", None)
+        lost_agent_id = None
+        if speculative_agent is not None:
+            logger.info("The speculative copy of task %s on agent %s finished "
+                        "first", task_id, speculative_agent.hostname)
+            lost_agent_id = task.promote_speculation()
+            task.agent = speculative_agent
+
         agent = task.agent
         state_transition = False
         if new_state is not None and new_state != task.state:
@@ -1235,9 +1262,18 @@ class JobSingleTaskAPI(MethodView):
             return (jsonify(error="Unknown columns in request: %r" % g.json),
                     BAD_REQUEST)
 
+        # The original is not running anymore, so neither should the copy
+        if (task.speculative_agent_id is not None and
+            task.state != _WorkState.RUNNING):
+            lost_agent_id = task.end_speculation()
+
         db.session.add(task)
         db.session.commit()
 
+        if lost_agent_id is not None:
+            stop_task.delay(task.id, lost_agent_id, dissociate_agent=False)
+            request_scheduling(agent_ids=[lost_agent_id])
+
         task_data = task.to_dict(unpack_relationships=("job", "agent",
                                                        "children", "parents",
                                                        "project"))
@@ -1265,7 +1301,7 @@ class JobSingleTaskAPI(MethodView):
             task.job.update_state()
             db.session.commit()
             if task.job.state != old_state and task.job.state == WorkState.DONE:
-                assign_tasks.delay()
+                request_scheduling()
 
         if config.get("enable_statistics") and task.job and state_transition:
             task_event_count = TaskEventCount(
@@ -1285,6 +1321,28 @@ class JobSingleTaskAPI(MethodView):
 
         return jsonify(task_data), OK
 
+    def update_speculative_copy(self, task, agent):
+        """
+        Handles an update from `agent` about the speculative copy of `task`
+        it is running.  Only the copy failing is acted upon, the state and
+        progress of the task are left to the agent running the original.
+        """
+        if g.json.get("state") == "failed":
+            logger.info("The speculative copy of task %s on agent %s failed",
+                        task.id, agent.hostname)
+            task.end_speculation()
+            if task not in agent.failed_tasks:
+                agent.failed_tasks.append(task)
+            db.session.add(task)
+            db.session.add(agent)
+            db.session.commit()
+            request_scheduling(agent_ids=[agent.id])
+
+        task_data = task.to_dict(unpack_relationships=("job", "agent",
+                                                       "children", "parents",
+                                                       "project"))
+        return jsonify(task_data), OK
+
     def get(self, job_name, task_id):
         """
         A ``GET`` to this endpoint will return the requested task
@@ -1683,3 +1741,61 @@ class JobSingleNotifiedUserAPI(MethodView):
                     "job %s (%s)", user.username, user.id, job.title, job.id)
 
         return jsonify(), NO_CONTENT
+
+
+class JobRuntimeAPI(MethodView):
+    def get(self, job_name):
+        """
+        A ``GET`` to this endpoint will return the statistics about the
+        runtime of the finished tasks in this job and the predicted time the
+        job will finish at.  If no task of the job has finished yet, the
+        statistics of its jobtype version are used.
+
+        .. http:get:: /api/v1/jobs/[<str:name>|<int:id>]/runtime HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/jobs/Test%20Job%202/runtime HTTP/1.1
+                Accept: application/json
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                {
+                    "statistics": {
+                        "count": 12,
+                        "mean": 95.4,
+                        "stddev": 10.2,
+                        "p50": 92.0,
+                        "p90": 110.4,
+                        "p99": 126.2
+                    },
+                    "remaining_time": 1144.8,
+                    "predicted_time_finished": "2015-06-02T11:31:02.412056"
+                }
+
+        :statuscode 200: no error
+        :statuscode 404: job not found
+        """
+        if isinstance(job_name, STRING_TYPES):
+            job = Job.query.filter_by(title=job_name).first()
+        else:
+            job = Job.query.filter_by(id=job_name).first()
+
+        if not job:
+            return jsonify(error="Job not found"), NOT_FOUND
+
+        statistics = TaskRuntimeStatistics.for_job(job)
+        time_finished = job.predict_time_finished()
+
+        return jsonify(
+            statistics=statistics.to_dict() if statistics else None,
+            remaining_time=job.predict_remaining_time(),
+            predicted_time_finished=(time_finished.isoformat()
+                                     if time_finished else None)), OK
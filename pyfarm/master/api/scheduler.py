@@ -0,0 +1,149 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler
+=========
+
+Contained within this module are API handling functions which expose
+information about the scheduler.
+"""
+
+try:
+    from httplib import OK
+except ImportError:  # pragma: no cover
+    from http.client import OK
+
+from flask.views import MethodView
+
+from pyfarm.core.logger import getLogger
+from pyfarm.models.agent import Agent
+from pyfarm.master.application import db
+from pyfarm.scheduler.tracing import read_traces
+from pyfarm.master.utility import (
+    jsonify, get_integer_argument, get_uuid_argument, get_request_argument)
+
+logger = getLogger("api.scheduler")
+
+
+class SchedulerTracesAPI(MethodView):
+    def get(self):
+        """
+        A ``GET`` to this endpoint will return the most recent scheduler
+        traces, newest first.  Traces are only written while
+        ``scheduler_trace`` is enabled in the configuration.
+
+        .. http:get:: /api/v1/scheduler/traces/ HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/scheduler/traces/?limit=1 HTTP/1.1
+                Accept: application/json
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                [
+                    {
+                        "cycle_id": "5d5e0bf3a2b54e0f8c2d1f9cbb9b1ab4",
+                        "agent_id": "dd0c6da2-0c91-42cf-a82f-6d503aae43d3",
+                        "time_started": "2015-06-02T10:12:45.531032",
+                        "time": 0.0712,
+                        "queries": 14,
+                        "phases": {
+                            "candidate_query": {"time": 0.0213, "queries": 5},
+                            "requirement_checks": {"time": 0.0104,
+                                                   "queries": 3},
+                            "batch_selection": {"time": 0.0091, "queries": 2},
+                            "commit": {"time": 0.0152, "queries": 3}
+                        },
+                        "rejections": [
+                            {"type": "job", "id": 12, "reason": "tags"},
+                            {"type": "queue", "id": 2,
+                             "reason": "max_agents"}
+                        ],
+                        "job_ids": [14],
+                        "tasks": 2
+                    }
+                ]
+
+        :qparam limit:
+            The maximum number of traces to return, defaults to 100
+
+        :qparam agent_id:
+            If set, return only traces for this agent
+
+        :qparam cycle_id:
+            If set, return only the trace with this id
+
+        :statuscode 200:
+            no error
+        """
+        limit = get_integer_argument("limit", default=100)
+        agent_id = get_uuid_argument("agent_id")
+        cycle_id = get_request_argument("cycle_id")
+
+        return jsonify(read_traces(
+            limit=limit, agent_id=agent_id, cycle_id=cycle_id)), OK
+
+
+class SchedulerAffinityAPI(MethodView):
+    def get(self):
+        """
+        A ``GET`` to this endpoint will return how often agents were assigned
+        tasks from the same job or job group they had worked on right
+        before, and so could reuse what they had cached locally.
+
+        .. http:get:: /api/v1/scheduler/affinity/ HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/scheduler/affinity/ HTTP/1.1
+                Accept: application/json
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                {
+                    "affinity_hits": 42,
+                    "agents": {
+                        "dd0c6da2-0c91-42cf-a82f-6d503aae43d3": 30,
+                        "8a3a3f1c-6f1c-4f2a-9a39-4e3b4c1fd2a7": 12
+                    }
+                }
+
+        :statuscode 200:
+            no error
+        """
+        agents = dict(
+            (str(agent_id), hits) for agent_id, hits in
+            db.session.query(Agent.id, Agent.affinity_hits).filter(
+                Agent.affinity_hits > 0))
+
+        return jsonify(affinity_hits=sum(agents.values()),
+                       agents=agents), OK
@@ -76,6 +76,12 @@ class Configuration(_Configuration):
         "scheduler_broker": ("PYFARM_SCHEDULER_BROKER", read_env),
         "scheduler_lockfile_base": (
             "PYFARM_SCHEDULER_LOCKFILE_BASE", read_env),
+        "scheduler_lock_backend": (
+            "PYFARM_SCHEDULER_LOCK_BACKEND", read_env),
+        "scheduler_lock_redis_url": (
+            "PYFARM_SCHEDULER_LOCK_REDIS_URL", read_env),
+        "scheduler_trace": ("PYFARM_SCHEDULER_TRACE", read_env_bool),
+        "scheduler_trace_file": ("PYFARM_SCHEDULER_TRACE_FILE", read_env),
         "transaction_retries": ("PYFARM_TRANSACTION_RETRIES", read_env_int),
         "agent_request_timeout": (
             "PYFARM_AGENT_REQUEST_TIMEOUT", read_env_int),
@@ -60,6 +60,10 @@ from pyfarm.models.pathmap import PathMap
 from pyfarm.models.tasklog import TaskLog
 from pyfarm.models.gpu import GPU
 from pyfarm.models.jobgroup import JobGroup
+from pyfarm.models.schedulerlock import SchedulerLock
+from pyfarm.models.schedulertrigger import SchedulerTrigger
+from pyfarm.models.runtimestatistics import (
+    TaskRuntimeStatistics, JobTypeVersionRuntimeStatistics)
 from pyfarm.models.statistics.agent_count import AgentCount
 from pyfarm.models.statistics.task_event_count import TaskEventCount
 from pyfarm.models.statistics.task_count import TaskCount
@@ -402,7 +406,8 @@ def load_api(app_instance, api_instance):
     """configures flask to serve the api endpoints"""
     from pyfarm.master.api.agents import (
         SingleAgentAPI, AgentIndexAPI, schema as agent_schema, TasksInAgentAPI,
-        SoftwareInAgentIndexAPI, SingleSoftwareInAgentAPI)
+        SoftwareInAgentIndexAPI, SingleSoftwareInAgentAPI, AgentHeartbeatAPI,
+        TaskUpdatesInAgentAPI)
     from pyfarm.master.api.software import (
         schema as software_schema, SoftwareIndexAPI, SingleSoftwareAPI,
         SoftwareVersionsIndexAPI, SingleSoftwareVersionAPI,
@@ -416,7 +421,8 @@ def load_api(app_instance, api_instance):
     from pyfarm.master.api.jobs import (
         schema as job_schema, JobIndexAPI, SingleJobAPI, JobTasksIndexAPI,
         JobSingleTaskAPI, JobNotifiedUsersIndexAPI, JobSingleNotifiedUserAPI,
-        TaskFailedOnAgentsIndexAPI, SingleTaskOnAgentFailureAPI)
+        TaskFailedOnAgentsIndexAPI, SingleTaskOnAgentFailureAPI,
+        JobRuntimeAPI)
     from pyfarm.master.api.jobqueues import (
         schema as jobqueues_schema, JobQueueIndexAPI, SingleJobQueueAPI)
     from pyfarm.master.api.agent_updates import AgentUpdatesAPI
@@ -427,6 +433,8 @@ def load_api(app_instance, api_instance):
     from pyfarm.master.api.jobgroups import (
         schema as jobgroups_schema, JobGroupIndexAPI, SingleJobGroupAPI,
         JobsInJobGroupIndexAPI)
+    from pyfarm.master.api.scheduler import (
+        SchedulerTracesAPI, SchedulerAffinityAPI)
 
     # top level types
     api_instance.add_url_rule(
@@ -453,6 +461,12 @@ def load_api(app_instance, api_instance):
     api_instance.add_url_rule(
         "/jobgroups/",
         view_func=JobGroupIndexAPI.as_view("jobgroup_index_api"))
+    api_instance.add_url_rule(
+        "/scheduler/traces/",
+        view_func=SchedulerTracesAPI.as_view("scheduler_traces_api"))
+    api_instance.add_url_rule(
+        "/scheduler/affinity/",
+        view_func=SchedulerAffinityAPI.as_view("scheduler_affinity_api"))
 
     # schemas
     api_instance.add_url_rule(
@@ -637,6 +651,15 @@ def load_api(app_instance, api_instance):
     api_instance.add_url_rule(
         "/agents/<uuid:agent_id>/tasks/",
         view_func=TasksInAgentAPI.as_view("tasks_in_agent_api"))
+    api_instance.add_url_rule(
+        "/agents/<uuid:agent_id>/tasks/updates",
+        view_func=TaskUpdatesInAgentAPI.as_view(
+            "task_updates_in_agent_api"))
+
+    # Agent heartbeats
+    api_instance.add_url_rule(
+        "/agents/<uuid:agent_id>/heartbeat",
+        view_func=AgentHeartbeatAPI.as_view("agent_heartbeat_api"))
 
     # Agents that failed a task
     api_instance.add_url_rule(
@@ -672,6 +695,14 @@ def load_api(app_instance, api_instance):
         view_func=JobSingleNotifiedUserAPI.as_view(
             "job_by_string_single_notified_api"))
 
+    # Runtime statistics and predictions of jobs
+    api_instance.add_url_rule(
+        "/jobs/<int:job_name>/runtime",
+        view_func=JobRuntimeAPI.as_view("job_by_id_runtime_api"))
+    api_instance.add_url_rule(
+        "/jobs/<string:job_name>/runtime",
+        view_func=JobRuntimeAPI.as_view("job_by_string_runtime_api"))
+
     # Task logs
     api_instance.add_url_rule(
         "/jobs/<int:job_id>/tasks/<int:task_id>/attempts/<int:attempt>/logs/",
@@ -115,6 +115,10 @@ class BaseTestCase(TestCase):
         from pyfarm.models.jobqueue import JobQueue
         from pyfarm.models.gpu import GPU
         from pyfarm.models.jobgroup import JobGroup
+        from pyfarm.models.schedulerlock import SchedulerLock
+        from pyfarm.models.schedulertrigger import SchedulerTrigger
+        from pyfarm.models.runtimestatistics import (
+            TaskRuntimeStatistics, JobTypeVersionRuntimeStatistics)
 
         # set ENVIRONMENT_SETUP so the tests will run
         cls.ENVIRONMENT_SETUP = True
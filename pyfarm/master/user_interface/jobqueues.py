@@ -20,7 +20,7 @@ except ImportError:  # pragma: no cover
     from http.client import SEE_OTHER, NOT_FOUND
 
 from flask import render_template, request, redirect, url_for, flash
-from sqlalchemy import or_
+from sqlalchemy import or_, desc
 
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import WorkState
@@ -31,9 +31,8 @@ from pyfarm.models.job import Job
 logger = getLogger("ui.jobqueues")
 
 def jobqueues():
-    jobqueues = JobQueue.query.filter_by(parent_jobqueue_id=None).all()
-    jobqueues = sorted(jobqueues, key=lambda x: x.num_assigned_agents(),
-                       reverse=True)
+    jobqueues = JobQueue.query.filter_by(parent_jobqueue_id=None).order_by(
+        desc(JobQueue.assigned_agents)).all()
 
     top_level_jobs_query = Job.query.filter_by(queue=None)
 
@@ -30,7 +30,8 @@ from sqlalchemy import func, desc, asc, or_, distinct
 
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import WorkState, _WorkState, AgentState
-from pyfarm.scheduler.tasks import delete_job, stop_task, assign_tasks
+from pyfarm.scheduler.tasks import delete_job, stop_task
+from pyfarm.scheduler.triggers import request_scheduling
 from pyfarm.models.job import (
     Job, JobDependency, JobTagAssociation, JobNotifiedUser)
 from pyfarm.models.tag import Tag, JobTagRequirement
@@ -44,29 +45,9 @@ from pyfarm.master.application import db
 logger = getLogger("ui.jobs")
 
 def jobs():
-    queued_count_query = db.session.query(
-        Task.job_id, func.count('*').label('t_queued')).\
-            filter(Task.state == None).group_by(Task.job_id).subquery()
-    running_count_query = db.session.query(
-        Task.job_id, func.count('*').label('t_running')).\
-            filter(Task.state == WorkState.RUNNING).\
-                group_by(Task.job_id).subquery()
-    done_count_query = db.session.query(
-        Task.job_id, func.count('*').label('t_done')).\
-            filter(Task.state == WorkState.DONE).\
-                group_by(Task.job_id).subquery()
-    failed_count_query = db.session.query(
-        Task.job_id, func.count('*').label('t_failed')).\
-            filter(Task.state == WorkState.FAILED).\
-                group_by(Task.job_id).subquery()
     child_count_query = db.session.query(
         JobDependency.c.parentid, func.count('*').label('child_count')).\
                 group_by(JobDependency.c.parentid).subquery()
-    blocker_count_query = db.session.query(
-        JobDependency.c.childid, func.count('*').label('blocker_count')).\
-            join(Job, Job.id == JobDependency.c.parentid).\
-                filter(or_(Job.state == None, Job.state != WorkState.DONE)).\
-                    group_by(JobDependency.c.childid).subquery()
     agent_count_query = db.session.query(
         Task.job_id, func.count(distinct(Task.agent_id)).label('agent_count')).\
             filter(Task.agent_id != None, or_(Task.state == None,
@@ -75,18 +56,10 @@ def jobs():
                 group_by(Task.job_id).subquery()
 
     jobs_query = db.session.query(Job,
-                                  func.coalesce(
-                                      queued_count_query.c.t_queued,
-                                      0).label('t_queued'),
-                                  func.coalesce(
-                                      running_count_query.c.t_running,
-                                      0).label('t_running'),
-                                  func.coalesce(
-                                      done_count_query.c.t_done,
-                                      0).label('t_done'),
-                                  func.coalesce(
-                                      failed_count_query.c.t_failed,
-                                      0).label('t_failed'),
+                                  Job.num_tasks_queued.label('t_queued'),
+                                  Job.num_tasks_running.label('t_running'),
+                                  Job.num_tasks_done.label('t_done'),
+                                  Job.num_tasks_failed.label('t_failed'),
                                   User.username,
                                   JobType.name.label('jobtype_name'),
                                   JobType.id.label('jobtype_id'),
@@ -94,22 +67,16 @@ def jobs():
                                   func.coalesce(
                                       child_count_query.c.child_count,
                                       0).label('child_count'),
-                                  func.coalesce(
-                                      blocker_count_query.c.blocker_count,
-                                      0).label('blocker_count'),
+                                  Job.unfinished_parents.label(
+                                      'blocker_count'),
                                   func.coalesce(
                                       agent_count_query.c.agent_count,
                                       0).label('agent_count')).\
         join(JobTypeVersion, Job.jobtype_version_id == JobTypeVersion.id).\
         join(JobType, JobTypeVersion.jobtype_id == JobType.id).\
         outerjoin(JobQueue, Job.job_queue_id == JobQueue.id).\
-        outerjoin(queued_count_query, Job.id == queued_count_query.c.job_id).\
-        outerjoin(running_count_query, Job.id == running_count_query.c.job_id).\
-        outerjoin(done_count_query, Job.id == done_count_query.c.job_id).\
-        outerjoin(failed_count_query, Job.id == failed_count_query.c.job_id).\
         outerjoin(User, Job.user_id == User.id).\
         outerjoin(child_count_query, Job.id == child_count_query.c.parentid).\
-        outerjoin(blocker_count_query, Job.id == blocker_count_query.c.childid).\
         outerjoin(agent_count_query, Job.id == agent_count_query.c.job_id)
 
     filters = {}
@@ -188,10 +155,10 @@ def jobs():
                                   request.args["not_blocked"].lower() == "true")
     if not filters["blocked"]:
         jobs_query = jobs_query.filter(
-            blocker_count_query.c.blocker_count == None)
+            Job.unfinished_parents == 0)
     if not filters["not_blocked"]:
         jobs_query = jobs_query.filter(
-            blocker_count_query.c.blocker_count != None)
+            Job.unfinished_parents != 0)
 
     filters["no_user"] = ("no_user" in request.args and
                           request.args["no_user"].lower() == "true")
@@ -408,6 +375,8 @@ def single_job(job_id):
         autodelete_time["minutes"], autodelete_time["seconds"] =\
             divmod(remainder, 60)
 
+    predicted_time_finished = job.predict_time_finished()
+
     return render_template("pyfarm/user_interface/job.html", job=job,
                            tasks=tasks, first_task=first_task,
                            last_task=last_task, queues=jobqueues,
@@ -415,6 +384,7 @@ def single_job(job_id):
                            latest_jobtype_version=latest_jobtype_version[0],
                            now=datetime.utcnow(),
                            autodelete_time=autodelete_time,
+                           predicted_time_finished=predicted_time_finished,
                            order_by=order_by, order_dir=order_dir)
 
 def delete_single_job(job_id):
@@ -489,7 +459,7 @@ def rerun_single_job(job_id):
 
     job.rerun()
     db.session.commit()
-    assign_tasks.delay()
+    request_scheduling()
 
     logger.info("Job %s (job id: %s) is being rerun by request from %s",
                 job.title, job.id, request.remote_addr)
@@ -515,7 +485,7 @@ def rerun_multiple_jobs():
                     job.title, job.id, request.remote_addr)
 
     db.session.commit()
-    assign_tasks.delay()
+    request_scheduling()
 
     flash("Selected jobs will be run again.")
 
@@ -534,7 +504,7 @@ def rerun_failed_in_job(job_id):
     job.rerun_failed()
     db.session.commit()
 
-    assign_tasks.delay()
+    request_scheduling()
 
     logger.info("Failed tasks from job %s (job id: %s) are being rerun by "
                 "request from %s",
@@ -563,7 +533,7 @@ def rerun_failed_in_multiple_jobs():
         job.rerun_failed()
         db.session.commit()
 
-    assign_tasks.delay()
+    request_scheduling()
 
     flash("Failed tasks in selected jobs will be run again.")
 
@@ -587,7 +557,7 @@ def pause_single_job(job_id):
         if task.state == WorkState.RUNNING:
             stop_task.delay(task.id)
 
-    assign_tasks.delay()
+    request_scheduling()
 
     flash("Job %s will be paused." % job.title)
 
@@ -618,7 +588,7 @@ def pause_multiple_jobs():
 
     for task_id in task_ids_to_stop:
         stop_task.delay(task_id)
-    assign_tasks.delay()
+    request_scheduling()
 
     flash("Selected jobs will be paused.")
 
@@ -639,7 +609,7 @@ def unpause_single_job(job_id):
     db.session.add(job)
     db.session.commit()
 
-    assign_tasks.delay()
+    request_scheduling()
 
     flash("Job %s is unpaused." % job.title)
 
@@ -664,7 +634,7 @@ def unpause_multiple_jobs():
 
     db.session.commit()
 
-    assign_tasks.delay()
+    request_scheduling()
 
     flash("Selected jobs are unpaused")
 
@@ -690,7 +660,7 @@ def alter_frames_in_single_job(job_id):
                     "pyfarm/error.html", error=e), BAD_REQUEST)
 
     db.session.commit()
-    assign_tasks.delay()
+    request_scheduling()
 
     flash("Frame selection for job %s has been changed." % job.title)
 
@@ -1166,7 +1136,7 @@ def rerun_single_task(job_id, task_id):
     db.session.add(task)
     db.session.commit()
 
-    assign_tasks.delay()
+    request_scheduling()
 
     flash("Task %s (frame %s) in job %s will be run again." %
           (task.id, task.frame, job.title))
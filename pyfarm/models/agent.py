@@ -25,11 +25,13 @@ import re
 import uuid
 from datetime import datetime
 
-from sqlalchemy import or_
+from sqlalchemy import event, inspect, or_, and_, select, bindparam
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.schema import UniqueConstraint
-from sqlalchemy.orm import validates
+from sqlalchemy.orm import validates, aliased, Session
 from netaddr import AddrFormatError, IPAddress
 
+from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import (
     AgentState, STRING_TYPES, UseAgentAddress, INTEGER_TYPES, WorkState)
 from pyfarm.master.config import config
@@ -42,15 +44,28 @@ from pyfarm.models.core.types import (
     OperatingSystemEnum, AgentStateEnum, MACAddress)
 from pyfarm.models.jobtype import JobTypeVersion
 from pyfarm.models.job import Job
+from pyfarm.models.software import SoftwareVersion, JobTypeSoftwareRequirement
+from pyfarm.models.tag import Tag
+from pyfarm.models.task import Task
 
 
 __all__ = ("Agent", )
 
+logger = getLogger("models.agent")
+
 ALLOW_AGENT_LOOPBACK = config.get("allow_agents_from_loopback")
+MULTI_SLOT = config.get("scheduler_multi_slot")
+DEFAULT_RAM_ALLOCATION = config.get("agent_ram_allocation")
+DEFAULT_CPU_ALLOCATION = config.get("agent_cpu_allocation")
+AFFINITY_TOLERANCE = config.get("scheduler_affinity_tolerance")
 REGEX_HOSTNAME = re.compile("^(?!-)[A-Z\d-]{1,63}(?<!-)"
                             "(\.(?!-)[A-Z\d-]{1,63}(?<!-))*\.?$",
                             re.IGNORECASE)
 
+# Keys used for tracking invalidated capabilities in Session.info
+CAPABILITY_CHANGES = "pf_capability_changes"
+CAPABILITY_UPDATED = "pf_capability_updated"
+
 
 AgentSoftwareVersionAssociation = db.Table(
     config.get("table_agent_software_version_assoc"), db.metadata,
@@ -100,6 +115,161 @@ GPUInAgent = db.Table(
         primary_key=True))
 
 
+AgentJobTypeVersionCapability = db.Table(
+    config.get("table_agent_jobtype_version_capability"), db.metadata,
+    db.Column(
+        "agent_id", IDTypeAgent,
+        db.ForeignKey("%s.id" % config.get("table_agent"), ondelete="CASCADE"),
+        primary_key=True),
+    db.Column(
+        "jobtype_version_id", db.Integer,
+        db.ForeignKey("%s.id" % config.get("table_job_type_version"),
+                      ondelete="CASCADE"),
+        primary_key=True),
+    db.Column(
+        "supported", db.Boolean,
+        nullable=False),
+    db.Column(
+        "agent_revision", db.Integer,
+        nullable=False),
+    db.Column(
+        "jobtype_version_revision", db.Integer,
+        nullable=False))
+
+
+class AgentReservation(object):
+    """
+    The cpus and ram reserved on an agent by the jobs it has queued or
+    running tasks from.  A job which requires -1 cpus or ram, meaning the
+    entire agent, makes the reservation exclusive.
+    """
+    def __init__(self):
+        self.cpus = 0
+        self.ram = 0
+        self.job_ids = set()
+        self.exclusive = False
+
+    def add(self, job_id, cpus, ram):
+        if job_id in self.job_ids:
+            return
+
+        self.job_ids.add(job_id)
+        cpus = cpus or 0
+        ram = ram or 0
+        if cpus < 0 or ram < 0:
+            self.exclusive = True
+        self.cpus += max(cpus, 0)
+        self.ram += max(ram, 0)
+
+    def fits(self, agent, job):
+        """
+        Returns True if `job` can be started on `agent` in addition to the
+        jobs already reserved.  An agent without any work can always take on
+        a job, further jobs have to fit into the agent's ``cpu_allocation``
+        and ``ram_allocation`` and are only assigned if
+        ``scheduler_multi_slot`` is enabled.
+        """
+        if not self.job_ids:
+            return True
+
+        if not MULTI_SLOT or self.exclusive or job.id in self.job_ids:
+            return False
+
+        cpus = job.cpus or 0
+        ram = job.ram or 0
+        if cpus < 0 or ram < 0:
+            return False
+
+        cpu_capacity, ram_capacity = self.capacity(agent)
+        return (self.cpus + cpus <= cpu_capacity and
+                self.ram + ram <= ram_capacity)
+
+    def has_capacity(self, agent):
+        """
+        Returns True if `agent` might be able to take on another job, used to
+        skip busy agents before looking for work for them
+        """
+        if not self.job_ids:
+            return True
+
+        if not MULTI_SLOT or self.exclusive:
+            return False
+
+        cpu_capacity, ram_capacity = self.capacity(agent)
+        return self.cpus < cpu_capacity and self.ram < ram_capacity
+
+    @staticmethod
+    def capacity(agent):
+        """
+        Returns a tuple of the cpus and ram of `agent` which may be allocated
+        to work
+        """
+        cpu_allocation = agent.cpu_allocation
+        if cpu_allocation is None:
+            cpu_allocation = DEFAULT_CPU_ALLOCATION
+        ram_allocation = agent.ram_allocation
+        if ram_allocation is None:
+            ram_allocation = DEFAULT_RAM_ALLOCATION
+
+        return agent.cpus * cpu_allocation, agent.ram * ram_allocation
+
+
+class AgentAffinity(object):
+    """
+    The job an agent most recently got work from, which it likely still has
+    the scene files and textures of in its local cache.  Jobs and queues are
+    scored by how much of that cache they are likely to reuse.
+    """
+    def __init__(self, job_id=None, jobtype_version_id=None,
+                 job_group_id=None, queue_ids=()):
+        self.job_id = job_id
+        self.jobtype_version_id = jobtype_version_id
+        self.job_group_id = job_group_id
+        self.queue_ids = set(queue_ids)
+
+    def score_job(self, job):
+        """
+        Returns 3 if `job` is the agent's last job, 2 if it is part of the
+        same job group, 1 if it uses the same jobtype version and 0 otherwise
+        """
+        if self.job_id is None:
+            return 0
+        if job.id == self.job_id:
+            return 3
+        if (self.job_group_id is not None and
+                job.job_group_id == self.job_group_id):
+            return 2
+        if job.jobtype_version_id == self.jobtype_version_id:
+            return 1
+        return 0
+
+    def score_queue(self, queue_id):
+        """Returns 1 if the agent's last job is part of the given queue"""
+        return 1 if queue_id in self.queue_ids else 0
+
+    @staticmethod
+    def sort_key(share, score):
+        """
+        Returns the key to sort a job or queue by among those of equal
+        priority.  `share` is the ratio between the share of the agents the
+        job or queue has and the share its weight entitles it to.  Jobs and
+        queues with affinity are allowed to be up to
+        ``scheduler_affinity_tolerance`` above their fair share before others
+        are preferred over them.
+        """
+        if AFFINITY_TOLERANCE is None or not score:
+            return share, 0
+        return share - AFFINITY_TOLERANCE, -score
+
+    @staticmethod
+    def max_advantage():
+        """
+        Returns how far below its share :meth:`sort_key` may place a job or
+        queue
+        """
+        return max(AFFINITY_TOLERANCE or 0, 0)
+
+
 class AgentTaggingMixin(object):
     """
     Mixin used which provides some common structures to
@@ -156,6 +326,13 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         "id", "hostname", "port", "state", "remote_ip",
         "cpus", "ram", "free_ram")
     REPR_CONVERT_COLUMN = {"remote_ip": repr_ip}
+    DICT_CONVERT_COLUMN = {
+        "last_job_id": NotImplemented,
+        "last_jobtype_version_id": NotImplemented,
+        "last_job_group_id": NotImplemented,
+        "affinity_hits": NotImplemented,
+        "last_heartbeat": NotImplemented,
+        "capability_revision": NotImplemented}
     URL_TEMPLATE = config.get("agent_api_url_template")
 
     MIN_PORT = config.get("agent_min_port")
@@ -277,6 +454,19 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         db.DateTime,
         doc="Time we last tried to contact the agent")
 
+    last_heartbeat = db.Column(
+        db.DateTime,
+        nullable=True,
+        doc="Time the agent last sent a heartbeat.  Agents which send "
+            "heartbeats are only polled once their heartbeats stop.")
+
+    capability_revision = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="Incremented on flush whenever the software of this agent "
+            "changes.  Entries in the capability index are only used "
+            "while they carry the current revision.")
+
     # Max allocation of the two primary resources which `1.0` is 100%
     # allocation.  For `cpu_allocation` 100% allocation typically means
     # one task per cpu.
@@ -299,6 +489,29 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
             "task requires 4 cpus then only that task will "
             "run on the system.")
 
+    last_job_id = db.Column(
+        db.Integer,
+        nullable=True,
+        doc="The job this agent was most recently assigned tasks from")
+
+    last_jobtype_version_id = db.Column(
+        db.Integer,
+        nullable=True,
+        doc="The jobtype version of the job this agent was most recently "
+            "assigned tasks from")
+
+    last_job_group_id = db.Column(
+        db.Integer,
+        nullable=True,
+        doc="The job group of the job this agent was most recently "
+            "assigned tasks from")
+
+    affinity_hits = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The number of times this agent was assigned tasks from the "
+            "same job or job group it had worked on right before")
+
     #
     # Relationships
     #
@@ -306,6 +519,7 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
     tasks = db.relationship(
         "Task",
         backref="agent", lazy="dynamic",
+        foreign_keys="Task.agent_id",
         doc="Relationship between an :class:`Agent` and any "
             ":class:`pyfarm.models.Task` objects")
 
@@ -356,54 +570,298 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
     def is_disabled(self):
         return self.state == AgentState.DISABLED
 
+    def clear_scheduling_cache(self):
+        """
+        Forgets the supported jobtype versions and tag bits cached on this
+        instance, called at the start of every scheduling cycle
+        """
+        self.__dict__.pop("support_jobtype_versions", None)
+        self.__dict__.pop("tag_bits", None)
+        self.__dict__.pop("reservation", None)
+        self.__dict__.pop("affinity", None)
+
+    @staticmethod
+    def load_reservations(agent_ids):
+        """
+        Returns a dictionary mapping each of the given agent ids to the
+        :class:`AgentReservation` of the jobs the agent has queued or running
+        tasks from
+        """
+        agent_ids = list(agent_ids)
+        reservations = dict(
+            (agent_id, AgentReservation()) for agent_id in agent_ids)
+        if not agent_ids:
+            return reservations
+
+        reservations_query = db.session.query(
+            Task.agent_id, Job.id, Job.cpus, Job.ram).\
+                join(Job, Task.job_id == Job.id).filter(
+                    Task.agent_id.in_(agent_ids),
+                    or_(Task.state == None,
+                        Task.state == WorkState.RUNNING)).distinct()
+        for agent_id, job_id, cpus, ram in reservations_query:
+            reservations[agent_id].add(job_id, cpus, ram)
+
+        return reservations
+
+    def get_reservation(self):
+        """
+        Returns the :class:`AgentReservation` of this agent, which is cached
+        until :meth:`clear_scheduling_cache` is called
+        """
+        try:
+            return self.reservation
+        except AttributeError:
+            self.reservation = Agent.load_reservations([self.id])[self.id]
+            return self.reservation
+
+    def get_affinity(self):
+        """
+        Returns the :class:`AgentAffinity` of this agent, which is cached
+        until :meth:`clear_scheduling_cache` is called
+        """
+        try:
+            return self.affinity
+        except AttributeError:
+            # Import here instead of at the top to avoid circular import
+            from pyfarm.models.jobqueue import JobQueue
+
+            queue_ids = []
+            if self.last_job_id is not None:
+                queue_id = db.session.query(Job.job_queue_id).filter(
+                    Job.id == self.last_job_id).scalar()
+                while queue_id is not None and queue_id not in queue_ids:
+                    queue_ids.append(queue_id)
+                    queue_id = db.session.query(
+                        JobQueue.parent_jobqueue_id).filter(
+                            JobQueue.id == queue_id).scalar()
+
+            self.affinity = AgentAffinity(
+                self.last_job_id, self.last_jobtype_version_id,
+                self.last_job_group_id, queue_ids)
+            return self.affinity
+
+    def record_assignment(self, job):
+        """
+        Remembers `job` as the job this agent most recently got work from
+        and counts an affinity hit if it is the same job or part of the same
+        job group as the previous one
+        """
+        if (self.last_job_id is not None and
+            (job.id == self.last_job_id or
+             (job.job_group_id is not None and
+              job.job_group_id == self.last_job_group_id))):
+            self.affinity_hits = (self.affinity_hits or 0) + 1
+
+        self.last_job_id = job.id
+        self.last_jobtype_version_id = job.jobtype_version_id
+        self.last_job_group_id = job.job_group_id
+        self.__dict__.pop("affinity", None)
+
+    def get_tag_bits(self):
+        """Returns the tags of this agent as a bitset, see :meth:`Tag.bitset`"""
+        try:
+            return self.tag_bits
+        except AttributeError:
+            self.tag_bits = Tag.bitset(x[0] for x in db.session.query(
+                AgentTagAssociation.c.tag_id).filter(
+                    AgentTagAssociation.c.agent_id == self.id))
+            return self.tag_bits
+
     def get_supported_types(self):
         try:
             return self.support_jobtype_versions
         except AttributeError:
-            jobtype_versions_query = JobTypeVersion.query.filter(
-                JobTypeVersion.jobs.any(
-                    or_(Job.state == None, Job.state == WorkState.RUNNING)))
+            jobtype_version_ids = [x[0] for x in db.session.query(
+                JobTypeVersion.id).filter(JobTypeVersion.jobs.any(
+                    or_(Job.state == None, Job.state == WorkState.RUNNING)))]
 
-            self.support_jobtype_versions = []
-            for jobtype_version in jobtype_versions_query:
-                if self.satisfies_jobtype_requirements(jobtype_version):
-                    self.support_jobtype_versions.append(jobtype_version.id)
+            supported = Agent.get_capabilities(
+                [self.id], jobtype_version_ids)[self.id]
+            self.support_jobtype_versions = [
+                x for x in jobtype_version_ids if x in supported]
 
             return self.support_jobtype_versions
 
     def satisfies_jobtype_requirements(self, jobtype_version):
-        requirements_to_satisfy = list(jobtype_version.software_requirements)
+        if jobtype_version.id in self.get_supported_types():
+            return True
 
-        for software_version in self.software_versions:
-            for requirement in list(requirements_to_satisfy):
-                if (software_version.software == requirement.software and
-                    (requirement.min_version == None or
-                    requirement.min_version.rank <= software_version.rank) and
-                    (requirement.max_version == None or
-                    requirement.max_version.rank >= software_version.rank)):
-                    requirements_to_satisfy.remove(requirement)
+        return jobtype_version.id in Agent.get_capabilities(
+            [self.id], [jobtype_version.id])[self.id]
 
-        return len(requirements_to_satisfy) == 0
+    @staticmethod
+    def get_capabilities(agent_ids, jobtype_version_ids):
+        """
+        Returns a dictionary mapping each of the given agent ids to the set of
+        ids of the given jobtype versions whose software requirements the
+        agent satisfies.
+
+        The results are stored in the capability index and only recomputed
+        after the software of an agent, the software requirements of a
+        jobtype version or the rank of a software version have changed.
+        Each entry carries the :attr:`capability_revision` of its agent and
+        its jobtype version, which are read before the software and the
+        requirements the entry is computed from, so an entry computed while
+        another transaction changed them is never used.
+        """
+        agent_ids = list(agent_ids)
+        jobtype_version_ids = list(jobtype_version_ids)
+        capabilities = dict((agent_id, set()) for agent_id in agent_ids)
+        if not agent_ids or not jobtype_version_ids:
+            return capabilities
+
+        agent_revisions = dict(db.session.query(
+            Agent.id, Agent.capability_revision).filter(
+                Agent.id.in_(agent_ids)))
+        jobtype_version_revisions = dict(db.session.query(
+            JobTypeVersion.id, JobTypeVersion.capability_revision).filter(
+                JobTypeVersion.id.in_(jobtype_version_ids)))
+
+        table = AgentJobTypeVersionCapability
+        known = set()
+        stale = []
+        known_query = db.session.query(
+            table.c.agent_id, table.c.jobtype_version_id, table.c.supported,
+            table.c.agent_revision, table.c.jobtype_version_revision).filter(
+                table.c.agent_id.in_(agent_ids),
+                table.c.jobtype_version_id.in_(jobtype_version_ids))
+        for agent_id, jobtype_version_id, supported, agent_revision, \
+                jobtype_version_revision in known_query:
+            if (agent_revision != agent_revisions.get(agent_id) or
+                    jobtype_version_revision !=
+                    jobtype_version_revisions.get(jobtype_version_id)):
+                stale.append({"b_agent_id": agent_id,
+                              "b_jobtype_version_id": jobtype_version_id})
+                continue
+            known.add((agent_id, jobtype_version_id))
+            if supported:
+                capabilities[agent_id].add(jobtype_version_id)
+
+        missing = [(agent_id, jobtype_version_id) for agent_id in agent_ids
+                   for jobtype_version_id in jobtype_version_ids
+                   if (agent_id, jobtype_version_id) not in known]
+        if not missing:
+            return capabilities
+
+        software = dict((agent_id, {}) for agent_id, _ in missing)
+        software_query = db.session.query(
+            AgentSoftwareVersionAssociation.c.agent_id,
+            SoftwareVersion.software_id, SoftwareVersion.rank).\
+                join(SoftwareVersion,
+                     AgentSoftwareVersionAssociation.c.software_version_id ==
+                        SoftwareVersion.id).\
+                filter(AgentSoftwareVersionAssociation.c.agent_id.in_(
+                    list(software)))
+        for agent_id, software_id, rank in software_query:
+            software[agent_id].setdefault(software_id, []).append(rank)
+
+        requirements = dict((x, []) for _, x in missing)
+        min_version = aliased(SoftwareVersion)
+        max_version = aliased(SoftwareVersion)
+        requirements_query = db.session.query(
+            JobTypeSoftwareRequirement.jobtype_version_id,
+            JobTypeSoftwareRequirement.software_id,
+            min_version.rank, max_version.rank).\
+                outerjoin(min_version,
+                          JobTypeSoftwareRequirement.min_version_id ==
+                            min_version.id).\
+                outerjoin(max_version,
+                          JobTypeSoftwareRequirement.max_version_id ==
+                            max_version.id).\
+                filter(JobTypeSoftwareRequirement.jobtype_version_id.in_(
+                    list(requirements)))
+        for jobtype_version_id, software_id, min_rank, max_rank in \
+                requirements_query:
+            requirements[jobtype_version_id].append(
+                (software_id, min_rank, max_rank))
+
+        rows = []
+        for agent_id, jobtype_version_id in missing:
+            agent_software = software[agent_id]
+            supported = all(
+                any((min_rank is None or min_rank <= rank) and
+                    (max_rank is None or max_rank >= rank)
+                    for rank in agent_software.get(software_id, ()))
+                for software_id, min_rank, max_rank in
+                requirements[jobtype_version_id])
+            if supported:
+                capabilities[agent_id].add(jobtype_version_id)
+            if (agent_id in agent_revisions and
+                    jobtype_version_id in jobtype_version_revisions):
+                rows.append({
+                    "agent_id": agent_id,
+                    "jobtype_version_id": jobtype_version_id,
+                    "supported": supported,
+                    "agent_revision": agent_revisions[agent_id],
+                    "jobtype_version_revision":
+                        jobtype_version_revisions[jobtype_version_id]})
+
+        Agent.store_capabilities(rows, stale)
+        return capabilities
+
+    @staticmethod
+    def store_capabilities(rows, stale=()):
+        """
+        Replaces the `stale` entries of the capability index, dictionaries
+        of ``b_agent_id`` and ``b_jobtype_version_id``, with `rows`.  This
+        happens in a savepoint, so if another transaction stores the same
+        entries at the same time only the savepoint is rolled back instead
+        of the caller's transaction.  The index is only a cache, entries
+        which could not be stored are computed again on the next lookup.
+        """
+        if not rows and not stale:
+            return
+
+        # Errors in the caller's own changes must not be swallowed below
+        db.session.flush()
+
+        table = AgentJobTypeVersionCapability
+        try:
+            with db.session.begin_nested():
+                if stale:
+                    db.session.execute(table.delete().where(and_(
+                        table.c.agent_id == bindparam("b_agent_id"),
+                        table.c.jobtype_version_id ==
+                            bindparam("b_jobtype_version_id"))),
+                        list(stale))
+                if rows:
+                    db.session.execute(table.insert(), rows)
+        except (IntegrityError, OperationalError) as e:
+            logger.debug("Could not store %s entries in the capability "
+                         "index: %s", len(rows), e)
 
     def satisfies_job_requirements(self, job):
+        return self.unsatisfied_job_requirement(job) is None
+
+    def unsatisfied_job_requirement(self, job, ignore_load=False):
+        """
+        Returns the first requirement of `job` this agent does not satisfy,
+        one of ``software``, ``cpus``, ``ram``, ``capacity`` or ``tags``, or
+        None if the agent satisfies all of them.  With `ignore_load` the work
+        the agent currently has is disregarded, its total ram is compared
+        instead of its free ram and the capacity is not checked.
+        """
         if not self.satisfies_jobtype_requirements(job.jobtype_version):
-            return False
+            return "software"
 
         if self.cpus < job.cpus:
-            return False
+            return "cpus"
 
-        if self.free_ram < job.ram:
-            return False
+        if (self.ram if ignore_load else self.free_ram) < job.ram:
+            return "ram"
 
-        for tag_requirement in job.tag_requirements:
-            if (not tag_requirement.negate and
-                tag_requirement.tag not in self.tags):
-                return False
-            if (tag_requirement.negate and
-                tag_requirement.tag in self.tags):
-                return False
+        if not ignore_load and not self.get_reservation().fits(self, job):
+            return "capacity"
 
-        return True
+        required_bits, forbidden_bits = job.get_tag_requirement_bits()
+        tag_bits = self.get_tag_bits()
+        if tag_bits & required_bits != required_bits:
+            return "tags"
+        if tag_bits & forbidden_bits:
+            return "tags"
+
+        return None
 
     @classmethod
     def validate_hostname(cls, key, value):
@@ -516,3 +974,121 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
     def validate_remote_ip(self, key, value):
         """Validates the remote_ip column"""
         return self.validate_ipv4_address(key, value)
+
+    @staticmethod
+    def collect_capability_changes(session, flush_context, instances):
+        """
+        Remembers all changes in a session which invalidate entries in the
+        capability index used by :meth:`get_capabilities`
+        """
+        changes = session.info.setdefault(
+            CAPABILITY_CHANGES,
+            {"agent_ids": set(), "jobtype_version_ids": set(),
+             "software_ids": set()})
+
+        for obj in session.dirty:
+            if isinstance(obj, Agent):
+                if inspect(obj).attrs.software_versions.history.has_changes():
+                    changes["agent_ids"].add(obj.id)
+
+            elif isinstance(obj, SoftwareVersion):
+                attrs = inspect(obj).attrs
+                if attrs.rank.history.has_changes():
+                    changes["software_ids"].add(obj.software_id)
+                history = attrs.agents.history
+                changes["agent_ids"].update(
+                    x.id for x in history.added or ())
+                changes["agent_ids"].update(
+                    x.id for x in history.deleted or ())
+
+        for obj in list(session.new) + list(session.dirty) + \
+                list(session.deleted):
+            if isinstance(obj, JobTypeSoftwareRequirement):
+                if obj.jobtype_version_id is not None:
+                    changes["jobtype_version_ids"].add(obj.jobtype_version_id)
+                elif obj.jobtype_version is not None:
+                    changes["jobtype_version_ids"].add(obj.jobtype_version.id)
+
+        for obj in session.deleted:
+            if isinstance(obj, SoftwareVersion):
+                changes["software_ids"].add(obj.software_id)
+            elif isinstance(obj, Agent):
+                changes["agent_ids"].add(obj.id)
+            elif isinstance(obj, JobTypeVersion):
+                changes["jobtype_version_ids"].add(obj.id)
+
+    @staticmethod
+    def invalidate_capabilities(session, flush_context):
+        """
+        Removes the entries invalidated by the flush from the capability
+        index, they will be recomputed on the next lookup.
+        """
+        changes = session.info.pop(CAPABILITY_CHANGES, None)
+        if not changes:
+            return
+
+        # The revisions are incremented first, so entries which are still
+        # being computed by other transactions will not be used either
+        agents = Agent.__table__
+        jobtype_versions = JobTypeVersion.__table__
+        changes["jobtype_version_ids"].discard(None)
+        changes["agent_ids"].discard(None)
+        if changes["agent_ids"]:
+            session.execute(agents.update().where(
+                agents.c.id.in_(changes["agent_ids"])).values(
+                    capability_revision=agents.c.capability_revision + 1))
+        jobtype_version_conditions = []
+        if changes["jobtype_version_ids"]:
+            jobtype_version_conditions.append(jobtype_versions.c.id.in_(
+                changes["jobtype_version_ids"]))
+        if changes["software_ids"]:
+            jobtype_version_conditions.append(jobtype_versions.c.id.in_(
+                select([JobTypeSoftwareRequirement.jobtype_version_id]).where(
+                    JobTypeSoftwareRequirement.software_id.in_(
+                        changes["software_ids"]))))
+        if jobtype_version_conditions:
+            session.execute(jobtype_versions.update().where(
+                or_(*jobtype_version_conditions)).values(
+                    capability_revision=
+                        jobtype_versions.c.capability_revision + 1))
+        session.info[CAPABILITY_UPDATED] = changes
+
+        table = AgentJobTypeVersionCapability
+        if changes["agent_ids"]:
+            session.execute(table.delete().where(
+                table.c.agent_id.in_(changes["agent_ids"])))
+        if changes["jobtype_version_ids"]:
+            session.execute(table.delete().where(
+                table.c.jobtype_version_id.in_(
+                    changes["jobtype_version_ids"])))
+        if changes["software_ids"]:
+            session.execute(table.delete().where(
+                table.c.jobtype_version_id.in_(select(
+                    [JobTypeSoftwareRequirement.jobtype_version_id]).where(
+                        JobTypeSoftwareRequirement.software_id.in_(
+                            changes["software_ids"])))))
+
+    @staticmethod
+    def expire_capability_revisions(session, flush_context):
+        changes = session.info.pop(CAPABILITY_UPDATED, None)
+        if not changes:
+            return
+
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, Agent) and obj.id in changes["agent_ids"]:
+                session.expire(obj, ["capability_revision"])
+            elif isinstance(obj, JobTypeVersion) and (
+                    changes["software_ids"] or
+                    obj.id in changes["jobtype_version_ids"]):
+                session.expire(obj, ["capability_revision"])
+
+    @staticmethod
+    def discard_capability_changes(session):
+        session.info.pop(CAPABILITY_CHANGES, None)
+        session.info.pop(CAPABILITY_UPDATED, None)
+
+event.listen(Session, "before_flush", Agent.collect_capability_changes)
+event.listen(Session, "after_flush", Agent.invalidate_capabilities)
+event.listen(Session, "after_flush_postexec",
+             Agent.expire_capability_revisions)
+event.listen(Session, "after_rollback", Agent.discard_capability_changes)
@@ -22,7 +22,7 @@ Models and interface classes related to jobs.
 
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 try:
     import pwd
@@ -31,8 +31,9 @@ except ImportError:  # pragma: no cover
 
 from sys import maxsize
 
-from sqlalchemy import event, distinct, or_, and_
-from sqlalchemy.orm import validates
+from sqlalchemy import event, func, inspect, exists, case, or_, and_
+from sqlalchemy.orm import validates, object_session, aliased, Session
+from sqlalchemy.orm.attributes import NO_VALUE, NEVER_SET
 
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import WorkState, DBWorkState, _WorkState, AgentState
@@ -45,8 +46,11 @@ from pyfarm.models.core.mixins import (
     ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin,
     ValidateWorkStateMixin, UtilityMixins)
 from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.models.tag import Tag, JobTagRequirement
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.task import Task
+from pyfarm.models.user import User
+from pyfarm.models.runtimestatistics import TaskRuntimeStatistics
 
 try:
   # pylint: disable=undefined-variable
@@ -56,8 +60,25 @@ except NameError:
 
 __all__ = ("Job", )
 
+BATCH_SCAN_LIMIT = config.get("job_batch_scan_limit")
+BATCH_TARGET_DURATION = config.get("job_batch_target_duration")
+
 logger = getLogger("models.job")
 
+# Keys used for tracking changes to task counts in Session.info
+TASK_COUNT_CHANGES = "pf_task_count_changes"
+TASK_COUNT_UPDATED = "pf_task_count_updated"
+
+# Keys used for tracking changes to job dependencies in Session.info
+DEPENDENCY_CHANGES = "pf_dependency_changes"
+DEPENDENCY_UPDATED = "pf_dependency_updated"
+READY_JOBS = "pf_ready_jobs"
+
+# Keys used for tracking changes to what is sent to agents along with the
+# tasks of a job in Session.info
+PAYLOAD_CHANGES = "pf_payload_changes"
+PAYLOAD_UPDATED = "pf_payload_updated"
+
 
 JobTagAssociation = db.Table(
     config.get("table_job_tag_assoc"),
@@ -144,8 +165,25 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
     __tablename__ = config.get("table_job")
     REPR_COLUMNS = ("id", "state", "project")
     REPR_CONVERT_COLUMN = {"state": repr}
+    DICT_CONVERT_COLUMN = {
+        "assigned_agents": NotImplemented,
+        "num_tasks_queued": NotImplemented,
+        "num_tasks_running": NotImplemented,
+        "num_tasks_done": NotImplemented,
+        "num_tasks_failed": NotImplemented,
+        "unfinished_parents": NotImplemented,
+        "payload_revision": NotImplemented}
+    TASK_COUNT_COLUMNS = ("num_tasks_queued", "num_tasks_running",
+                          "num_tasks_done", "num_tasks_failed")
     STATE_ENUM = list(WorkState) + [None]
 
+    # The attributes sent to agents along with the tasks of a job, changing
+    # any of them increments `payload_revision`
+    PAYLOAD_ATTRIBUTES = (
+        "title", "data", "environ", "by", "batch", "ram", "ram_warning",
+        "ram_max", "cpus", "priority", "notes", "num_tiles", "user_id",
+        "user", "jobtype_version_id", "jobtype_version", "tags")
+
     # shared work columns
     id, state, priority, time_submitted, time_started, time_finished = \
         work_columns(None, "job.priority")
@@ -336,6 +374,54 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         doc="If not None, this job will be automatically deleted this "
             "number of seconds after it finishes.")
 
+    assigned_agents = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The number of agents that currently have queued or running "
+            "tasks from this job assigned.  This column is a database "
+            "denormalization, it is kept up to date automatically on flush "
+            "and periodically repaired by the scheduler.")
+
+    num_tasks_queued = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The number of queued tasks in this job.  Like the other "
+            "``num_tasks_*`` columns this is a database denormalization, "
+            "kept up to date on every task state change and periodically "
+            "repaired by the scheduler.")
+
+    num_tasks_running = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The number of running tasks in this job.  Tasks in any other "
+            "unfinished state, like paused, are counted here too.")
+
+    num_tasks_done = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The number of tasks in this job which are done.")
+
+    num_tasks_failed = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The number of tasks in this job which have failed.")
+
+    unfinished_parents = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The number of parent jobs of this job which are not done yet.  "
+            "The scheduler only considers jobs for which this is 0.  This "
+            "column is a database denormalization, it is kept up to date "
+            "automatically on flush and periodically repaired by the "
+            "scheduler.")
+
+    payload_revision = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="Incremented on flush whenever anything that is sent to agents "
+            "along with the tasks of this job changes.  The scheduler "
+            "caches the payload of a job until its revision changes.")
+
     #
     # Relationships
     #
@@ -411,18 +497,18 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         # Import here instead of at the top of the file to avoid a circular
         # import
         from pyfarm.scheduler.tasks import send_job_completion_mail
-        from pyfarm.models.agent import Agent
 
-        num_active_tasks = db.session.query(Task).\
-            filter(Task.job == self,
-                   or_(Task.state == None, and_(
-                            Task.state != WorkState.DONE,
-                            Task.state != WorkState.FAILED))).count()
+        # Make sure the counters include all pending changes and not just what
+        # we have seen earlier in this transaction
+        db.session.flush()
+        if inspect(self).persistent:
+            db.session.refresh(
+                self, attribute_names=("assigned_agents", ) +
+                                      self.TASK_COUNT_COLUMNS)
+
+        num_active_tasks = self.num_tasks_queued + self.num_tasks_running
         if num_active_tasks == 0:
-            num_failed_tasks = db.session.query(Task).filter(
-                Task.job == self,
-                Task.state == WorkState.FAILED).count()
-            if num_failed_tasks == 0:
+            if self.num_tasks_failed == 0:
                 if self.state != _WorkState.DONE:
                     logger.info("Job %r (id %s): state transition %r -> 'done'",
                                 self.title, self.id, self.state)
@@ -439,15 +525,7 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
                                                          countdown=5)
             db.session.add(self)
         elif self.state != _WorkState.PAUSED:
-            num_running_tasks = db.session.query(Task).\
-                filter(Task.job == self,
-                       Task.agent_id != None,
-                       Task.agent.has(and_(Agent.state != AgentState.OFFLINE,
-                                           Agent.state != AgentState.DISABLED)),
-                       or_(
-                            Task.state == WorkState.RUNNING,
-                            Task.state == None)).count()
-            if num_running_tasks == 0:
+            if self.assigned_agents == 0:
                 logger.debug("No running tasks in job %s (id %s), setting it "
                              "to queued", self.title, self.id)
                 self.state = None
@@ -456,38 +534,45 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
                 self.state = WorkState.RUNNING
 
     # Methods used by the scheduler
-    def num_assigned_agents(self):
-        # Import here instead of at the top of the file to avoid circular import
-        from pyfarm.models.agent import Agent
+    def get_tag_requirement_bits(self):
+        """
+        Returns a tuple of the bitsets of the tags required and the tags
+        forbidden by this job, see :meth:`Tag.bitset`
+        """
+        try:
+            return self.tag_requirement_bits
+        except AttributeError:
+            Job.load_tag_requirement_bits([self])
+            return self.tag_requirement_bits
+
+    @staticmethod
+    def load_tag_requirement_bits(jobs):
+        """
+        Loads the tag requirements of all the given jobs in a single query
+        and stores them as bitsets on the jobs
+        """
+        jobs = dict((job.id, job) for job in jobs)
+        tag_ids = dict((job_id, ([], [])) for job_id in jobs)
+        if jobs:
+            requirements_query = db.session.query(
+                JobTagRequirement.job_id, JobTagRequirement.tag_id,
+                JobTagRequirement.negate).filter(
+                    JobTagRequirement.job_id.in_(list(jobs)))
+            for job_id, tag_id, negate in requirements_query:
+                tag_ids[job_id][1 if negate else 0].append(tag_id)
+
+        for job_id, job in jobs.items():
+            required, forbidden = tag_ids[job_id]
+            job.tag_requirement_bits = (Tag.bitset(required),
+                                        Tag.bitset(forbidden))
 
+    def num_assigned_agents(self):
         # Optimization: Blindly assume that we have no agents assigned if not
         # running
         if self.state != _WorkState.RUNNING:
             return 0
 
-        try:
-            return self.assigned_agents_count
-        except AttributeError:
-            self.assigned_agents_count =\
-                db.session.query(distinct(Task.agent_id)).\
-                    filter(Task.job == self,
-                           Task.agent_id != None,
-                           or_(Task.state == None,
-                               Task.state == WorkState.RUNNING),
-                           Task.agent.has(
-                               and_(Agent.state != AgentState.OFFLINE,
-                                    Agent.state != AgentState.DISABLED)))\
-                                        .count()
-
-            return self.assigned_agents_count
-
-    def clear_assigned_counts(self):
-        try:
-            del self.assigned_agents_count
-        except AttributeError:
-            pass
-        if self.queue:
-            self.queue.clear_assigned_counts()
+        return self.assigned_agents or 0
 
     def can_use_more_agents(self):
         # Import here instead of at the top of the file to avoid circular import
@@ -503,30 +588,143 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
 
         return unassigned_tasks > 0
 
+    def get_batch_size(self):
+        """
+        Returns the number of tasks the next batch of this job should have.
+        If ``job_batch_target_duration`` is set and there are
+        :class:`.TaskRuntimeStatistics` for this job or its jobtype version,
+        the size is chosen so that the batch takes about that long,
+        otherwise :attr:`batch` is used.  The size never exceeds the
+        ``max_batch`` of the jobtype version.
+        """
+        batch_size = self.batch or 1
+        if BATCH_TARGET_DURATION:
+            statistics = TaskRuntimeStatistics.for_job(self)
+            if statistics is not None:
+                batch_size = max(
+                    int(BATCH_TARGET_DURATION / max(statistics.mean, 1.0)), 1)
+
+        return min(batch_size, self.jobtype_version.max_batch or maxsize)
+
+    def predict_remaining_time(self):
+        """
+        Returns the number of seconds the remaining tasks of this job are
+        expected to take with the agents it currently has, based on the
+        :class:`.TaskRuntimeStatistics` of this job or its jobtype version.
+        Returns None if there are no statistics yet.
+        """
+        statistics = TaskRuntimeStatistics.for_job(self)
+        if statistics is None:
+            return None
+
+        remaining_tasks = ((self.num_tasks_queued or 0) +
+                           (self.num_tasks_running or 0))
+        return (statistics.mean * remaining_tasks /
+                max(self.num_assigned_agents(), 1))
+
+    def predict_time_finished(self):
+        """
+        Returns the time this job is expected to finish at, see
+        :meth:`predict_remaining_time`, or None if that cannot be predicted
+        """
+        if self.state in (_WorkState.DONE, _WorkState.FAILED):
+            return self.time_finished
+
+        remaining_time = self.predict_remaining_time()
+        if remaining_time is None:
+            return None
+        return datetime.utcnow() + timedelta(seconds=remaining_time)
+
     def get_batch(self, agent):
+        batch_size = self.get_batch_size()
+        tasks_query = self.batchable_tasks_query(agent)
+
+        if not self.jobtype_version.batch_contiguous or batch_size == 1:
+            return tasks_query.order_by(Task.frame, Task.tile).\
+                limit(batch_size).all()
+        elif db.engine.name == "postgresql":
+            return self.get_contiguous_batch_windowed(tasks_query, batch_size)
+        else:
+            return self.get_contiguous_batch_scan(tasks_query, batch_size)
+
+    def batchable_tasks_query(self, agent):
+        """
+        Returns a query for all tasks in this job which could be assigned to
+        `agent`: Tasks which are neither finished nor assigned to an agent
+        that is online, and which have not failed on `agent` before.
+        """
         # Import here instead of at the top of the file to avoid circular import
-        from pyfarm.models.agent import Agent
+        from pyfarm.models.agent import Agent, FailedTaskInAgent
 
-        tasks_query = Task.query.filter(
-            Task.job == self,
-            ~Task.failed_in_agents.any(id=agent.id),
+        return Task.query.filter(
+            Task.job_id == self.id,
+            ~exists().where(and_(FailedTaskInAgent.c.task_id == Task.id,
+                                 FailedTaskInAgent.c.agent_id == agent.id)),
             or_(Task.state == None,
                 ~Task.state.in_([WorkState.DONE, WorkState.FAILED])),
-            or_(Task.agent == None,
+            or_(Task.agent_id == None,
                 Task.agent.has(Agent.state.in_(
-                    [AgentState.OFFLINE, AgentState.DISABLED])))).\
-                        order_by("frame asc, tile asc")
+                    [AgentState.OFFLINE, AgentState.DISABLED]))))
 
-        batch = []
+    def get_contiguous_batch_windowed(self, tasks_query, batch_size):
+        """
+        Finds the first window of `batch_size` contiguous frames in
+        `tasks_query` using window functions, so only the tasks of the batch
+        itself are read from the database.  If there is no window that large,
+        the window starting at the first frame is used instead.
+        """
+        # Within a run of contiguous frames, the frame minus `by` times its
+        # row number is constant and identifies the run
+        numbered = tasks_query.with_entities(
+            Task.id.label("id"), Task.frame.label("frame"),
+            Task.tile.label("tile"),
+            (Task.frame - self.by * func.row_number().over(
+                order_by=(Task.frame, Task.tile))).label("window")).\
+                    subquery()
+        windows = db.session.query(
+            numbered.c.id, numbered.c.frame, numbered.c.tile,
+            numbered.c.window,
+            func.count(numbered.c.id).over(
+                partition_by=numbered.c.window).label("window_size"),
+            func.min(numbered.c.frame).over(
+                partition_by=numbered.c.window).label("window_start")).\
+                    subquery()
+        rows = db.session.query(windows.c.id, windows.c.window).order_by(
+            case([(windows.c.window_size >= batch_size, 0)], else_=1),
+            windows.c.window_start, windows.c.frame, windows.c.tile).\
+                limit(batch_size).all()
+
+        if not rows:
+            return []
+
+        task_ids = [task_id for task_id, window in rows
+                    if window == rows[0][1]]
+        return Task.query.filter(Task.id.in_(task_ids)).order_by(
+            Task.frame, Task.tile).all()
+
+    def get_contiguous_batch_scan(self, tasks_query, batch_size):
+        """
+        Finds the first window of `batch_size` contiguous frames in
+        `tasks_query` by scanning at most ``job_batch_scan_limit`` tasks in
+        frame order.  If there is no window that large, the window starting
+        at the first frame is used instead.
+        """
+        first_window = None
+        window = []
+        tasks_query = tasks_query.order_by(Task.frame, Task.tile).\
+            limit(BATCH_SCAN_LIMIT)
         for task in tasks_query:
-            if (len(batch) < self.batch and
-                len(batch) < (self.jobtype_version.max_batch or maxsize) and
-                (not self.jobtype_version.batch_contiguous or
-                 (len(batch) == 0 or
-                  batch[-1].frame + self.by == task.frame))):
-                batch.append(task)
+            if window and window[-1].frame + self.by == task.frame:
+                window.append(task)
+            else:
+                window = [task]
+                if first_window is None:
+                    first_window = window
+
+            if len(window) == batch_size:
+                return window
 
-        return batch
+        return first_window or []
 
     def alter_frame_range(self, start, end, by):
         # We have to import this down here instead of at the top to break a
@@ -645,8 +843,12 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         """
         Validation that ensures that the value provided for either
         :attr:`.ram` or :attr:`.cpus` is a valid value with a given range
+        or -1, which reserves the entire agent
         """
         assert isinstance(value, int), "%s must be an integer" % key
+        if value == -1:
+            return value
+
         min_value = config.get("agent_min_%s" % key)
         max_value = config.get("agent_max_%s" % key)
 
@@ -663,4 +865,376 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         if value < 0.0 or value > 1.0:
             raise ValueError("Progress must be between 0.0 and 1.0")
 
+    @staticmethod
+    def task_count_column(state):
+        """Returns the name of the counter column for a task state"""
+        if state is None:
+            return "num_tasks_queued"
+        elif state == _WorkState.DONE:
+            return "num_tasks_done"
+        elif state == _WorkState.FAILED:
+            return "num_tasks_failed"
+        else:
+            # Paused tasks are still active, so they are counted as running
+            return "num_tasks_running"
+
+    @staticmethod
+    def count_task_state_change(target, new_value, old_value, initiator):
+        """
+        Records the change in task counts caused by a state change of an
+        existing task.  New and deleted tasks are handled on flush.
+        """
+        session = object_session(target)
+        if session is None or not inspect(target).persistent:
+            return
+
+        changes = session.info.setdefault(
+            TASK_COUNT_CHANGES,
+            {"deltas": {}, "new_tasks": set(), "recount_job_ids": set()})
+
+        if old_value is NO_VALUE or old_value is NEVER_SET:
+            changes["recount_job_ids"].add(target.job_id)
+            return
+
+        old_column = Job.task_count_column(old_value)
+        new_column = Job.task_count_column(new_value)
+        if old_column == new_column:
+            return
+
+        deltas = changes["deltas"].setdefault(target.job_id, {})
+        if old_column:
+            deltas[old_column] = deltas.get(old_column, 0) - 1
+        if new_column:
+            deltas[new_column] = deltas.get(new_column, 0) + 1
+
+    @staticmethod
+    def collect_task_count_changes(session, flush_context, instances):
+        """
+        Remembers all new and deleted tasks as well as tasks moved between
+        jobs for :meth:`update_task_counts`
+        """
+        changes = session.info.setdefault(
+            TASK_COUNT_CHANGES,
+            {"deltas": {}, "new_tasks": set(), "recount_job_ids": set()})
+
+        for obj in session.new:
+            if isinstance(obj, Task):
+                changes["new_tasks"].add(obj)
+
+        for obj in session.dirty:
+            if isinstance(obj, Task):
+                attrs = inspect(obj).attrs
+                if (attrs.job_id.history.has_changes() or
+                        attrs.job.history.has_changes()):
+                    changes["recount_job_ids"].update(
+                        x for x in attrs.job_id.history.deleted
+                        if x is not None)
+                    changes["recount_job_ids"].add(obj.job_id)
+                    changes["new_tasks"].add(obj)
+
+        for obj in session.deleted:
+            if isinstance(obj, Task):
+                column = Job.task_count_column(obj.state)
+                if column:
+                    deltas = changes["deltas"].setdefault(obj.job_id, {})
+                    deltas[column] = deltas.get(column, 0) - 1
+
+    @staticmethod
+    def update_task_counts(session, flush_context):
+        """
+        Applies the collected changes to the task counters of all affected
+        jobs
+        """
+        changes = session.info.pop(TASK_COUNT_CHANGES, None)
+        if not changes:
+            return
+
+        recount_job_ids = changes["recount_job_ids"]
+        # Tasks moved between jobs will be covered by the recount
+        recount_job_ids.update(x.job_id for x in changes["new_tasks"] if
+                               inspect(x).attrs.job_id.history.deleted)
+        recount_job_ids.discard(None)
+
+        deltas = changes["deltas"]
+        for task in changes["new_tasks"]:
+            if task.job_id in recount_job_ids:
+                continue
+            column = Job.task_count_column(task.state)
+            if column:
+                job_deltas = deltas.setdefault(task.job_id, {})
+                job_deltas[column] = job_deltas.get(column, 0) + 1
+
+        table = Job.__table__
+        updated_job_ids = set(recount_job_ids)
+        for job_id, job_deltas in deltas.items():
+            if job_id is None or job_id in recount_job_ids:
+                continue
+            values = dict((column, table.c[column] + delta) for
+                          column, delta in job_deltas.items() if delta)
+            if values:
+                session.execute(table.update().where(
+                    table.c.id == job_id).values(**values))
+                updated_job_ids.add(job_id)
+
+        if recount_job_ids:
+            counts = dict((job_id, dict((x, 0) for x in
+                                        Job.TASK_COUNT_COLUMNS))
+                          for job_id in recount_job_ids)
+            counts_query = session.query(
+                Task.job_id, Task.state, func.count(Task.id)).filter(
+                    Task.job_id.in_(recount_job_ids)).group_by(
+                        Task.job_id, Task.state)
+            for job_id, state, count in counts_query:
+                column = Job.task_count_column(state)
+                if column:
+                    counts[job_id][column] = count
+
+            for job_id, values in counts.items():
+                session.execute(table.update().where(
+                    table.c.id == job_id).values(**values))
+
+        if updated_job_ids:
+            session.info[TASK_COUNT_UPDATED] = updated_job_ids
+
+    @staticmethod
+    def expire_task_counts(session, flush_context):
+        updated_job_ids = session.info.pop(TASK_COUNT_UPDATED, None)
+        if not updated_job_ids:
+            return
+
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, Job) and obj.id in updated_job_ids:
+                session.expire(obj, Job.TASK_COUNT_COLUMNS)
+
+    @staticmethod
+    def discard_task_count_changes(session):
+        session.info.pop(TASK_COUNT_CHANGES, None)
+        session.info.pop(TASK_COUNT_UPDATED, None)
+
+    @staticmethod
+    def collect_dependency_changes(session, flush_context, instances):
+        """
+        Remembers all jobs whose parents were changed and all jobs which
+        became done or stopped being done, so :meth:`update_unfinished_parents`
+        can update the ``unfinished_parents`` counters after the flush
+        """
+        changes = session.info.setdefault(
+            DEPENDENCY_CHANGES, {"jobs": set(), "parent_ids": set()})
+
+        for obj in session.new:
+            if isinstance(obj, Job) and obj.parents:
+                changes["jobs"].add(obj)
+
+        for obj in session.dirty:
+            if isinstance(obj, Job):
+                attrs = inspect(obj).attrs
+                if attrs.parents.history.has_changes():
+                    changes["jobs"].add(obj)
+
+                # The history of collections which were not loaded is empty
+                children_history = attrs.children.history
+                changes["jobs"].update(children_history.added or ())
+                changes["jobs"].update(children_history.deleted or ())
+
+                # If the previous state was not loaded we can not tell
+                # whether the job was done before, so recount its children
+                state_history = attrs.state.history
+                if (state_history.added and
+                        (not state_history.deleted or
+                         (state_history.deleted[0] == _WorkState.DONE) !=
+                         (obj.state == _WorkState.DONE))):
+                    changes["parent_ids"].add(obj.id)
+
+        for obj in session.deleted:
+            if isinstance(obj, Job):
+                changes["jobs"].update(obj.children)
+
+    @staticmethod
+    def update_unfinished_parents(session, flush_context):
+        """
+        Recounts the unfinished parents of all jobs affected by the flush and
+        adds the jobs that are no longer blocked by any parent to the ready
+        set of the session
+        """
+        changes = session.info.pop(DEPENDENCY_CHANGES, None)
+        if not changes:
+            return
+
+        job_ids = set(x.id for x in changes["jobs"])
+        if changes["parent_ids"]:
+            job_ids.update(x[0] for x in session.query(
+                JobDependency.c.childid).filter(
+                    JobDependency.c.parentid.in_(changes["parent_ids"])))
+        job_ids.discard(None)
+        if not job_ids:
+            return
+
+        parent = aliased(Job)
+        counts = dict(session.query(
+            JobDependency.c.childid, func.count(parent.id)).\
+                join(parent, parent.id == JobDependency.c.parentid).filter(
+                    JobDependency.c.childid.in_(job_ids),
+                    or_(parent.state == None,
+                        parent.state != WorkState.DONE)).\
+                            group_by(JobDependency.c.childid))
+
+        table = Job.__table__
+        updated_job_ids = set()
+        jobs_query = session.query(
+            Job.id, Job.unfinished_parents, Job.job_queue_id).filter(
+                Job.id.in_(job_ids))
+        for job_id, stored_count, job_queue_id in jobs_query:
+            count = counts.get(job_id, 0)
+            if count != stored_count:
+                session.execute(table.update().where(
+                    table.c.id == job_id).values(unfinished_parents=count))
+                updated_job_ids.add(job_id)
+                if count == 0:
+                    session.info.setdefault(
+                        READY_JOBS, {})[job_id] = job_queue_id
+
+        if updated_job_ids:
+            session.info[DEPENDENCY_UPDATED] = updated_job_ids
+
+    @staticmethod
+    def expire_unfinished_parents(session, flush_context):
+        updated_job_ids = session.info.pop(DEPENDENCY_UPDATED, None)
+        if not updated_job_ids:
+            return
+
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, Job) and obj.id in updated_job_ids:
+                session.expire(obj, ["unfinished_parents"])
+
+    @staticmethod
+    def schedule_ready_jobs(session):
+        """
+        Triggers the scheduler once jobs became ready to run because their
+        last unfinished parent is done
+        """
+        ready_jobs = session.info.pop(READY_JOBS, None)
+        if not ready_jobs:
+            return
+
+        # Import here instead of at the top of the file to avoid a circular
+        # import
+        from pyfarm.scheduler.triggers import request_scheduling
+
+        logger.debug("Jobs %s no longer have unfinished parents",
+                     ", ".join(str(x) for x in sorted(ready_jobs)))
+        request_scheduling(queue_ids=set(ready_jobs.values()))
+
+    @staticmethod
+    def discard_dependency_changes(session):
+        session.info.pop(DEPENDENCY_CHANGES, None)
+        session.info.pop(DEPENDENCY_UPDATED, None)
+        session.info.pop(READY_JOBS, None)
+
+    @staticmethod
+    def collect_payload_changes(session, flush_context, instances):
+        """
+        Remembers the ids of all jobs whose :attr:`PAYLOAD_ATTRIBUTES` or
+        notified users were changed, or whose user, tags or jobtype were
+        renamed, so :meth:`update_payload_revisions` can increment their
+        revisions after the flush
+        """
+        job_ids = session.info.setdefault(PAYLOAD_CHANGES, set())
+
+        user_ids = set()
+        tag_ids = set()
+        jobtype_ids = set()
+        for obj in session.dirty:
+            attrs = inspect(obj).attrs
+            if isinstance(obj, Job):
+                if any(getattr(attrs, x).history.has_changes()
+                       for x in Job.PAYLOAD_ATTRIBUTES):
+                    job_ids.add(obj.id)
+            elif isinstance(obj, User):
+                if attrs.username.history.has_changes():
+                    user_ids.add(obj.id)
+            elif isinstance(obj, Tag):
+                if attrs.tag.history.has_changes():
+                    tag_ids.add(obj.id)
+            elif isinstance(obj, JobType):
+                if attrs.name.history.has_changes():
+                    jobtype_ids.add(obj.id)
+
+        # Jobs linked to or unlinked from the tag's side
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, Tag):
+                history = inspect(obj).attrs.jobs.history
+                job_ids.update(x.id for x in history.added or ())
+                job_ids.update(x.id for x in history.deleted or ())
+
+        # The links of deleted tags are gone after the flush
+        tag_ids.update(x.id for x in session.deleted if isinstance(x, Tag))
+
+        if user_ids:
+            job_ids.update(x for x, in session.query(Job.id).filter(
+                Job.user_id.in_(user_ids)))
+            job_ids.update(x for x, in session.query(
+                JobNotifiedUser.job_id).filter(
+                    JobNotifiedUser.user_id.in_(user_ids)))
+        if tag_ids:
+            job_ids.update(x for x, in session.query(
+                JobTagAssociation.c.job_id).filter(
+                    JobTagAssociation.c.tag_id.in_(tag_ids)))
+        if jobtype_ids:
+            job_ids.update(x for x, in session.query(Job.id).join(
+                JobTypeVersion,
+                JobTypeVersion.id == Job.jobtype_version_id).filter(
+                    JobTypeVersion.jobtype_id.in_(jobtype_ids)))
+
+        for obj in list(session.new) + list(session.dirty) + \
+                list(session.deleted):
+            if isinstance(obj, JobNotifiedUser):
+                if obj.job_id is not None:
+                    job_ids.add(obj.job_id)
+                elif obj.job is not None:
+                    job_ids.add(obj.job.id)
+
+    @staticmethod
+    def update_payload_revisions(session, flush_context):
+        job_ids = session.info.pop(PAYLOAD_CHANGES, None)
+        if job_ids:
+            job_ids.discard(None)
+        if not job_ids:
+            return
+
+        table = Job.__table__
+        session.execute(table.update().where(
+            table.c.id.in_(job_ids)).values(
+                payload_revision=table.c.payload_revision + 1))
+        session.info[PAYLOAD_UPDATED] = job_ids
+
+    @staticmethod
+    def expire_payload_revisions(session, flush_context):
+        updated_job_ids = session.info.pop(PAYLOAD_UPDATED, None)
+        if not updated_job_ids:
+            return
+
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, Job) and obj.id in updated_job_ids:
+                session.expire(obj, ["payload_revision"])
+
+    @staticmethod
+    def discard_payload_changes(session):
+        session.info.pop(PAYLOAD_CHANGES, None)
+        session.info.pop(PAYLOAD_UPDATED, None)
+
 event.listen(Job.state, "set", Job.state_changed)
+event.listen(Task.state, "set", Job.count_task_state_change,
+             active_history=True)
+event.listen(Session, "before_flush", Job.collect_task_count_changes)
+event.listen(Session, "after_flush", Job.update_task_counts)
+event.listen(Session, "after_flush_postexec", Job.expire_task_counts)
+event.listen(Session, "after_rollback", Job.discard_task_count_changes)
+event.listen(Session, "before_flush", Job.collect_dependency_changes)
+event.listen(Session, "after_flush", Job.update_unfinished_parents)
+event.listen(Session, "after_flush_postexec", Job.expire_unfinished_parents)
+event.listen(Session, "after_commit", Job.schedule_ready_jobs)
+event.listen(Session, "after_rollback", Job.discard_dependency_changes)
+event.listen(Session, "before_flush", Job.collect_payload_changes)
+event.listen(Session, "after_flush", Job.update_payload_revisions)
+event.listen(Session, "after_flush_postexec", Job.expire_payload_revisions)
+event.listen(Session, "after_rollback", Job.discard_payload_changes)
@@ -23,10 +23,10 @@ Model for job queues
 """
 
 from sys import maxsize
-from functools import reduce
 from logging import DEBUG
 
-from sqlalchemy import event, distinct, or_, and_
+from sqlalchemy import event, distinct, func, inspect, desc, or_, and_
+from sqlalchemy.orm import Session
 from sqlalchemy.schema import UniqueConstraint
 
 from pyfarm.core.logger import getLogger
@@ -36,11 +36,22 @@ from pyfarm.master.config import config
 from pyfarm.models.core.mixins import UtilityMixins, ReprMixin
 from pyfarm.models.core.types import id_column, IDTypeWork
 from pyfarm.models.agent import Agent
+from pyfarm.models.runtimestatistics import TaskRuntimeStatistics
+from pyfarm.scheduler.stride import (
+    StrideHeap, affinity_order, UNKNOWN_REMAINING_WORK)
+from pyfarm.scheduler.tracing import (
+    NULL_TRACE, REJECT_SOFTWARE, REJECT_RAM, REJECT_MAX_AGENTS,
+    REJECT_NO_TASKS, REJECT_UNWANTED)
 
 PREFER_RUNNING_JOBS = config.get("queue_prefer_running_jobs")
 USE_TOTAL_RAM = config.get("use_total_ram_for_scheduling")
+SHORTEST_REMAINING_FIRST = config.get("scheduler_shortest_remaining_first")
 logger = getLogger("pf.models.jobqueue")
 
+# Keys used for tracking changes to assigned agents in Session.info
+ASSIGNED_AGENTS_CHANGES = "pf_assigned_agents_changes"
+ASSIGNED_AGENTS_UPDATED = "pf_assigned_agents_updated"
+
 if config.get("debug_queue"):
     logger.setLevel(DEBUG)
 
@@ -54,6 +65,7 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
     __table_args__ = (UniqueConstraint("parent_jobqueue_id", "name"),)
 
     REPR_COLUMNS = ("id", "name")
+    DICT_CONVERT_COLUMN = {"assigned_agents": NotImplemented}
 
     id = id_column(IDTypeWork)
 
@@ -110,6 +122,14 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
             "path must be computed by recursively querying "
             "the parent queues.")
 
+    assigned_agents = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The number of agents working on jobs in or below this queue.  "
+            "This column is a database denormalization, it is kept up to "
+            "date automatically on flush and periodically repaired by the "
+            "scheduler.")
+
     #
     # Relationship
     #
@@ -138,9 +158,8 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
         Return child queues sorted by number of currently assigned agents with
         priority as a secondary sort key.
         """
-        queues = [x for x in self.children]
-        return sorted(queues, key=lambda x: x.num_assigned_agents(),
-                      reverse=True)
+        return self.children.order_by(desc(JobQueue.assigned_agents),
+                                      desc(JobQueue.priority)).all()
 
     def child_jobs(self, filters):
         # Import down here instead of at the top to avoid circular import
@@ -172,61 +191,58 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
                       reverse=True)
 
     def num_assigned_agents(self):
-        try:
-            return self.assigned_agents_count
-        except AttributeError:
-            # Import down here instead of at the top to avoid circular import
-            from pyfarm.models.task import Task
-            from pyfarm.models.job import Job
-
-            self.assigned_agents_count = 0
-            for queue in self.children:
-                self.assigned_agents_count += queue.num_assigned_agents()
-            self.assigned_agents_count +=\
-                db.session.query(distinct(Task.agent_id)).\
-                    filter(Task.job.has(Job.queue == self),
-                           Task.agent_id != None,
-                           Task.agent.has(
-                               and_(Agent.state != AgentState.OFFLINE,
-                                    Agent.state != AgentState.DISABLED)),
-                           or_(Task.state == None,
-                               Task.state == WorkState.RUNNING)).count()
-
-            return self.assigned_agents_count
-
-    def clear_assigned_counts(self):
-        try:
-            del self.assigned_agents_count
-        except AttributeError:
-            pass
-        if self.parent:
-            self.parent.clear_assigned_counts()
-
-    def get_job_for_agent(self, agent, unwanted_job_ids=None):
+        return self.assigned_agents or 0
+
+    def get_job_for_agent(self, agent, unwanted_job_ids=None,
+                          trace=NULL_TRACE):
         # Import down here instead of at the top to avoid circular import
         from pyfarm.models.job import Job
 
+        unwanted_job_ids = unwanted_job_ids or ()
         supported_types = agent.get_supported_types()
         if not supported_types:
             return None
 
         available_ram = agent.ram if USE_TOTAL_RAM else agent.free_ram
-        child_jobs = Job.query.filter(or_(Job.state == WorkState.RUNNING,
-                                          Job.state == None),
-                                      Job.job_queue_id == self.id,
-                                      ~Job.parents.any(or_(
-                                          Job.state == None,
-                                          Job.state != WorkState.DONE)),
-                                      Job.jobtype_version_id.in_(
-                                            supported_types),
-                                      Job.ram <= available_ram).all()
-        child_jobs = [x for x in child_jobs if
-                      (agent.satisfies_job_requirements(x) and
-                       x.id not in unwanted_job_ids)]
-        if unwanted_job_ids:
-            child_jobs = [x for x in child_jobs if x.id not in unwanted_job_ids]
-        child_queues = JobQueue.query.filter(
-            JobQueue.parent_jobqueue_id == self.id).all()
+        with trace.phase("candidate_query"):
+            candidate_filters = [or_(Job.state == WorkState.RUNNING,
+                                     Job.state == None),
+                                 Job.job_queue_id == self.id,
+                                 Job.unfinished_parents == 0]
+            child_jobs = Job.query.filter(
+                Job.jobtype_version_id.in_(supported_types),
+                Job.ram <= available_ram, *candidate_filters).all()
+            child_queues = JobQueue.query.filter(
+                JobQueue.parent_jobqueue_id == self.id).all()
+
+            # The database already filtered out the jobs the agent does not
+            # have the software or the ram for, only look them up if someone
+            # is going to read about it
+            if trace.enabled:
+                filtered_query = db.session.query(
+                    Job.id, Job.jobtype_version_id).filter(
+                        ~and_(Job.jobtype_version_id.in_(supported_types),
+                              Job.ram <= available_ram),
+                        *candidate_filters)
+                for job_id, jobtype_version_id in filtered_query:
+                    if jobtype_version_id not in supported_types:
+                        trace.reject_job(job_id, REJECT_SOFTWARE)
+                    else:
+                        trace.reject_job(job_id, REJECT_RAM)
+
+        with trace.phase("requirement_checks"):
+            Job.load_tag_requirement_bits(child_jobs)
+            suitable_jobs = []
+            for job in child_jobs:
+                if job.id in unwanted_job_ids:
+                    trace.reject_job(job.id, REJECT_UNWANTED)
+                    continue
+                reason = agent.unsatisfied_job_requirement(job)
+                if reason is not None:
+                    trace.reject_job(job.id, reason)
+                    continue
+                suitable_jobs.append(job)
+            child_jobs = suitable_jobs
 
         # Before anything else, enforce minimums
         for job in child_jobs:
@@ -243,7 +259,7 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
             if (queue.num_assigned_agents() < (queue.minimum_agents or 0) and
                 queue.num_assigned_agents() <
                     (queue.maximum_agents or maxsize)):
-                job = queue.get_job_for_agent(agent, unwanted_job_ids)
+                job = queue.get_job_for_agent(agent, unwanted_job_ids, trace)
                 if job:
                     return job
 
@@ -262,20 +278,39 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
                 objects_by_priority[job.priority] = [job]
 
         available_priorities = sorted(objects_by_priority.keys(), reverse=True)
+        affinity = agent.get_affinity()
+
+        # The expected runtime of the tasks each job has left, used to break
+        # ties in favour of the job closest to being finished
+        remaining_work = {}
+        unknown_remaining_work = 0
+        if SHORTEST_REMAINING_FIRST:
+            unknown_remaining_work = UNKNOWN_REMAINING_WORK
+            jobs_by_id = dict((x.id, x) for x in child_jobs)
+            for job_id, mean in TaskRuntimeStatistics.load_means(
+                    child_jobs).items():
+                job = jobs_by_id[job_id]
+                remaining_work[job_id] = mean * (
+                    (job.num_tasks_queued or 0) + (job.num_tasks_running or 0))
 
         # Work through the priorities in descending order
         for priority in available_priorities:
-            objects = objects_by_priority[priority]
-            active_objects = [x for x in objects if
-                              (type(x) != Job or x.state == _WorkState.RUNNING)]
-            weight_sum = reduce(lambda a, b: a + b.weight, active_objects, 0)
-            total_assigned = reduce(lambda a, b: a + b.num_assigned_agents(),
-                                    objects, 0)
-            objects.sort(key=(lambda x:
-                                ((float(x.num_assigned_agents()) / total_assigned)
-                                    if total_assigned else 0) /
-                                ((float(x.weight) / weight_sum)
-                                    if weight_sum and x.weight else 1)))
+            level = StrideHeap()
+            for item in objects_by_priority[priority]:
+                if isinstance(item, Job):
+                    level.push((1, item.id), item, item.num_assigned_agents(),
+                               item.weight, item.state == _WorkState.RUNNING,
+                               remaining_work.get(
+                                   item.id, unknown_remaining_work))
+                else:
+                    level.push((0, item.id), item, item.num_assigned_agents(),
+                               item.weight, True)
+            objects = affinity_order(
+                level.ordered(),
+                lambda share, x: affinity.sort_key(
+                    share, affinity.score_job(x) if isinstance(x, Job)
+                    else affinity.score_queue(x.id)),
+                affinity.max_advantage())
 
             selected_job = None
             for item in objects:
@@ -290,6 +325,8 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
                                   selected_job.time_submitted >
                                     item.time_submitted):
                                 selected_job = item
+                        else:
+                            trace.reject_job(item.id, REJECT_MAX_AGENTS)
                     elif (selected_job is None or
                           selected_job.time_submitted > item.time_submitted):
                         # If this job is not running yet, remember it, but keep
@@ -298,9 +335,13 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
                 if isinstance(item, JobQueue):
                     if (item.num_assigned_agents() <
                             (item.maximum_agents or maxsize)):
-                        job = item.get_job_for_agent(agent, unwanted_job_ids)
+                        job = item.get_job_for_agent(
+                            agent, unwanted_job_ids, trace)
                         if job:
                             return job
+                        trace.reject_queue(item.id, REJECT_NO_TASKS)
+                    else:
+                        trace.reject_queue(item.id, REJECT_MAX_AGENTS)
             if selected_job:
                 return selected_job
 
@@ -315,4 +356,216 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
                 raise ValueError("Cannot have two jobqueues named %r at the "
                                  "top level" % target.name)
 
+    @staticmethod
+    def collect_assigned_agents_changes(session, flush_context, instances):
+        """
+        Remembers all changes in a session which might affect the
+        ``assigned_agents`` counters of jobs and queues, so that
+        :meth:`update_assigned_agents` can update them after the flush.
+        """
+        # Import here instead of at the top to avoid circular import
+        from pyfarm.models.task import Task
+        from pyfarm.models.job import Job
+
+        changes = session.info.setdefault(
+            ASSIGNED_AGENTS_CHANGES,
+            {"tasks": set(), "job_ids": set(), "agent_ids": set(),
+             "moved_jobs": {}, "queue_ids": set()})
+
+        for obj in session.new:
+            if isinstance(obj, Task):
+                changes["tasks"].add(obj)
+
+        for obj in session.dirty:
+            if isinstance(obj, Task):
+                attrs = inspect(obj).attrs
+                if any(attrs[name].history.has_changes() for name in
+                       ("state", "agent", "agent_id", "job", "job_id")):
+                    changes["tasks"].add(obj)
+                    changes["job_ids"].update(
+                        x for x in attrs.job_id.history.deleted
+                        if x is not None)
+
+            elif isinstance(obj, Agent):
+                if inspect(obj).attrs.state.history.has_changes():
+                    changes["agent_ids"].add(obj.id)
+
+            elif isinstance(obj, Job):
+                attrs = inspect(obj).attrs
+                if (attrs.job_queue_id.history.has_changes() or
+                        attrs.queue.history.has_changes()):
+                    history = attrs.job_queue_id.history
+                    old_queue_id = (history.deleted[0] if history.deleted
+                                    else obj.job_queue_id)
+                    changes["moved_jobs"].setdefault(obj, old_queue_id)
+
+        for obj in session.deleted:
+            if isinstance(obj, Task):
+                changes["job_ids"].add(obj.job_id)
+
+            elif isinstance(obj, Job) and obj.assigned_agents:
+                changes["queue_ids"].add(obj.job_queue_id)
+
+    @staticmethod
+    def count_assigned_agents(session, queue_ids=None):
+        """
+        Returns a dictionary mapping the given queue ids and the ids of all
+        their parents, or the ids of all queues if `queue_ids` is None, to
+        the number of distinct agents working on jobs in or below the queue.
+        An agent working on several jobs below a queue is counted only once.
+        """
+        # Import here instead of at the top to avoid circular import
+        from pyfarm.models.task import Task
+        from pyfarm.models.job import Job
+
+        parents = dict(session.query(JobQueue.id,
+                                     JobQueue.parent_jobqueue_id))
+        if queue_ids is None:
+            counted = set(parents)
+        else:
+            counted = set()
+            for queue_id in queue_ids:
+                while queue_id is not None and queue_id not in counted:
+                    counted.add(queue_id)
+                    queue_id = parents.get(queue_id)
+        if not counted:
+            return {}
+
+        agents_query = session.query(Job.job_queue_id, Task.agent_id).\
+            join(Task, Task.job_id == Job.id).\
+            join(Agent, Task.agent_id == Agent.id).filter(
+                Job.job_queue_id != None,
+                or_(Task.state == None, Task.state == WorkState.RUNNING),
+                Agent.state != AgentState.OFFLINE,
+                Agent.state != AgentState.DISABLED).distinct()
+        if queue_ids is not None:
+            # Only the queues below the counted ones are of interest
+            subtree = set()
+            for queue_id in parents:
+                path = []
+                while queue_id is not None and queue_id not in subtree:
+                    path.append(queue_id)
+                    if queue_id in counted:
+                        subtree.update(path)
+                        break
+                    queue_id = parents.get(queue_id)
+            agents_query = agents_query.filter(
+                Job.job_queue_id.in_(subtree))
+
+        agents = dict((x, set()) for x in counted)
+        for queue_id, agent_id in agents_query:
+            while queue_id is not None:
+                if queue_id in agents:
+                    agents[queue_id].add(agent_id)
+                queue_id = parents.get(queue_id)
+
+        return dict((x, len(y)) for x, y in agents.items())
+
+    @staticmethod
+    def update_assigned_agents(session, flush_context):
+        """
+        Recounts the assigned agents of every job affected by the flush and
+        of the queues of those jobs whose count changed, including all of
+        their parents.
+        """
+        changes = session.info.pop(ASSIGNED_AGENTS_CHANGES, None)
+        if not changes:
+            return
+
+        # Import here instead of at the top to avoid circular import
+        from pyfarm.models.task import Task
+        from pyfarm.models.job import Job
+
+        job_ids = changes["job_ids"]
+        job_ids.update(x.job_id for x in changes["tasks"])
+        moved_jobs = dict((job.id, old_queue_id) for job, old_queue_id in
+                          changes["moved_jobs"].items())
+        job_ids.update(moved_jobs)
+        if changes["agent_ids"]:
+            job_ids.update(x[0] for x in session.query(
+                distinct(Task.job_id)).filter(
+                    Task.agent_id.in_(changes["agent_ids"]),
+                    or_(Task.state == None,
+                        Task.state == WorkState.RUNNING)))
+        job_ids.discard(None)
+
+        queue_ids = changes["queue_ids"]
+        updated_job_ids = set()
+        if job_ids:
+            counts = dict(session.query(
+                Task.job_id, func.count(distinct(Task.agent_id))).\
+                    join(Agent, Task.agent_id == Agent.id).filter(
+                        Task.job_id.in_(job_ids),
+                        or_(Task.state == None,
+                            Task.state == WorkState.RUNNING),
+                        Agent.state != AgentState.OFFLINE,
+                        Agent.state != AgentState.DISABLED).\
+                            group_by(Task.job_id))
+
+            jobs_query = session.query(
+                Job.id, Job.job_queue_id, Job.assigned_agents).filter(
+                    Job.id.in_(job_ids))
+            for job_id, queue_id, stored_count in jobs_query:
+                stored_count = stored_count or 0
+                count = counts.get(job_id, 0)
+                if job_id in moved_jobs:
+                    queue_ids.add(moved_jobs[job_id])
+                    queue_ids.add(queue_id)
+                elif count != stored_count:
+                    queue_ids.add(queue_id)
+
+                if count != stored_count:
+                    session.execute(Job.__table__.update().where(
+                        Job.__table__.c.id == job_id).values(
+                            assigned_agents=count))
+                    updated_job_ids.add(job_id)
+
+        queue_ids.discard(None)
+        updated_queue_ids = set()
+        if queue_ids:
+            counts = JobQueue.count_assigned_agents(session, queue_ids)
+            stored_counts = dict(session.query(
+                JobQueue.id, JobQueue.assigned_agents).filter(
+                    JobQueue.id.in_(list(counts))))
+            table = JobQueue.__table__
+            for queue_id, count in counts.items():
+                if count != stored_counts.get(queue_id):
+                    session.execute(table.update().where(
+                        table.c.id == queue_id).values(
+                            assigned_agents=count))
+                    updated_queue_ids.add(queue_id)
+
+        if updated_job_ids or updated_queue_ids:
+            session.info[ASSIGNED_AGENTS_UPDATED] = (
+                updated_job_ids, updated_queue_ids)
+
+    @staticmethod
+    def expire_assigned_agents(session, flush_context):
+        """
+        Expires the ``assigned_agents`` attribute of all jobs and queues in
+        the session which were updated by :meth:`update_assigned_agents`
+        """
+        updated = session.info.pop(ASSIGNED_AGENTS_UPDATED, None)
+        if not updated:
+            return
+
+        # Import here instead of at the top to avoid circular import
+        from pyfarm.models.job import Job
+
+        job_ids, queue_ids = updated
+        for obj in list(session.identity_map.values()):
+            if ((isinstance(obj, Job) and obj.id in job_ids) or
+                    (isinstance(obj, JobQueue) and obj.id in queue_ids)):
+                session.expire(obj, ["assigned_agents"])
+
+    @staticmethod
+    def discard_assigned_agents_changes(session):
+        session.info.pop(ASSIGNED_AGENTS_CHANGES, None)
+        session.info.pop(ASSIGNED_AGENTS_UPDATED, None)
+
 event.listen(JobQueue, "before_insert", JobQueue.top_level_unique_check)
+event.listen(Session, "before_flush", JobQueue.collect_assigned_agents_changes)
+event.listen(Session, "after_flush", JobQueue.update_assigned_agents)
+event.listen(Session, "after_flush_postexec", JobQueue.expire_assigned_agents)
+event.listen(Session, "after_rollback",
+             JobQueue.discard_assigned_agents_changes)
@@ -105,6 +105,7 @@ class JobTypeVersion(db.Model, UtilityMixins, ReprMixin):
     __table_args__ = (UniqueConstraint("jobtype_id", "version"),)
 
     REPR_COLUMNS = ("id", "jobtype_id", "version")
+    DICT_CONVERT_COLUMN = {"capability_revision": NotImplemented}
 
     id = id_column(IDTypeWork)
 
@@ -162,6 +163,13 @@ class JobTypeVersion(db.Model, UtilityMixins, ReprMixin):
         nullable=False,
         doc="The source code of the job type")
 
+    capability_revision = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="Incremented on flush whenever the software requirements of "
+            "this version change.  Entries in the capability index are "
+            "only used while they carry the current revision.")
+
     #
     # Relationships
     #
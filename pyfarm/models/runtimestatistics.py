@@ -0,0 +1,339 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Task Runtime Statistics Model
+=============================
+
+Streaming statistics about the runtime of finished tasks, kept per job in
+:class:`TaskRuntimeStatistics` and per jobtype version in
+:class:`JobTypeVersionRuntimeStatistics`.  The statistics are updated
+incrementally whenever a task is set to done and are used to predict when
+jobs will finish and to prefer jobs with the least remaining work.
+"""
+
+from math import sqrt, log
+
+from sqlalchemy import event, inspect, func, select, and_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from pyfarm.core.enums import WorkState, _WorkState
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.models.core.types import IDTypeWork, JSONList
+from pyfarm.models.task import Task
+
+# Key used for tracking finished tasks in Session.info
+FINISHED_TASKS = "pf_finished_tasks"
+
+# Runtimes are counted in buckets growing by powers of two, the first one
+# being for runtimes below one second and the last one for everything above
+# 2 ** (HISTOGRAM_BUCKETS - 2) seconds
+HISTOGRAM_BUCKETS = 24
+
+
+class RuntimeStatisticsMixin(object):
+    """
+    The number, mean, variance and a histogram of the runtimes of finished
+    tasks
+    """
+    count = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The number of finished tasks")
+
+    mean = db.Column(
+        db.Float,
+        nullable=False, default=0.0,
+        doc="The mean runtime of the finished tasks in seconds")
+
+    m2 = db.Column(
+        db.Float,
+        nullable=False, default=0.0,
+        doc="The sum of the squared differences of the runtimes from the "
+            "mean, from which the variance is derived")
+
+    histogram = db.Column(
+        JSONList,
+        nullable=True,
+        doc="The number of finished tasks per runtime bucket, see "
+            ":data:`HISTOGRAM_BUCKETS`")
+
+    def add(self, runtime):
+        """Adds the runtime of one finished task, in seconds"""
+        runtime = max(runtime, 0.0)
+        count = (self.count or 0) + 1
+        mean = self.mean or 0.0
+        delta = runtime - mean
+        mean += delta / count
+        self.m2 = (self.m2 or 0.0) + delta * (runtime - mean)
+        self.mean = mean
+        self.count = count
+
+        histogram = list(self.histogram or [0] * HISTOGRAM_BUCKETS)
+        histogram[self.bucket(runtime)] += 1
+        self.histogram = histogram
+
+    def variance(self):
+        if not self.count or self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+    def stddev(self):
+        return sqrt(self.variance())
+
+    def percentile(self, percent):
+        """
+        Returns an estimate of the given percentile of the runtimes, in
+        seconds, interpolated within the histogram bucket it falls into
+        """
+        if not self.count or not self.histogram:
+            return None
+
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            if count and seen + count >= rank:
+                lower, upper = self.bucket_bounds(bucket)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+
+        return self.bucket_bounds(HISTOGRAM_BUCKETS - 1)[1]
+
+    def to_dict(self):
+        return {"count": self.count,
+                "mean": self.mean,
+                "stddev": self.stddev(),
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99)}
+
+    @staticmethod
+    def bucket(runtime):
+        if runtime < 1:
+            return 0
+        return min(int(log(runtime, 2)) + 1, HISTOGRAM_BUCKETS - 1)
+
+    @staticmethod
+    def bucket_bounds(bucket):
+        if bucket == 0:
+            return 0.0, 1.0
+        return float(2 ** (bucket - 1)), float(2 ** bucket)
+
+    @classmethod
+    def add_runtimes(cls, session, keys, runtimes, retry=True):
+        """
+        Adds `runtimes` to the row of this table identified by the column
+        values in `keys`, creating the row if it does not exist yet.  The
+        row is locked while it is updated, so concurrent updates are not
+        lost.  If another transaction creates the row first, the runtimes
+        are added to that one.
+        """
+        table = cls.__table__
+        row_query = select(
+            [table.c.count, table.c.mean, table.c.m2,
+             table.c.histogram]).where(
+                and_(*[table.c[key] == value
+                       for key, value in keys.items()])).with_for_update()
+
+        row = session.execute(row_query).first()
+        statistics = cls()
+        if row is not None:
+            (statistics.count, statistics.mean, statistics.m2,
+             statistics.histogram) = row
+        for runtime in runtimes:
+            statistics.add(runtime)
+        values = {"count": statistics.count,
+                  "mean": statistics.mean,
+                  "m2": statistics.m2,
+                  "histogram": statistics.histogram}
+
+        if row is None:
+            savepoint = session.connection().begin_nested()
+            try:
+                session.execute(table.insert().values(dict(keys, **values)))
+                savepoint.commit()
+                return
+            except IntegrityError:
+                # Either the row exists now or what it refers to is gone
+                savepoint.rollback()
+                if retry:
+                    cls.add_runtimes(session, keys, runtimes, retry=False)
+                return
+
+        session.execute(table.update().where(
+            and_(*[table.c[key] == value
+                   for key, value in keys.items()])).values(**values))
+
+
+class TaskRuntimeStatistics(db.Model, RuntimeStatisticsMixin):
+    """
+    The runtime statistics of the finished tasks of a single job
+    """
+    __tablename__ = config.get("table_task_runtime_statistics")
+
+    job_id = db.Column(
+        IDTypeWork,
+        db.ForeignKey("%s.id" % config.get("table_job"), ondelete="CASCADE"),
+        primary_key=True,
+        doc="The job these statistics are about")
+
+    jobtype_version_id = db.Column(
+        IDTypeWork,
+        db.ForeignKey("%s.id" % config.get("table_job_type_version"),
+                      ondelete="CASCADE"),
+        nullable=False,
+        doc="The jobtype version of the job")
+
+    @classmethod
+    def for_job(cls, job):
+        """
+        Returns the statistics for `job` or, if none of its tasks have
+        finished yet, the :class:`JobTypeVersionRuntimeStatistics` for its
+        jobtype version.  Returns None if there are neither.
+        """
+        statistics = cls.query.filter_by(job_id=job.id).first()
+        if statistics is None or not statistics.count:
+            statistics = JobTypeVersionRuntimeStatistics.query.filter_by(
+                jobtype_version_id=job.jobtype_version_id).first()
+        if statistics is None or not statistics.count:
+            return None
+        return statistics
+
+    @classmethod
+    def load_means(cls, jobs):
+        """
+        Returns a dictionary of job ids and the mean task runtime of each of
+        the given jobs, falling back to the mean of their jobtype version.
+        Jobs without either are left out.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return {}
+
+        job_means = dict(db.session.query(cls.job_id, cls.mean).filter(
+            cls.job_id.in_([x.id for x in jobs]), cls.count > 0))
+        missing = [x for x in jobs if x.id not in job_means]
+        if missing:
+            jobtype_statistics = JobTypeVersionRuntimeStatistics
+            jobtype_means = dict(db.session.query(
+                jobtype_statistics.jobtype_version_id,
+                jobtype_statistics.mean).filter(
+                    jobtype_statistics.jobtype_version_id.in_(
+                        set(x.jobtype_version_id for x in missing)),
+                    jobtype_statistics.count > 0))
+            for job in missing:
+                if job.jobtype_version_id in jobtype_means:
+                    job_means[job.id] = jobtype_means[job.jobtype_version_id]
+
+        return job_means
+
+    @staticmethod
+    def task_runtime(session, task):
+        """
+        Returns the runtime of `task` in seconds.  Tasks of a batch usually
+        share the time they were started at, so the runtime of such a task
+        only starts when the previous task of the batch finished.
+        """
+        previous_finished = session.query(func.max(Task.time_finished)).\
+            filter(Task.job_id == task.job_id,
+                   Task.agent_id == task.agent_id,
+                   Task.time_started == task.time_started,
+                   Task.state == WorkState.DONE,
+                   Task.id != task.id,
+                   Task.time_finished <= task.time_finished).scalar()
+        started = max(task.time_started, previous_finished or
+                      task.time_started)
+        return max((task.time_finished - started).total_seconds(), 0.0)
+
+    @staticmethod
+    def collect_finished_tasks(session, flush_context, instances):
+        """
+        Remembers the runtimes of all tasks which are being set to done for
+        :meth:`update_statistics`
+        """
+        for obj in session.dirty:
+            # States which were just set are still plain strings, which
+            # != would never consider equal to a _WorkState value
+            if not isinstance(obj, Task) or obj.state not in (
+                    _WorkState.DONE, ):
+                continue
+            history = inspect(obj).attrs.state.history
+            if (not history.added or _WorkState.DONE in history.deleted or
+                    obj.time_started is None or obj.time_finished is None or
+                    obj.job is None):
+                continue
+
+            session.info.setdefault(FINISHED_TASKS, []).append(
+                (obj.job_id, obj.job.jobtype_version_id,
+                 TaskRuntimeStatistics.task_runtime(session, obj)))
+
+    @staticmethod
+    def update_statistics(session, flush_context):
+        """
+        Adds the collected runtimes to the statistics of their jobs and
+        jobtype versions
+        """
+        finished_tasks = session.info.pop(FINISHED_TASKS, None)
+        if not finished_tasks:
+            return
+
+        job_runtimes = {}
+        jobtype_runtimes = {}
+        for job_id, jobtype_version_id, runtime in finished_tasks:
+            job_runtimes.setdefault(
+                (job_id, jobtype_version_id), []).append(runtime)
+            jobtype_runtimes.setdefault(jobtype_version_id, []).append(
+                runtime)
+
+        # Always in the same order, so concurrent transactions do not
+        # deadlock on the row locks
+        for job_id, jobtype_version_id in sorted(job_runtimes):
+            TaskRuntimeStatistics.add_runtimes(
+                session, {"job_id": job_id,
+                          "jobtype_version_id": jobtype_version_id},
+                job_runtimes[(job_id, jobtype_version_id)])
+        for jobtype_version_id in sorted(jobtype_runtimes):
+            JobTypeVersionRuntimeStatistics.add_runtimes(
+                session, {"jobtype_version_id": jobtype_version_id},
+                jobtype_runtimes[jobtype_version_id])
+
+    @staticmethod
+    def discard_finished_tasks(session):
+        session.info.pop(FINISHED_TASKS, None)
+
+
+class JobTypeVersionRuntimeStatistics(db.Model, RuntimeStatisticsMixin):
+    """
+    The runtime statistics of the finished tasks of all jobs using a jobtype
+    version
+    """
+    __tablename__ = config.get("table_job_type_version_runtime_statistics")
+
+    jobtype_version_id = db.Column(
+        IDTypeWork,
+        db.ForeignKey("%s.id" % config.get("table_job_type_version"),
+                      ondelete="CASCADE"),
+        primary_key=True,
+        doc="The jobtype version of the tasks these statistics are about")
+
+
+event.listen(Session, "before_flush",
+             TaskRuntimeStatistics.collect_finished_tasks)
+event.listen(Session, "after_flush", TaskRuntimeStatistics.update_statistics)
+event.listen(Session, "after_rollback",
+             TaskRuntimeStatistics.discard_finished_tasks)
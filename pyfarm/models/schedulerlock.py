@@ -0,0 +1,51 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler Lock Model
+====================
+
+Model for the locks the scheduler holds on agents and jobs when the database
+lock backend is in use.
+"""
+
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+
+
+class SchedulerLock(db.Model):
+    """
+    A named lock with an owner and an expiry time.  A lock whose expiry time
+    has passed may be taken over by any other owner.
+    """
+    __tablename__ = config.get("table_scheduler_lock")
+
+    name = db.Column(
+        db.String(255),
+        primary_key=True,
+        nullable=False,
+        autoincrement=False,
+        doc="The name of the lock, for example ``agent-<agent id>``")
+
+    owner = db.Column(
+        db.String(32),
+        nullable=False,
+        doc="A random token identifying the holder of the lock")
+
+    expires = db.Column(
+        db.DateTime,
+        nullable=False,
+        doc="The point in time after which the lock is considered stale")
@@ -0,0 +1,62 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler Trigger Model
+=======================
+
+Model for the requests to run the scheduler which have not been handled yet,
+see :mod:`pyfarm.scheduler.triggers`.
+"""
+
+from datetime import datetime
+
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.models.core.types import JSONList
+
+
+class SchedulerTrigger(db.Model):
+    """
+    A pending request to run the scheduler, optionally restricted to some
+    agents and job queues.  A trigger without any agents or job queues
+    requires a run over all idle agents.
+    """
+    __tablename__ = config.get("table_scheduler_trigger")
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True,
+        doc="Increasing id of the trigger, only the trigger with the lowest "
+            "pending id starts a run of the scheduler")
+
+    agent_ids = db.Column(
+        JSONList,
+        nullable=True,
+        doc="The ids of the agents which may have become able to take on "
+            "work")
+
+    queue_ids = db.Column(
+        JSONList,
+        nullable=True,
+        doc="The ids of the job queues which may have gotten new work")
+
+    time_created = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        doc="The time the scheduler was triggered")
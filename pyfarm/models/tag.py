@@ -46,6 +46,19 @@ class Tag(db.Model, UtilityMixins):
         db.String(config.get("max_tag_length")),
         nullable=False, doc="The actual value of the tag")
 
+    @staticmethod
+    def bitset(tag_ids):
+        """
+        Returns the given tag ids as an integer with the bit at the position
+        of each id set.  Tag ids are small, sequential integers, so the
+        bitsets of agents and tag requirements can be compared with a couple
+        of bitwise operations instead of set or relationship lookups.
+        """
+        bits = 0
+        for tag_id in tag_ids:
+            bits |= 1 << tag_id
+        return bits
+
 
 class JobTagRequirement(db.Model, UtilityMixins):
     """
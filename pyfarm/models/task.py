@@ -51,6 +51,7 @@ class Task(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
     STATE_DEFAULT = None
     REPR_COLUMNS = ("id", "state", "frame", "project")
     REPR_CONVERT_COLUMN = {"state": partial(repr_enum, enum=STATE_ENUM)}
+    DICT_CONVERT_COLUMN = {"speculative_agent_id": NotImplemented}
 
     # shared work columns
     id, state, priority, time_submitted, time_started, time_finished = \
@@ -61,6 +62,13 @@ class Task(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         db.ForeignKey("%s.id" % config.get("table_agent")),
         doc="Foreign key which stores :attr:`Job.id`")
 
+    speculative_agent_id = db.Column(
+        IDTypeAgent,
+        db.ForeignKey("%s.id" % config.get("table_agent")),
+        nullable=True,
+        doc="The agent running a speculative copy of this task next to "
+            ":attr:`agent_id`, see :mod:`pyfarm.scheduler.speculation`")
+
     job_id = db.Column(
         IDTypeWork, db.ForeignKey("%s.id" % config.get("table_job")),
         nullable=False,
@@ -133,9 +141,51 @@ class Task(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
     def failed(self):
         return self.state == WorkState.FAILED
 
+    def start_speculation(self, agent_id):
+        """
+        Makes `agent_id` run a speculative copy of this task.  The copy is
+        a new attempt, so :attr:`attempts` is incremented and the copy runs
+        with the new attempt number while the original keeps its own.
+        """
+        self.speculative_agent_id = agent_id
+
+    def end_speculation(self):
+        """
+        Drops the speculative copy of this task and returns the id of the
+        agent that ran it, the attempt it used still counts
+        """
+        agent_id = self.speculative_agent_id
+        self.speculative_agent_id = None
+        return agent_id
+
+    def promote_speculation(self):
+        """
+        Makes the agent running the speculative copy of this task the agent
+        owning it, because the copy finished first.  Returns the id of the
+        agent which ran the original.  :attr:`attempts` is left at the
+        attempt number of the copy.
+        """
+        agent_id = self.agent_id
+        # The copy's attempt was already counted when it was started, so
+        # the agent is changed while it still is the speculative one
+        self.agent_id = self.speculative_agent_id
+        self.end_speculation()
+        return agent_id
+
+    @staticmethod
+    def speculating_agent_ids():
+        """
+        Returns a query for the ids of all agents which currently run a
+        speculative copy of a task
+        """
+        return db.session.query(Task.speculative_agent_id).filter(
+            Task.speculative_agent_id != None)
+
     @staticmethod
     def increment_attempts(target, new_value, old_value, initiator):
-        if new_value is not None and new_value != old_value:
+        if (new_value is not None and new_value != old_value and
+                (initiator.key == "speculative_agent_id" or
+                 new_value != target.speculative_agent_id)):
             target.attempts += 1
 
     @staticmethod
@@ -222,6 +272,7 @@ event.listen(Task.state, "set", Task.update_failures)
 event.listen(Task.state, "set", Task.set_progress_on_success)
 event.listen(Task.state, "set", Task.update_agent_on_success)
 event.listen(Task.agent_id, "set", Task.increment_attempts)
+event.listen(Task.speculative_agent_id, "set", Task.increment_attempts)
 event.listen(Task.agent_id, "set", Task.log_assign_change)
 event.listen(Task.state, "set", Task.reset_agent_if_failed_and_retry,
              retval=True)
@@ -0,0 +1,133 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Agent Client
+------------
+
+The HTTP client used for all requests from the master to the agents.  It
+keeps the connections to the agents alive between requests in a pool per
+agent, so polling or sending work to an agent does not require a new TCP
+connection every time.  The pools belong to the worker process, see
+:func:`get_agent_client`, and are sized by ``agent_client_pool_agents``
+and ``agent_client_pool_connections``.
+"""
+
+from json import dumps
+from os import getpid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pyfarm.core.logger import getLogger
+from pyfarm.master.config import config
+from pyfarm.master.utility import default_json_encoder
+
+USERAGENT = config.get("master_user_agent")
+AGENT_REQUEST_TIMEOUT = config.get("agent_request_timeout")
+AGENT_CONNECT_TIMEOUT = config.get("agent_connect_timeout")
+POOL_AGENTS = config.get("agent_client_pool_agents")
+POOL_CONNECTIONS = config.get("agent_client_pool_connections")
+
+logger = getLogger("pf.scheduler.agentclient")
+
+_agent_client = None
+
+
+class AgentClient(object):
+    """
+    Sends requests to the REST api of agents over a single
+    :class:`requests.Session`.  Request bodies are encoded as json and every
+    request carries the master's User-Agent header.
+    """
+    def __init__(self, pool_agents=None, pool_connections=None,
+                 timeout=None, connect_timeout=None):
+        self.pid = getpid()
+        self.timeout = (
+            AGENT_REQUEST_TIMEOUT if timeout is None else timeout)
+        connect_timeout = (
+            AGENT_CONNECT_TIMEOUT if connect_timeout is None
+            else connect_timeout)
+        if connect_timeout is not None:
+            self.timeout = (connect_timeout, self.timeout)
+
+        # Failed requests are retried by the celery tasks, not in here
+        adapter = HTTPAdapter(
+            pool_connections=POOL_AGENTS if pool_agents is None
+            else pool_agents,
+            pool_maxsize=POOL_CONNECTIONS if pool_connections is None
+            else pool_connections,
+            max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = USERAGENT
+
+    def request(self, method, agent, path, data=None):
+        """
+        Sends a request to `agent` and returns the
+        :class:`requests.Response`
+
+        :param str method:
+            The HTTP method to use
+
+        :param agent:
+            The agent, or anything else with an ``api_url()`` method, to
+            send the request to
+
+        :param str path:
+            The path of the request, relative to the agent's api url
+
+        :param data:
+            If not None, this is encoded as json and sent as the request's
+            body
+        """
+        headers = {}
+        if data is not None:
+            data = dumps(data, default=default_json_encoder)
+            headers["Content-Type"] = "application/json"
+
+        return self.session.request(
+            method, agent.api_url() + path, data=data, headers=headers,
+            timeout=self.timeout)
+
+    def get(self, agent, path):
+        return self.request("GET", agent, path)
+
+    def post(self, agent, path, data):
+        return self.request("POST", agent, path, data=data)
+
+    def delete(self, agent, path):
+        return self.request("DELETE", agent, path)
+
+    def close(self):
+        self.session.close()
+
+
+def get_agent_client():
+    """
+    Returns the :class:`AgentClient` of the current process.  Connections
+    must not be shared with forked children, so a process which did not
+    create the client itself, like a celery worker forked from its parent,
+    gets a new one.
+    """
+    global _agent_client
+
+    if _agent_client is None or _agent_client.pid != getpid():
+        _agent_client = AgentClient()
+        logger.debug("Created a new agent client for process %s",
+                     _agent_client.pid)
+    return _agent_client
@@ -0,0 +1,347 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler Benchmark
+-------------------
+
+Generates a synthetic farm in the configured database and measures how
+expensive it is for the scheduler to find work for its agents.  The results
+are written as a JSON report, so that runs against different revisions of
+PyFarm can be compared with ``--compare``.
+
+Two modes are supported:
+
+    * ``select`` - only ask the queue (or the scheduler snapshot with
+      ``--snapshot``) for the best job for every agent, nothing is assigned
+    * ``assign`` - run :func:`.assign_tasks_to_agent` for every agent.  The
+      assigned tasks are not sent to the agents, which do not exist.
+
+Because the farm is written to the database configured for PyFarm, the
+benchmark refuses to run against a database that already contains agents or
+jobs unless ``--drop-all`` is given.
+"""
+
+import json
+import uuid
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from math import ceil
+from random import Random
+from time import time
+
+from pyfarm.core.logger import getLogger
+from pyfarm.models.software import (
+    Software, SoftwareVersion, JobTypeSoftwareRequirement)
+from pyfarm.models.tag import Tag, JobTagRequirement
+from pyfarm.models.task import Task
+from pyfarm.models.job import Job
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.agent import Agent
+from pyfarm.master.application import db
+from pyfarm.scheduler import tasks
+from pyfarm.scheduler.snapshot import SchedulerSnapshot
+from pyfarm.scheduler.tracing import QueryCounter
+
+logger = getLogger("pf.scheduler.benchmark")
+
+# Keys of the report which are compared by compare_reports() and whether a
+# higher value is better
+COMPARED_KEYS = (
+    ("assignments_per_second", True),
+    ("queries_per_assignment", False),
+    ("latency_p50", False),
+    ("latency_p99", False))
+
+
+def generate_farm(agents=100, queues=10, jobs=100, tasks_per_job=100,
+                  software=5, tags=10, dependency_ratio=0.1, seed=0):
+    """
+    Creates a synthetic farm in the database and returns the parameters it
+    was generated with.
+
+    :param int agents:
+        The number of agents, each of them gets a random selection of the
+        software versions and tags
+    :param int queues:
+        The number of job queues, arranged in a random tree
+    :param int jobs:
+        The number of jobs, spread randomly over the queues
+    :param int tasks_per_job:
+        The number of tasks (frames) in every job
+    :param int software:
+        The number of software packages, each with three versions.  Every
+        jobtype version requires one of them.
+    :param int tags:
+        The number of tags.  Every third job requires one tag.
+    :param float dependency_ratio:
+        The share of jobs which depend on an earlier job
+    :param int seed:
+        The seed for the random number generator, the same parameters and
+        seed always produce the same farm
+    """
+    parameters = {
+        "agents": agents, "queues": queues, "jobs": jobs,
+        "tasks_per_job": tasks_per_job, "software": software, "tags": tags,
+        "dependency_ratio": dependency_ratio, "seed": seed}
+    random = Random(seed)
+
+    software_versions = []
+    for i in range(software):
+        software_item = Software(software="benchmark-software-%s" % i)
+        versions = [SoftwareVersion(software=software_item, version=str(rank),
+                                    rank=rank) for rank in range(3)]
+        software_versions.append(versions)
+        db.session.add_all(versions)
+
+    tag_objects = [Tag(tag="benchmark-tag-%s" % i) for i in range(tags)]
+    db.session.add_all(tag_objects)
+
+    jobtype_versions = []
+    for i in range(max(software, 1)):
+        jobtype = JobType(name="BenchmarkJobType%s" % i,
+                          description="Generated by the scheduler benchmark")
+        jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="BenchmarkJobType%s" % i,
+            max_batch=4, batch_contiguous=True,
+            code="class BenchmarkJobType(JobType): pass".encode("utf-8"))
+        if software_versions:
+            db.session.add(JobTypeSoftwareRequirement(
+                jobtype_version=jobtype_version,
+                software=software_versions[i][0].software,
+                min_version=software_versions[i][random.randint(0, 1)]))
+        jobtype_versions.append(jobtype_version)
+    db.session.add_all(jobtype_versions)
+    db.session.flush()
+
+    for i in range(agents):
+        agent = Agent(hostname="benchmark-agent-%s" % i, id=uuid.uuid4(),
+                      ram=32768, free_ram=32768, cpus=16, port=50000)
+        for versions in software_versions:
+            if random.random() < 0.8:
+                agent.software_versions.append(random.choice(versions))
+        for tag in tag_objects:
+            if random.random() < 0.5:
+                agent.tags.append(tag)
+        db.session.add(agent)
+    db.session.flush()
+
+    queue_objects = []
+    for i in range(queues):
+        parent = random.choice(queue_objects) if queue_objects else None
+        queue = JobQueue(name="benchmark-queue-%s" % i, parent=parent,
+                         weight=random.randint(1, 10),
+                         priority=random.randint(1, 5))
+        queue_objects.append(queue)
+    db.session.add_all(queue_objects)
+    db.session.flush()
+
+    job_objects = []
+    for i in range(jobs):
+        job = Job(title="benchmark-job-%s" % i,
+                  jobtype_version=random.choice(jobtype_versions),
+                  queue=random.choice(queue_objects) if queue_objects else None,
+                  batch=random.randint(1, 4), by=1, ram=1024, cpus=1,
+                  weight=random.randint(1, 10))
+        if job_objects and random.random() < dependency_ratio:
+            job.parents = [random.choice(job_objects)]
+        if tag_objects and i % 3 == 0:
+            db.session.add(JobTagRequirement(
+                job=job, tag=random.choice(tag_objects)))
+        db.session.add(job)
+        db.session.add_all(Task(job=job, frame=frame)
+                           for frame in range(tasks_per_job))
+        job_objects.append(job)
+
+        # Keep the session small for large farms
+        if i % 100 == 99:
+            db.session.flush()
+
+    db.session.commit()
+    logger.info("Generated a farm with %s agents, %s queues, %s jobs and %s "
+                "tasks", agents, queues, jobs, jobs * tasks_per_job)
+    return parameters
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of `values`"""
+    if not values:
+        return None
+
+    values = sorted(values)
+    index = int(ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+@contextmanager
+def scheduler_environment(use_snapshot):
+    """
+    Makes :func:`.assign_tasks_to_agent` use the scheduler snapshot if
+    requested and keeps it from sending the assigned tasks to the (not
+    existing) agents.
+    """
+    class NotSent(object):
+        @staticmethod
+        def delay(*args, **kwargs):
+            pass
+
+    use_snapshot_before = tasks.USE_SCHEDULER_SNAPSHOT
+    send_tasks_to_agent = tasks.send_tasks_to_agent
+    tasks.USE_SCHEDULER_SNAPSHOT = use_snapshot
+    tasks.send_tasks_to_agent = NotSent
+    try:
+        yield
+    finally:
+        tasks.USE_SCHEDULER_SNAPSHOT = use_snapshot_before
+        tasks.send_tasks_to_agent = send_tasks_to_agent
+
+
+def run_benchmark(mode="assign", use_snapshot=False):
+    """
+    Runs the scheduler once for every agent in the database and returns a
+    report of the results.
+
+    :param str mode:
+        Either ``select`` or ``assign``, see the module documentation
+    :param bool use_snapshot:
+        If True, use :class:`.SchedulerSnapshot` instead of :class:`.JobQueue`
+    """
+    if mode not in ("select", "assign"):
+        raise ValueError("Unknown benchmark mode %r" % mode)
+
+    db.session.rollback()
+    agent_ids = [x[0] for x in db.session.query(Agent.id).order_by(
+        Agent.hostname)]
+    assigned_before = Task.query.filter(Task.agent_id != None).count()
+
+    latencies = []
+    jobs_found = 0
+    counter = QueryCounter()
+    started = time()
+    with scheduler_environment(use_snapshot), counter.counting():
+        for agent_id in agent_ids:
+            start = time()
+            if mode == "assign":
+                tasks.assign_tasks_to_agent(agent_id)
+            else:
+                agent = Agent.query.filter_by(id=agent_id).one()
+                agent.clear_scheduling_cache()
+                if use_snapshot:
+                    queue = SchedulerSnapshot.load(agent_ids=[agent_id])
+                else:
+                    queue = JobQueue()
+                if queue.get_job_for_agent(agent, []) is not None:
+                    jobs_found += 1
+                db.session.rollback()
+            latencies.append(time() - start)
+    duration = time() - started
+
+    if mode == "assign":
+        assignments = (Task.query.filter(Task.agent_id != None).count() -
+                       assigned_before)
+    else:
+        assignments = jobs_found
+
+    return {
+        "mode": mode,
+        "snapshot": use_snapshot,
+        "database": db.engine.name,
+        "agents": len(agent_ids),
+        "assignments": assignments,
+        "duration": duration,
+        "queries": counter.count,
+        "assignments_per_second":
+            assignments / duration if duration else None,
+        "queries_per_assignment":
+            float(counter.count) / assignments if assignments else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies) if latencies else None}
+
+
+def compare_reports(base, new):
+    """
+    Returns the relative change of the compared values from report `base` to
+    report `new`.  Positive numbers are improvements.
+    """
+    changes = {}
+    for key, higher_is_better in COMPARED_KEYS:
+        old_value = base.get(key)
+        new_value = new.get(key)
+        if not old_value or new_value is None:
+            changes[key] = None
+            continue
+
+        change = (new_value - old_value) / float(old_value)
+        changes[key] = change if higher_is_better else -change
+
+    return changes
+
+
+def benchmark():  # pragma: no cover
+    """Command line entry point for the scheduler benchmark"""
+    parser = ArgumentParser(
+        description="Generates a synthetic farm and benchmarks the scheduler "
+                    "against it")
+    parser.add_argument("--agents", type=int, default=100)
+    parser.add_argument("--queues", type=int, default=10)
+    parser.add_argument("--jobs", type=int, default=100)
+    parser.add_argument("--tasks-per-job", type=int, default=100)
+    parser.add_argument("--software", type=int, default=5)
+    parser.add_argument("--tags", type=int, default=10)
+    parser.add_argument("--dependency-ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--mode", choices=("select", "assign"), default="assign")
+    parser.add_argument(
+        "--snapshot", action="store_true",
+        help="Use the scheduler snapshot instead of the job queue models")
+    parser.add_argument(
+        "--drop-all", action="store_true",
+        help="Drop and recreate all tables before generating the farm")
+    parser.add_argument(
+        "--output", help="Write the report to this file instead of stdout")
+    parser.add_argument(
+        "--compare", help="A report from an earlier run to compare against")
+    args = parser.parse_args()
+
+    if args.drop_all:
+        db.drop_all()
+    db.create_all()
+
+    if Agent.query.count() or Job.query.count():
+        parser.error("The database already contains agents or jobs, use "
+                     "--drop-all to replace them with the synthetic farm")
+
+    report = {"farm": generate_farm(
+        agents=args.agents, queues=args.queues, jobs=args.jobs,
+        tasks_per_job=args.tasks_per_job, software=args.software,
+        tags=args.tags, dependency_ratio=args.dependency_ratio,
+        seed=args.seed)}
+    report.update(run_benchmark(mode=args.mode, use_snapshot=args.snapshot))
+
+    if args.compare:
+        with open(args.compare, "r") as base_file:
+            report["compared_to"] = args.compare
+            report["changes"] = compare_reports(json.load(base_file), report)
+
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
@@ -60,9 +60,34 @@ celery_app.conf.CELERYBEAT_SCHEDULE = {
     "periodically_execute_deletions": {
         "task": "pyfarm.scheduler.tasks.delete_to_be_deleted_jobs",
         "schedule": timedelta(**config.get("delete_job_interval")),
+    },
+    "periodically_reconcile_assigned_agents": {
+        "task": "pyfarm.scheduler.tasks.reconcile_assigned_agents",
+        "schedule": timedelta(**config.get("reconcile_counters_interval")),
+    },
+    "periodically_reconcile_task_counts": {
+        "task": "pyfarm.scheduler.tasks.reconcile_task_counts",
+        "schedule": timedelta(**config.get("reconcile_counters_interval")),
+    },
+    "periodically_reconcile_unfinished_parents": {
+        "task": "pyfarm.scheduler.tasks.reconcile_unfinished_parents",
+        "schedule": timedelta(**config.get("reconcile_counters_interval")),
     }
 }
 
+if config.get("scheduler_preemption"):
+    celery_app.conf.CELERYBEAT_SCHEDULE["periodically_preempt_tasks"] = {
+        "task": "pyfarm.scheduler.tasks.preempt_tasks",
+        "schedule": timedelta(**config.get("scheduler_preemption_interval"))
+        }
+
+if config.get("scheduler_speculative_execution"):
+    celery_app.conf.CELERYBEAT_SCHEDULE["periodically_speculate_tasks"] = {
+        "task": "pyfarm.scheduler.tasks.speculate_tasks",
+        "schedule": timedelta(
+            **config.get("scheduler_speculative_execution_interval"))
+        }
+
 if config.get("enable_statistics"):
     celery_app.conf.CELERYBEAT_SCHEDULE["periodically_count_agents"] = {
         "task": "pyfarm.scheduler.statistics_tasks.count_agents",
@@ -0,0 +1,337 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler Locks
+---------------
+
+Named, non-blocking locks used by the scheduler to make sure only one worker
+at a time assigns work to an agent or modifies a job.  Every lock has a time
+to live after which it is considered stale and may be taken over, so a
+crashed worker can never block the scheduler for longer than that.  Workers
+holding locks for longer than that have to :func:`renew_locks` in between.
+Which backend is used is controlled by ``scheduler_lock_backend``:
+
+    * ``lockfile`` - lock files below ``scheduler_lockfile_base``, only works
+      if all workers share a filesystem
+    * ``database`` - rows in the :class:`.SchedulerLock` table
+    * ``redis`` - keys in the redis server at ``scheduler_lock_redis_url``
+"""
+
+from datetime import datetime, timedelta
+from os.path import getmtime
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+
+from lockfile import LockFile, AlreadyLocked
+
+from pyfarm.core.logger import getLogger
+from pyfarm.models.schedulerlock import SchedulerLock
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = NotImplemented
+
+LOCK_BACKEND = config.get("scheduler_lock_backend")
+LOCK_TTL = config.get("scheduler_lock_ttl")
+SCHEDULER_LOCKFILE_BASE = config.get("scheduler_lockfile_base")
+LOCK_REDIS_URL = config.get("scheduler_lock_redis_url")
+
+logger = getLogger("pf.scheduler.locks")
+
+_redis_client = None
+
+# The tokens of the FileLocks held by this process by path.  Lock files are
+# owned by a process and thread, so they do not keep two FileLocks of the
+# same thread from both acquiring them.
+_file_lock_holders = {}
+_file_lock_holders_lock = Lock()
+
+
+class SchedulerLockBase(object):
+    """
+    Base class for all lock backends.  :meth:`acquire` never waits, it
+    returns ``False`` right away if somebody else is holding the lock.
+    """
+    def __init__(self, name, ttl=None):
+        self.name = name
+        self.ttl = LOCK_TTL if ttl is None else ttl
+        self.token = uuid4().hex
+        self.locked = False
+        self.renewed = None
+
+    def acquire(self):
+        raise NotImplementedError
+
+    def release(self):
+        raise NotImplementedError
+
+    def renew(self):
+        """
+        Restarts the time to live of the lock.  Returns ``False`` if the
+        lock has been taken over by somebody else in the meantime, it is no
+        longer held then.
+        """
+        raise NotImplementedError
+
+    def renewal_due(self):
+        """Returns True if half of the lock's time to live has passed"""
+        return self.locked and time() - self.renewed > self.ttl / 2.0
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.name)
+
+
+class FileLock(SchedulerLockBase):
+    """Lock backed by :class:`lockfile.LockFile`"""
+    def __init__(self, name, ttl=None):
+        super(FileLock, self).__init__(name, ttl=ttl)
+        self.path = SCHEDULER_LOCKFILE_BASE + "-" + name
+        self._lock = LockFile(self.path)
+
+    def _is_stale(self):
+        try:
+            with open(self.path, "r") as lockfile:
+                locktime = float(lockfile.read())
+        except (IOError, OSError, ValueError):
+            # We might be in the narrow window between lock acquisition and
+            # writing the time, so fall back to the age of the lock itself
+            try:
+                locktime = getmtime(self._lock.lock_file)
+            except OSError:
+                return False
+
+        return locktime < time() - self.ttl
+
+    def _break_lock(self):
+        logger.error("The lock %s was held for more than %s seconds. "
+                     "Breaking the lock.", self.name, self.ttl)
+        self._lock.break_lock()
+
+    def acquire(self):
+        with _file_lock_holders_lock:
+            holder = _file_lock_holders.get(self.path)
+            if holder is not None and holder != self.token:
+                if not self._is_stale():
+                    return False
+                self._break_lock()
+
+            try:
+                self._lock.acquire(timeout=-1)
+            except AlreadyLocked:
+                if not self._is_stale():
+                    return False
+                self._break_lock()
+                try:
+                    self._lock.acquire(timeout=-1)
+                except AlreadyLocked:
+                    return False
+
+            with open(self.path, "w") as lockfile:
+                lockfile.write(str(time()))
+            _file_lock_holders[self.path] = self.token
+            self.locked = True
+            self.renewed = time()
+            return True
+
+    def release(self):
+        if self.locked:
+            self.locked = False
+            with _file_lock_holders_lock:
+                # Do not release a lock which was taken over in the meantime
+                if _file_lock_holders.get(self.path) == self.token:
+                    del _file_lock_holders[self.path]
+                    self._lock.release()
+
+    def renew(self):
+        with _file_lock_holders_lock:
+            holder = _file_lock_holders.get(self.path)
+            if (self.locked and self._lock.i_am_locking() and
+                    holder == self.token):
+                with open(self.path, "w") as lockfile:
+                    lockfile.write(str(time()))
+                self.renewed = time()
+                return True
+
+            if holder == self.token:
+                del _file_lock_holders[self.path]
+            self.locked = False
+            return False
+
+
+class DatabaseLock(SchedulerLockBase):
+    """
+    Lock backed by a row in the :class:`.SchedulerLock` table.  The lock uses
+    its own connection and transactions so it is not affected by commits or
+    rollbacks of the scheduler's session.
+    """
+    def acquire(self):
+        table = SchedulerLock.__table__
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=self.ttl)
+
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.insert().values(
+                    name=self.name, owner=self.token, expires=expires))
+        except IntegrityError:
+            # Somebody else holds the lock, take it over if it is stale.  If
+            # two workers try this at the same time, the second update will
+            # no longer match any row.
+            with db.engine.begin() as connection:
+                result = connection.execute(table.update().where(
+                    and_(table.c.name == self.name,
+                         table.c.expires < now)).values(
+                             owner=self.token, expires=expires))
+            if result.rowcount != 1:
+                return False
+            logger.error("The lock %s was held for more than %s seconds. "
+                         "Breaking the lock.", self.name, self.ttl)
+
+        self.locked = True
+        self.renewed = time()
+        return True
+
+    def release(self):
+        if self.locked:
+            self.locked = False
+            table = SchedulerLock.__table__
+            with db.engine.begin() as connection:
+                connection.execute(table.delete().where(
+                    and_(table.c.name == self.name,
+                         table.c.owner == self.token)))
+
+    def renew(self):
+        if not self.locked:
+            return False
+
+        table = SchedulerLock.__table__
+        expires = datetime.utcnow() + timedelta(seconds=self.ttl)
+        with db.engine.begin() as connection:
+            result = connection.execute(table.update().where(
+                and_(table.c.name == self.name,
+                     table.c.owner == self.token)).values(expires=expires))
+        if result.rowcount != 1:
+            self.locked = False
+            return False
+
+        self.renewed = time()
+        return True
+
+
+class RedisLock(SchedulerLockBase):
+    """Lock backed by a redis key which expires after the lock's ttl"""
+    RELEASE_SCRIPT = """
+        if redis.call("get", KEYS[1]) == ARGV[1] then
+            return redis.call("del", KEYS[1])
+        else
+            return 0
+        end"""
+    RENEW_SCRIPT = """
+        if redis.call("get", KEYS[1]) == ARGV[1] then
+            return redis.call("pexpire", KEYS[1], ARGV[2])
+        else
+            return 0
+        end"""
+
+    def __init__(self, name, ttl=None):
+        super(RedisLock, self).__init__(name, ttl=ttl)
+        self.key = "pyfarm-scheduler-lock-" + name
+
+    @staticmethod
+    def get_client():
+        global _redis_client
+
+        if redis is NotImplemented:
+            raise RuntimeError(
+                "The redis lock backend requires the redis module")
+
+        if _redis_client is None:
+            _redis_client = redis.StrictRedis.from_url(LOCK_REDIS_URL)
+        return _redis_client
+
+    def acquire(self):
+        client = self.get_client()
+        if not client.set(self.key, self.token, nx=True,
+                          px=int(self.ttl * 1000)):
+            return False
+
+        self.locked = True
+        self.renewed = time()
+        return True
+
+    def release(self):
+        if self.locked:
+            self.locked = False
+            client = self.get_client()
+            client.eval(self.RELEASE_SCRIPT, 1, self.key, self.token)
+
+    def renew(self):
+        if not self.locked:
+            return False
+
+        client = self.get_client()
+        if not client.eval(self.RENEW_SCRIPT, 1, self.key, self.token,
+                           int(self.ttl * 1000)):
+            self.locked = False
+            return False
+
+        self.renewed = time()
+        return True
+
+
+LOCK_BACKENDS = {
+    "lockfile": FileLock,
+    "database": DatabaseLock,
+    "redis": RedisLock}
+
+
+def get_lock(name, ttl=None):
+    """
+    Returns a new, not yet acquired, lock with the given name using the
+    configured backend
+    """
+    try:
+        lock_class = LOCK_BACKENDS[LOCK_BACKEND]
+    except KeyError:
+        raise ValueError(
+            "Unknown scheduler lock backend %r, expected one of %s" %
+            (LOCK_BACKEND, ", ".join(sorted(LOCK_BACKENDS))))
+
+    return lock_class(name, ttl=ttl)
+
+
+def renew_locks(locks):
+    """
+    Renews those of `locks` which are due for it, see
+    :meth:`SchedulerLockBase.renewal_due`.  Returns ``False`` if any of them
+    has been lost, whatever they protect may be handled by another worker
+    then.
+    """
+    renewed = True
+    for lock in locks:
+        if lock.renewal_due() and not lock.renew():
+            logger.error("The lock %s has been taken over by somebody else",
+                         lock.name)
+            renewed = False
+    return renewed
@@ -0,0 +1,154 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Task Payloads
+-------------
+
+Builds the parts of the messages :func:`.send_tasks_to_agent` sends to
+agents which describe a job and its jobtype.  They are the same for every
+batch of the job, so they are built once and cached by each worker process
+until the job's :attr:`.Job.payload_revision` changes, which happens
+whenever the job is edited.  The payloads of all jobs missing from the
+cache are loaded together, with their users, jobtypes, tags and notified
+users, in a fixed number of queries.  Payloads older than
+``scheduler_payload_cache_max_age`` are rebuilt regardless.
+"""
+
+from collections import OrderedDict
+from copy import deepcopy
+from time import time
+
+from sqlalchemy.orm import joinedload
+
+from pyfarm.core.logger import getLogger
+from pyfarm.models.job import Job, JobNotifiedUser, JobTagAssociation
+from pyfarm.models.jobtype import JobTypeVersion
+from pyfarm.models.tag import Tag
+from pyfarm.models.user import User
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+
+PAYLOAD_CACHE_SIZE = config.get("scheduler_payload_cache_size")
+PAYLOAD_CACHE_MAX_AGE = config.get("scheduler_payload_cache_max_age")
+
+logger = getLogger("pf.scheduler.payloads")
+
+# Maps job ids to tuples of the job's revision, the time the payloads were
+# built, the job payload and the jobtype payload, the least recently used
+# first.  The revision includes the job's submission time, so a job reusing
+# the id of a deleted one does not get its payload.
+_payload_cache = OrderedDict()
+
+
+def build_payload(job, tags, notified_users):
+    """
+    Returns the job and the jobtype payloads for `job`, which must have its
+    user and jobtype loaded already, with the given tag names and notified
+    users
+    """
+    job_payload = {"id": job.id,
+                   "title": job.title,
+                   "data": deepcopy(job.data) if job.data else {},
+                   "environ": deepcopy(job.environ) if job.environ else {},
+                   "by": job.by,
+                   "batch": job.batch,
+                   "ram": job.ram,
+                   "ram_warning": job.ram_warning,
+                   "ram_max": job.ram_max,
+                   "cpus": job.cpus,
+                   "notified_users": notified_users,
+                   "priority": job.priority,
+                   "notes": job.notes,
+                   "tags": tags,
+                   "num_tiles": job.num_tiles}
+    if job.user:
+        job_payload["user"] = job.user.username
+
+    jobtype_payload = {"name": job.jobtype_version.jobtype.name,
+                       "version": job.jobtype_version.version}
+    return job_payload, jobtype_payload
+
+
+def load_payloads(job_ids):
+    """
+    Builds the payloads of the given jobs and returns them as a dictionary
+    of job ids and ``(job_payload, jobtype_payload)`` tuples
+    """
+    tags = dict((x, []) for x in job_ids)
+    tags_query = db.session.query(JobTagAssociation.c.job_id, Tag.tag).join(
+        Tag, Tag.id == JobTagAssociation.c.tag_id).filter(
+            JobTagAssociation.c.job_id.in_(job_ids))
+    for job_id, tag in tags_query:
+        tags[job_id].append(tag)
+
+    notified_users = dict((x, []) for x in job_ids)
+    notified_users_query = db.session.query(
+        JobNotifiedUser.job_id, User.username, JobNotifiedUser.on_success,
+        JobNotifiedUser.on_failure, JobNotifiedUser.on_deletion).join(
+            User, User.id == JobNotifiedUser.user_id).filter(
+                JobNotifiedUser.job_id.in_(job_ids))
+    for job_id, username, on_success, on_failure, on_deletion in \
+            notified_users_query:
+        notified_users[job_id].append({"username": username,
+                                       "on_success": on_success,
+                                       "on_failure": on_failure,
+                                       "on_deletion": on_deletion})
+
+    jobs_query = Job.query.filter(Job.id.in_(job_ids)).options(
+        joinedload(Job.user),
+        joinedload(Job.jobtype_version).joinedload(JobTypeVersion.jobtype))
+    return dict((job.id, build_payload(job, tags[job.id],
+                                       notified_users[job.id]))
+                for job in jobs_query)
+
+
+def get_payloads(job_ids):
+    """
+    Returns the payloads of the given jobs as a dictionary of job ids and
+    ``(job_payload, jobtype_payload)`` tuples, from the cache if they are
+    still current.  The payloads are shared, they must not be modified.
+    Jobs which do not exist are left out.
+    """
+    revisions = dict(
+        (job_id, (revision, time_submitted))
+        for job_id, revision, time_submitted in db.session.query(
+            Job.id, Job.payload_revision, Job.time_submitted).filter(
+                Job.id.in_(job_ids)))
+
+    now = time()
+    payloads = {}
+    stale_job_ids = []
+    for job_id, revision in revisions.items():
+        cached = _payload_cache.pop(job_id, None)
+        if (cached is not None and cached[0] == revision and
+                now - cached[1] < PAYLOAD_CACHE_MAX_AGE):
+            payloads[job_id] = cached[2:]
+            _payload_cache[job_id] = cached
+        else:
+            stale_job_ids.append(job_id)
+
+    if stale_job_ids:
+        logger.debug("Building payloads for jobs %s",
+                     ", ".join(str(x) for x in sorted(stale_job_ids)))
+        for job_id, payload in load_payloads(stale_job_ids).items():
+            payloads[job_id] = payload
+            _payload_cache[job_id] = (revisions[job_id], now) + payload
+
+        while len(_payload_cache) > PAYLOAD_CACHE_SIZE:
+            _payload_cache.popitem(last=False)
+
+    return payloads
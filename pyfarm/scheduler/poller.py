@@ -0,0 +1,283 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bulk Agent Poller
+-----------------
+
+Polls many agents at once from a single worker instead of starting one
+:func:`.poll_agent` task per agent.  :func:`poll_concurrently` requests the
+status and the tasks of all agents with up to
+``scheduler_bulk_poll_concurrency`` requests in flight, and
+:func:`apply_results` then updates the database for all of them in a few
+queries and transactions.  Agents which cannot be reached are tried again
+in further passes once all of the others have been polled, with a growing
+delay in between, so a short network outage does not take them offline.
+
+The requests are made from a pool of threads, which keeps this working on
+Python 2 as well.  The threads never touch the database, they only get a
+:class:`PollTarget` for each agent.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from time import sleep
+from uuid import UUID
+
+from sqlalchemy import or_
+
+import requests
+from requests.exceptions import ConnectionError, Timeout
+# Workaround for https://github.com/kennethreitz/requests/issues/2204
+from requests.packages.urllib3.exceptions import ProtocolError
+
+from pyfarm.core.logger import getLogger
+from pyfarm.core.enums import WorkState, AgentState
+from pyfarm.models.agent import Agent
+from pyfarm.models.task import Task
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.scheduler.agentclient import get_agent_client
+
+BULK_POLL_ENABLED = config.get("scheduler_bulk_poll")
+BULK_POLL_CONCURRENCY = config.get("scheduler_bulk_poll_concurrency")
+BULK_POLL_RETRIES = config.get("scheduler_bulk_poll_retries")
+BULK_POLL_RETRY_DELAY = config.get("scheduler_bulk_poll_retry_delay")
+OUR_FARM_NAME = config.get("farm_name")
+
+logger = getLogger("pf.scheduler.poller")
+
+
+class PollTarget(namedtuple("PollTarget", ("id", "hostname", "url"))):
+    """The parts of an agent needed to poll it outside of the session"""
+    @classmethod
+    def from_agent(cls, agent):
+        return cls(agent.id, agent.hostname, agent.api_url())
+
+    def api_url(self):
+        return self.url
+
+
+# The outcome of polling one agent.  `status` and `tasks` are the decoded
+# responses or None if polling failed, `unreachable` is True if the agent
+# could not be contacted at all.
+PollResult = namedtuple(
+    "PollResult", ("target", "status", "tasks", "error", "unreachable"))
+
+
+def fetch_agent(target):
+    """
+    Requests the status and the tasks of the agent `target` and returns a
+    :class:`PollResult`
+    """
+    client = get_agent_client()
+    try:
+        status_response = client.get(target, "/status")
+        if status_response.status_code != requests.codes.ok:
+            raise ValueError(
+                "Unexpected return code on checking status of agent "
+                "%s (id %s): %s" % (target.hostname, target.id,
+                                    status_response.status_code))
+        status_json = status_response.json()
+
+        tasks_response = client.get(target, "/tasks/")
+        if tasks_response.status_code != requests.codes.ok:
+            raise ValueError(
+                "Unexpected return code on checking tasks in agent "
+                "%s (id %s): %s" % (target.hostname, target.id,
+                                    tasks_response.status_code))
+        return PollResult(target, status_json, tasks_response.json(),
+                          None, False)
+
+    except (ConnectionError, Timeout, ProtocolError) as e:
+        logger.warning("Caught %s trying to contact agent %s (id %s): %s",
+                       type(e).__name__, target.hostname, target.id, e)
+        return PollResult(target, None, None, e, True)
+
+    except ValueError as e:
+        logger.error("Polling agent %s (id %s) failed: %s",
+                     target.hostname, target.id, e)
+        return PollResult(target, None, None, e, False)
+
+
+def poll_concurrently(targets, concurrency=None, retries=None,
+                      retry_delay=None):
+    """
+    Polls all agents in `targets` with at most `concurrency` requests at a
+    time and returns a list of :class:`PollResult`.  Agents which cannot be
+    reached are polled again up to `retries` more times after all of the
+    others, waiting `retry_delay` seconds before the first retry and twice
+    as long before each further one.
+    """
+    if not targets:
+        return []
+    if concurrency is None:
+        concurrency = BULK_POLL_CONCURRENCY
+    if retries is None:
+        retries = BULK_POLL_RETRIES
+    if retry_delay is None:
+        retry_delay = BULK_POLL_RETRY_DELAY
+
+    results = {}
+    pending = list(targets)
+    pool = ThreadPool(processes=min(concurrency, len(targets)))
+    try:
+        for attempt in range(retries + 1):
+            if attempt:
+                delay = retry_delay * 2 ** (attempt - 1)
+                logger.info("Polling %s unreachable agents again in %s "
+                            "seconds, attempt %s of %s", len(pending), delay,
+                            attempt + 1, retries + 1)
+                sleep(delay)
+
+            pass_results = pool.map(fetch_agent, pending)
+            for result in pass_results:
+                results[result.target] = result
+            pending = [x.target for x in pass_results if x.unreachable]
+            if not pending:
+                break
+    finally:
+        pool.close()
+        pool.join()
+
+    return [results[x] for x in targets]
+
+
+def apply_results(results, now=None):
+    """
+    Updates the agents and tasks in the database from `results` and commits
+    the changes.  Returns a tuple of the ids of the agents which miss some
+    of their tasks and a list of ``(task_id, agent_id)`` tuples for the
+    tasks which have to be stopped on an agent they do not belong to.
+    Sending and stopping the tasks is left to the caller.
+    """
+    if not results:
+        return [], []
+    now = now or datetime.utcnow()
+
+    agents = {}
+    for agent in Agent.query.filter(
+            Agent.id.in_([x.target.id for x in results])):
+        agents[agent.id] = agent
+
+    reachable = {}
+    unreachable_ids = []
+    for result in results:
+        agent = agents.get(result.target.id)
+        if agent is None:
+            logger.warning("Polled agent %s (id %s) does not exist anymore",
+                           result.target.hostname, result.target.id)
+        elif result.unreachable:
+            unreachable_ids.append(agent.id)
+        elif result.error is None and check_status(agent, result, now):
+            reachable[agent.id] = result
+
+    # The tasks the reachable agents are supposed to have, including the
+    # speculative copies they run
+    assigned_task_ids = dict((x, set()) for x in reachable)
+    if reachable:
+        assigned_query = db.session.query(
+            Task.id, Task.agent_id, Task.speculative_agent_id).filter(
+                or_(Task.agent_id.in_(list(reachable)),
+                    Task.speculative_agent_id.in_(list(reachable))),
+                or_(Task.state == None,
+                    Task.state == WorkState.RUNNING))
+        for task_id, agent_id, speculative_agent_id in assigned_query:
+            for owner_id in (agent_id, speculative_agent_id):
+                if owner_id in assigned_task_ids:
+                    assigned_task_ids[owner_id].add(task_id)
+
+    agents_missing_tasks = []
+    superfluous_task_ids = {}
+    for agent_id, result in reachable.items():
+        agent = agents[agent_id]
+        present_task_ids = set(x["id"] for x in result.tasks)
+        if assigned_task_ids[agent_id] - present_task_ids:
+            logger.debug("Agent %s does not have all the tasks it is "
+                         "supposed to have", agent.hostname)
+            agents_missing_tasks.append(agent_id)
+        superfluous = present_task_ids - assigned_task_ids[agent_id]
+        if superfluous:
+            superfluous_task_ids[agent_id] = superfluous
+
+        agent.state = result.status["state"]
+        agent.free_ram = result.status["free_ram"]
+        agent.last_heard_from = now
+        db.session.add(agent)
+
+    tasks_to_stop = []
+    if superfluous_task_ids:
+        owners = dict(db.session.query(Task.id, Task.agent_id).filter(
+            Task.id.in_(set.union(*superfluous_task_ids.values()))))
+        for agent_id, task_ids in superfluous_task_ids.items():
+            for task_id in task_ids:
+                if task_id not in owners:
+                    logger.warning("Superfluous task %s not found in db",
+                                   task_id)
+                elif owners[task_id] != agent_id:
+                    logger.warning("Task %s belongs to agent %s, but has "
+                                   "been found running on %s (id %s), "
+                                   "stopping it.", task_id, owners[task_id],
+                                   agents[agent_id].hostname, agent_id)
+                    tasks_to_stop.append((task_id, agent_id))
+
+    jobs_to_check = set()
+    for agent_id in unreachable_ids:
+        agent = agents[agent_id]
+        logger.error("Could not contact agent %s, (id %s), marking as "
+                     "offline", agent.hostname, agent.id)
+        agent.state = AgentState.OFFLINE
+        agent.last_polled = now
+        db.session.add(agent)
+    if unreachable_ids:
+        for task in Task.query.filter(Task.agent_id.in_(unreachable_ids),
+                                      Task.state == WorkState.RUNNING):
+            task.state = None
+            db.session.add(task)
+            jobs_to_check.add(task.job)
+    db.session.commit()
+
+    for job in jobs_to_check:
+        job.update_state()
+        db.session.add(job)
+    db.session.commit()
+
+    logger.info("Polled %s agents, %s reachable, %s unreachable",
+                len(results), len(reachable), len(unreachable_ids))
+    return agents_missing_tasks, tasks_to_stop
+
+
+def check_status(agent, result, now):
+    """
+    Returns True if the status in `result` was sent by `agent` of this
+    farm, otherwise the result has to be ignored
+    """
+    if UUID(result.status["agent_id"]) != agent.id:
+        logger.error("Wrong agent reached under %s. Expected id %s, got %s",
+                     result.target.url, agent.id, result.status["agent_id"])
+        return False
+
+    if ("farm_name" in result.status and
+            result.status["farm_name"] != OUR_FARM_NAME):
+        logger.error("Wrong farm_name from agent %s (id %s): %s. "
+                     "(Expected: %s)", agent.hostname, agent.id,
+                     result.status["farm_name"], OUR_FARM_NAME)
+        agent.last_polled = now
+        db.session.add(agent)
+        return False
+
+    return True
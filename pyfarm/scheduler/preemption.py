@@ -0,0 +1,211 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler Preemption
+--------------------
+
+Decides which agents should give up their current work so that a starving
+job of higher priority can run.  A job is starving if it has tasks waiting
+for an agent while it has fewer agents than its ``minimum_agents``, fewer
+agents than the ``minimum_agents`` of its queue or no agents at all.
+
+Victims are busy agents which only work on jobs of strictly lower priority
+than the starving job.  Agents working on the lowest priority jobs are
+picked first and among those the ones whose tasks have made the least
+progress.  :func:`hand_over` requeues the tasks of a victim and assigns a
+batch of the starving job to it in the same transaction.  Leaving the
+victim to the regular scheduler instead could give it its old work back,
+because job priorities are compared across the whole farm here while the
+scheduler ranks queues first.  Locking, committing and stopping the tasks
+on the agent is done by :func:`.preempt_tasks`.
+
+To keep preemption from thrashing, tasks which started less than
+``scheduler_preemption_grace_period`` ago are never preempted and a single
+run preempts at most ``scheduler_preemption_max_agents`` agents.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, and_, desc
+
+from pyfarm.core.logger import getLogger
+from pyfarm.core.enums import WorkState, _WorkState, AgentState
+from pyfarm.models.agent import Agent
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+
+PREEMPTION_ENABLED = config.get("scheduler_preemption")
+PREEMPTION_MAX_AGENTS = config.get("scheduler_preemption_max_agents")
+PREEMPTION_GRACE_PERIOD = timedelta(
+    **config.get("scheduler_preemption_grace_period"))
+
+logger = getLogger("pf.scheduler.preemption")
+
+
+def agent_deficit(job):
+    """
+    Returns the number of agents `job` is missing to satisfy its own
+    ``minimum_agents``, the ``minimum_agents`` of its queue or, if it has
+    no agents at all, to get at least one
+    """
+    assigned = job.num_assigned_agents()
+    deficit = max(job.minimum_agents or 0, 1) - assigned
+
+    queue = job.queue
+    if queue is not None and queue.minimum_agents:
+        deficit = max(
+            deficit, queue.minimum_agents - queue.num_assigned_agents())
+
+    if job.maximum_agents:
+        deficit = min(deficit, job.maximum_agents - assigned)
+
+    return max(deficit, 0)
+
+
+def find_starving_jobs():
+    """
+    Returns a list of ``(job, deficit)`` tuples for all runnable jobs with
+    tasks waiting for an agent which are short of agents, highest priority
+    first
+    """
+    jobs = Job.query.filter(
+        or_(Job.state == None, Job.state == WorkState.RUNNING),
+        Job.unfinished_parents == 0,
+        Job.to_be_deleted == False,
+        Job.tasks.any(and_(Task.agent_id == None,
+                           Task.state == None))).order_by(
+                               desc(Job.priority), Job.time_submitted)
+
+    starving = []
+    for job in jobs:
+        deficit = agent_deficit(job)
+        if deficit:
+            starving.append((job, deficit))
+
+    return starving
+
+
+class BusyAgent(object):
+    """The active tasks of an agent which may be preempted"""
+    def __init__(self, agent_id):
+        self.agent_id = agent_id
+        self.priority = None
+        self.progress = 0.0
+        self.job_ids = set()
+        self.preemptible = True
+
+    def add(self, job_id, priority, progress, time_started, started_before):
+        self.job_ids.add(job_id)
+        self.progress += progress or 0.0
+        if self.priority is None or priority > self.priority:
+            self.priority = priority
+        # Tasks which have not started yet were only just assigned
+        if time_started is None or time_started > started_before:
+            self.preemptible = False
+
+
+def load_busy_agents(now=None):
+    """
+    Returns the busy agents with their active tasks as a dictionary of
+    agent ids and :class:`BusyAgent` instances
+    """
+    now = now or datetime.utcnow()
+    started_before = now - PREEMPTION_GRACE_PERIOD
+
+    busy_agents = {}
+    for agent_id, job_id, priority, progress, time_started in \
+            db.session.query(Task.agent_id, Task.job_id, Job.priority,
+                             Task.progress, Task.time_started).join(
+                Job, Task.job_id == Job.id).join(
+                Agent, Task.agent_id == Agent.id).filter(
+                or_(Task.state == None, Task.state == WorkState.RUNNING),
+                Agent.state.in_([AgentState.ONLINE, AgentState.RUNNING])):
+        if agent_id not in busy_agents:
+            busy_agents[agent_id] = BusyAgent(agent_id)
+        busy_agents[agent_id].add(
+            job_id, priority, progress, time_started, started_before)
+
+    return busy_agents
+
+
+def select_victims(job, deficit, busy_agents):
+    """
+    Returns the ids of up to `deficit` agents among `busy_agents` which
+    should be preempted in favour of `job`.  The selected agents are removed
+    from `busy_agents`.
+    """
+    candidates = sorted(
+        (x for x in busy_agents.values()
+         if x.preemptible and x.priority < job.priority),
+        key=lambda x: (x.priority, x.progress))
+
+    victims = []
+    for candidate in candidates:
+        if len(victims) >= deficit:
+            break
+
+        agent = Agent.query.filter_by(id=candidate.agent_id).one()
+        requirement = agent.unsatisfied_job_requirement(job, ignore_load=True)
+        if requirement is not None:
+            logger.debug("Agent %s cannot be preempted for job %s (%s): %s",
+                         agent.hostname, job.id, job.title, requirement)
+            continue
+
+        victims.append(candidate.agent_id)
+        del busy_agents[candidate.agent_id]
+
+    return victims
+
+
+def hand_over(agent, job):
+    """
+    Requeues the active tasks of `agent` and assigns the next batch of `job`
+    to it instead.  Returns the ids of the requeued tasks, which still have
+    to be stopped on the agent, or None if `job` has no tasks left for the
+    agent.  In that case nothing is changed.  Committing is left to the
+    caller.
+    """
+    batch = job.get_batch(agent)
+    if not batch:
+        return None
+
+    stopped_task_ids = []
+    for task in Task.query.filter(
+            Task.agent_id == agent.id,
+            or_(Task.state == None, Task.state == WorkState.RUNNING)):
+        stopped_task_ids.append(task.id)
+        task.agent = None
+        task.state = None
+        db.session.add(task)
+
+    for task in batch:
+        task.agent = agent
+        task.sent_to_agent = False
+        logger.info("Assigned preempted agent %s (id %s) to task %s (frame "
+                    "%s) from job %s (id %s)", agent.hostname, agent.id,
+                    task.id, task.frame, job.title, job.id)
+        db.session.add(task)
+
+    if job.state != _WorkState.RUNNING:
+        job.state = WorkState.RUNNING
+        db.session.add(job)
+    agent.record_assignment(job)
+    db.session.add(agent)
+
+    return stopped_task_ids
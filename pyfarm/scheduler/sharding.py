@@ -0,0 +1,99 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler Sharding
+------------------
+
+Splits scheduling into shards which can run in parallel.  Every top-level
+:class:`.JobQueue` with everything below it is a shard of its own and all
+jobs which are not part of any queue form one more shard,
+:data:`ROOT_SHARD`.  Because the shards have no jobs in common, workers
+scheduling different shards never modify the same jobs.
+
+:func:`.assign_tasks` offers each idle agent to the shard of the job the
+scheduler snapshot would pick for it, which takes the priorities, minimums,
+maximums and weights of the top-level queues into account, and then starts
+one :func:`.assign_tasks_batch` per shard.  A worker has to hold the lease
+of a shard, a lock which expires after ``scheduler_shard_lease_ttl``
+seconds, while it schedules the shard.
+"""
+
+from pyfarm.core.logger import getLogger
+from pyfarm.master.config import config
+from pyfarm.scheduler.locks import get_lock
+
+SHARDING_ENABLED = config.get("scheduler_sharding")
+SHARD_LEASE_TTL = config.get("scheduler_shard_lease_ttl")
+
+# The shard of all jobs which are not part of any queue
+ROOT_SHARD = "root"
+
+logger = getLogger("pf.scheduler.sharding")
+
+
+def shard_of(snapshot, job_id):
+    """
+    Returns the shard of the given job, the id of its top-level queue or
+    :data:`ROOT_SHARD`
+    """
+    job = snapshot.jobs[job_id]
+    queue = snapshot.queues.get(job.queue_id)
+    if queue is None or queue is snapshot.root:
+        return ROOT_SHARD
+
+    while queue.parent is not snapshot.root:
+        queue = queue.parent
+    return queue.id
+
+
+def shard_queue(snapshot, shard):
+    """
+    Returns the queue of `snapshot` to select jobs from for `shard` or None
+    if the shard does not exist anymore
+    """
+    if shard == ROOT_SHARD:
+        return snapshot.root
+    return snapshot.queues.get(shard)
+
+
+def partition_agents(snapshot, agent_ids):
+    """
+    Returns a dictionary of shards and the ids of the agents among
+    `agent_ids` which are offered to them.  Each agent goes to the shard of
+    the job `snapshot` selects for it and the selection is recorded in
+    `snapshot`, so the agents are spread over the shards just like they
+    would be spread over the top-level queues.  Agents for which there is
+    no job are left out.
+    """
+    shards = {}
+    for agent_id in agent_ids:
+        job = snapshot.select_job(agent_id)
+        if job is None:
+            continue
+
+        shard = shard_of(snapshot, job.id)
+        shards.setdefault(shard, []).append(agent_id)
+        snapshot.record_assignment(job.id, agent_id, 1)
+
+    logger.debug("Offering %s agents to %s shards",
+                 sum(len(x) for x in shards.values()), len(shards))
+    return shards
+
+
+def get_lease(shard):
+    """Returns the lease, a not yet acquired lock, for `shard`"""
+    return get_lock("shard-%s" % shard, ttl=SHARD_LEASE_TTL)
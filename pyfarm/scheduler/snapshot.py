@@ -0,0 +1,576 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler Snapshot
+------------------
+
+An in-memory view of everything the scheduler needs to know in order to pick
+a job for an agent.  :meth:`JobQueue.get_job_for_agent` walks the queue tree
+and issues several small queries per queue, job and agent.  A
+:class:`SchedulerSnapshot` instead loads the queue tree, the runnable jobs,
+their task and agent counts and the capabilities of the agents in a handful
+of bulk queries and then runs the same priority, weight, minimum and maximum
+logic against that data.
+
+The jobs and child queues of every queue are kept in a
+:class:`.StrideHeap` per priority, which :meth:`record_assignment` updates,
+so finding the next candidate does not require sorting all of them again.
+"""
+
+from sys import maxsize
+from logging import DEBUG
+
+from sqlalchemy import or_, func
+
+from pyfarm.core.logger import getLogger
+from pyfarm.core.enums import WorkState, _WorkState, AgentState
+from pyfarm.models.tag import JobTagRequirement
+from pyfarm.models.task import Task
+from pyfarm.models.job import Job
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.runtimestatistics import TaskRuntimeStatistics
+from pyfarm.models.agent import (
+    Agent, AgentTagAssociation, AgentReservation, AgentAffinity)
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.scheduler.stride import (
+    StrideHeap, affinity_order, UNKNOWN_REMAINING_WORK)
+from pyfarm.scheduler.tracing import (
+    NULL_TRACE, REJECT_RAM, REJECT_CPUS, REJECT_SOFTWARE, REJECT_CAPACITY,
+    REJECT_TAGS, REJECT_MAX_AGENTS, REJECT_NO_TASKS, REJECT_UNWANTED)
+
+PREFER_RUNNING_JOBS = config.get("queue_prefer_running_jobs")
+USE_TOTAL_RAM = config.get("use_total_ram_for_scheduling")
+SHORTEST_REMAINING_FIRST = config.get("scheduler_shortest_remaining_first")
+
+logger = getLogger("pf.scheduler.snapshot")
+
+if config.get("debug_queue"):
+    logger.setLevel(DEBUG)
+
+
+class SnapshotQueue(object):
+    """The scheduling relevant columns of a single :class:`JobQueue`"""
+    is_job = False
+
+    def __init__(self, id, parent_id, priority, weight, minimum_agents,
+                 maximum_agents, assigned_agents=0):
+        self.id = id
+        self.parent_id = parent_id
+        self.priority = priority
+        self.weight = weight
+        self.minimum_agents = minimum_agents
+        self.maximum_agents = maximum_agents
+        self.parent = None
+        self.children = []
+        self.jobs = []
+        self.assigned_agents = assigned_agents or 0
+        self.levels = {}
+        self.priorities = []
+        self.minimum_jobs = []
+        self.minimum_queues = []
+
+    def num_assigned_agents(self):
+        return self.assigned_agents
+
+
+class SnapshotJob(object):
+    """The scheduling relevant columns and counters of a single :class:`Job`"""
+    is_job = True
+
+    def __init__(self, id, queue_id, state, priority, weight, minimum_agents,
+                 maximum_agents, time_submitted, jobtype_version_id, ram,
+                 cpus, assigned_agents=0, job_group_id=None,
+                 remaining_tasks=0):
+        self.id = id
+        self.queue_id = queue_id
+        self.state = state
+        self.priority = priority
+        self.weight = weight
+        self.minimum_agents = minimum_agents
+        self.maximum_agents = maximum_agents
+        self.time_submitted = time_submitted
+        self.jobtype_version_id = jobtype_version_id
+        self.job_group_id = job_group_id
+        self.ram = ram or 0
+        self.cpus = cpus or 0
+        self.unassigned_tasks = 0
+        self.remaining_tasks = remaining_tasks or 0
+        self.assigned_agents = assigned_agents or 0
+        self.required_tag_bits = 0
+        self.forbidden_tag_bits = 0
+        self.mean_runtime = None
+
+    def running(self):
+        return self.state == _WorkState.RUNNING
+
+    def num_assigned_agents(self):
+        # Same optimization as in Job.num_assigned_agents()
+        if not self.running():
+            return 0
+        return self.assigned_agents
+
+    def can_use_more_agents(self):
+        return self.unassigned_tasks > 0
+
+    def remaining_work(self):
+        """
+        Returns the expected runtime of the queued and running tasks of this
+        job in seconds, the same as in :meth:`JobQueue.get_job_for_agent`.
+        Jobs without runtime statistics come last.  Without
+        ``scheduler_shortest_remaining_first`` this is always 0.
+        """
+        if not SHORTEST_REMAINING_FIRST:
+            return 0
+        if self.mean_runtime is None:
+            return UNKNOWN_REMAINING_WORK
+        return self.mean_runtime * self.remaining_tasks
+
+
+class SnapshotAgent(object):
+    """The resources and capabilities of a single :class:`Agent`"""
+    def __init__(self, id, hostname, ram, free_ram, cpus, ram_allocation=None,
+                 cpu_allocation=None, last_job_id=None,
+                 last_jobtype_version_id=None, last_job_group_id=None):
+        self.id = id
+        self.hostname = hostname
+        self.ram = ram
+        self.free_ram = free_ram
+        self.cpus = cpus
+        self.ram_allocation = ram_allocation
+        self.cpu_allocation = cpu_allocation
+        self.tag_bits = 0
+        self.reservation = AgentReservation()
+        self.affinity = AgentAffinity(
+            last_job_id, last_jobtype_version_id, last_job_group_id)
+
+    def available_ram(self):
+        return self.ram if USE_TOTAL_RAM else self.free_ram
+
+
+class SchedulerSnapshot(object):
+    """
+    A snapshot of the queue tree, the runnable jobs and a set of agents.  Use
+    :meth:`load` to create one, then call :meth:`get_job_for_agent` for as
+    many agents as needed and :meth:`record_assignment` after every batch that
+    was actually assigned so the following decisions see the new counts.
+    """
+    def __init__(self):
+        self.root = SnapshotQueue(None, None, 0, 0, None, None)
+        self.queues = {None: self.root}
+        self.jobs = {}
+        self.agents = {}
+        self.supported_types = {}
+
+    @classmethod
+    def load(cls, agent_ids=None):
+        """
+        Loads a new snapshot from the database.
+
+        :param agent_ids:
+            The ids of the agents the snapshot will be used for.  If not
+            provided, all agents that are neither offline nor disabled are
+            loaded.
+        """
+        snapshot = cls()
+        snapshot._load_queues()
+        snapshot._load_jobs()
+        snapshot._build_levels()
+        snapshot._load_agents(agent_ids)
+        snapshot.supported_types = Agent.get_capabilities(
+            snapshot.agents, set(x.jobtype_version_id
+                                 for x in snapshot.jobs.values()))
+        logger.debug("Loaded scheduler snapshot with %s queues, %s runnable "
+                     "jobs and %s agents", len(snapshot.queues) - 1,
+                     len(snapshot.jobs), len(snapshot.agents))
+        return snapshot
+
+    def _load_queues(self):
+        queues_query = db.session.query(
+            JobQueue.id, JobQueue.parent_jobqueue_id, JobQueue.priority,
+            JobQueue.weight, JobQueue.minimum_agents,
+            JobQueue.maximum_agents, JobQueue.assigned_agents).\
+                order_by(JobQueue.id)
+
+        for row in queues_query:
+            self.queues[row[0]] = SnapshotQueue(*row)
+
+        for queue in self.queues.values():
+            if queue is not self.root:
+                queue.parent = self.queues.get(queue.parent_id, self.root)
+                queue.parent.children.append(queue)
+
+    def _load_jobs(self):
+        jobs_query = db.session.query(
+            Job.id, Job.job_queue_id, Job.state, Job.priority, Job.weight,
+            Job.minimum_agents, Job.maximum_agents, Job.time_submitted,
+            Job.jobtype_version_id, Job.ram, Job.cpus,
+            Job.assigned_agents, Job.job_group_id,
+            Job.num_tasks_queued + Job.num_tasks_running).filter(
+                or_(Job.state == WorkState.RUNNING, Job.state == None),
+                Job.unfinished_parents == 0).\
+                    order_by(Job.id)
+
+        for row in jobs_query:
+            job = SnapshotJob(*row)
+            self.jobs[job.id] = job
+            self.queues.get(job.queue_id, self.root).jobs.append(job)
+
+        unassigned_query = db.session.query(
+            Task.job_id, func.count(Task.id)).filter(
+                or_(Task.state == None,
+                    ~Task.state.in_([WorkState.DONE, WorkState.FAILED])),
+                or_(Task.agent_id == None,
+                    Task.agent.has(Agent.state.in_(
+                        [AgentState.OFFLINE, AgentState.DISABLED])))).\
+                            group_by(Task.job_id)
+
+        for job_id, count in unassigned_query:
+            if job_id in self.jobs:
+                self.jobs[job_id].unassigned_tasks = count
+
+        if SHORTEST_REMAINING_FIRST:
+            for job_id, mean in TaskRuntimeStatistics.load_means(
+                    self.jobs.values()).items():
+                self.jobs[job_id].mean_runtime = mean
+
+        tag_requirements_query = db.session.query(
+            JobTagRequirement.job_id, JobTagRequirement.tag_id,
+            JobTagRequirement.negate).filter(
+                JobTagRequirement.job.has(
+                    or_(Job.state == WorkState.RUNNING, Job.state == None)))
+
+        for job_id, tag_id, negate in tag_requirements_query:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                if negate:
+                    job.forbidden_tag_bits |= 1 << tag_id
+                else:
+                    job.required_tag_bits |= 1 << tag_id
+
+    def _build_levels(self):
+        for queue in self.queues.values():
+            for child_queue in queue.children:
+                self._update_level(queue, child_queue)
+            for job in queue.jobs:
+                self._update_level(queue, job)
+            queue.priorities = sorted(queue.levels, reverse=True)
+            queue.minimum_queues = sorted(
+                (x for x in queue.children if x.minimum_agents),
+                key=lambda x: x.id)
+            queue.minimum_jobs = [x for x in queue.jobs if
+                                  x.minimum_agents and x.minimum_agents > 0]
+
+    @staticmethod
+    def _update_level(queue, item):
+        """
+        Adds the job or child queue `item` to the :class:`.StrideHeap` for
+        its priority in `queue` or updates it there
+        """
+        level = queue.levels.get(item.priority)
+        if level is None:
+            level = queue.levels[item.priority] = StrideHeap()
+        if item.is_job:
+            level.push((1, item.id), item, item.num_assigned_agents(),
+                       item.weight, item.running(), item.remaining_work())
+        else:
+            level.push((0, item.id), item, item.num_assigned_agents(),
+                       item.weight, True)
+
+    def _load_agents(self, agent_ids):
+        agents_query = db.session.query(
+            Agent.id, Agent.hostname, Agent.ram, Agent.free_ram, Agent.cpus,
+            Agent.ram_allocation, Agent.cpu_allocation, Agent.last_job_id,
+            Agent.last_jobtype_version_id, Agent.last_job_group_id)
+        if agent_ids is not None:
+            agent_ids = list(agent_ids)
+            if not agent_ids:
+                return
+            agents_query = agents_query.filter(Agent.id.in_(agent_ids))
+        else:
+            agents_query = agents_query.filter(
+                Agent.state != AgentState.OFFLINE,
+                Agent.state != AgentState.DISABLED)
+
+        for row in agents_query:
+            agent = SnapshotAgent(*row)
+            agent.affinity.queue_ids = self.queue_path(agent.affinity.job_id)
+            self.agents[row[0]] = agent
+
+        if not self.agents:
+            return
+
+        reservations = Agent.load_reservations(self.agents)
+        for agent_id, reservation in reservations.items():
+            self.agents[agent_id].reservation = reservation
+
+        tags_query = db.session.query(
+            AgentTagAssociation.c.agent_id, AgentTagAssociation.c.tag_id)
+        if agent_ids is not None:
+            tags_query = tags_query.filter(
+                AgentTagAssociation.c.agent_id.in_(agent_ids))
+
+        for agent_id, tag_id in tags_query:
+            agent = self.agents.get(agent_id)
+            if agent is not None:
+                agent.tag_bits |= 1 << tag_id
+
+    def queue_path(self, job_id):
+        """
+        Returns the ids of the queue of the given job and all of its parent
+        queues, or an empty set if the job is not part of this snapshot
+        """
+        queue_ids = set()
+        job = self.jobs.get(job_id)
+        if job is not None:
+            queue = self.queues.get(job.queue_id)
+            while queue is not None and queue is not self.root:
+                queue_ids.add(queue.id)
+                queue = queue.parent
+        return queue_ids
+
+    def satisfies_jobtype_requirements(self, agent, jobtype_version_id):
+        """
+        Snapshot equivalent of :meth:`Agent.satisfies_jobtype_requirements`,
+        answered from the capability index loaded with the snapshot
+        """
+        return jobtype_version_id in self.supported_types.get(agent.id, ())
+
+    def satisfies_job_requirements(self, agent, job):
+        """
+        Snapshot equivalent of :meth:`Agent.satisfies_job_requirements`,
+        including the ram check done by :meth:`JobQueue.get_job_for_agent`
+        """
+        return self.unsatisfied_job_requirement(agent, job) is None
+
+    def unsatisfied_job_requirement(self, agent, job):
+        """
+        Snapshot equivalent of :meth:`Agent.unsatisfied_job_requirement`,
+        returns the reason the job does not fit the agent or None
+        """
+        if job.ram > agent.available_ram():
+            return REJECT_RAM
+
+        if not self.satisfies_jobtype_requirements(
+                agent, job.jobtype_version_id):
+            return REJECT_SOFTWARE
+
+        if agent.cpus < job.cpus:
+            return REJECT_CPUS
+
+        if agent.free_ram < job.ram:
+            return REJECT_RAM
+
+        if not agent.reservation.fits(agent, job):
+            return REJECT_CAPACITY
+
+        if agent.tag_bits & job.required_tag_bits != job.required_tag_bits:
+            return REJECT_TAGS
+
+        if agent.tag_bits & job.forbidden_tag_bits:
+            return REJECT_TAGS
+
+        return None
+
+    def select_job(self, agent_id, unwanted_job_ids=None, queue=None,
+                   trace=NULL_TRACE, jobs_only=False):
+        """
+        Returns the :class:`SnapshotJob` the given agent should work on next
+        or ``None`` if there is nothing suitable.  This follows the same rules
+        as :meth:`JobQueue.get_job_for_agent`.  With `jobs_only` the child
+        queues of `queue` are skipped and only its own jobs are considered.
+        """
+        agent = self.agents.get(agent_id)
+        if agent is None:
+            logger.warning("Agent %s is not part of this scheduler snapshot",
+                           agent_id)
+            return None
+
+        with trace.phase("requirement_checks"):
+            return self._select_job(agent, set(unwanted_job_ids or ()),
+                                    self.root if queue is None else queue,
+                                    {}, trace, jobs_only)
+
+    def _suitable(self, agent, job, unwanted_job_ids, checked, trace):
+        """
+        Returns True if `agent` may work on `job`.  Jobs are only checked
+        once per selection, the results are kept in `checked`.
+        """
+        suitable = checked.get(job.id)
+        if suitable is None:
+            if job.id in unwanted_job_ids:
+                reason = REJECT_UNWANTED
+            else:
+                reason = self.unsatisfied_job_requirement(agent, job)
+            if reason is not None:
+                trace.reject_job(job.id, reason)
+            suitable = checked[job.id] = reason is None
+        return suitable
+
+    def _level_totals(self, agent, level, unwanted_job_ids, checked, trace):
+        """
+        Returns the number of agents and the weight of the active items in
+        `level`, only counting the jobs `agent` may work on
+        """
+        total_assigned = weight_sum = 0
+        for item in level.items():
+            if item.is_job and not self._suitable(
+                    agent, item, unwanted_job_ids, checked, trace):
+                continue
+            total_assigned += item.num_assigned_agents()
+            if not item.is_job or item.running():
+                weight_sum += item.weight
+        return total_assigned, weight_sum
+
+    def _select_job(self, agent, unwanted_job_ids, queue, checked,
+                    trace=NULL_TRACE, jobs_only=False):
+        # Before anything else, enforce minimums
+        for job in queue.minimum_jobs:
+            if not self._suitable(
+                    agent, job, unwanted_job_ids, checked, trace):
+                continue
+            if job.running():
+                if (job.num_assigned_agents() < (job.minimum_agents or 0) and
+                    job.num_assigned_agents() <
+                        (job.maximum_agents or maxsize) and
+                    job.can_use_more_agents()):
+                    return job
+            else:
+                return job
+
+        for child_queue in () if jobs_only else queue.minimum_queues:
+            if (child_queue.num_assigned_agents() <
+                    (child_queue.minimum_agents or 0) and
+                child_queue.num_assigned_agents() <
+                    (child_queue.maximum_agents or maxsize)):
+                job = self._select_job(
+                    agent, unwanted_job_ids, child_queue, checked, trace)
+                if job:
+                    return job
+
+        affinity = agent.affinity
+        max_advantage = affinity.max_advantage()
+
+        # Work through the priorities in descending order
+        for priority in queue.priorities:
+            level = queue.levels[priority]
+
+            # With all weights set and no affinity tolerance the order does
+            # not depend on the totals, otherwise they have to be limited to
+            # the jobs this agent may work on, just like in JobQueue
+            total_assigned = weight_sum = None
+            if level.num_unweighted or max_advantage:
+                total_assigned, weight_sum = self._level_totals(
+                    agent, level, unwanted_job_ids, checked, trace)
+
+            objects = affinity_order(
+                level.ordered(total_assigned, weight_sum),
+                lambda share, x: affinity.sort_key(
+                    share, affinity.score_job(x) if x.is_job
+                    else affinity.score_queue(x.id)),
+                max_advantage)
+
+            selected_job = None
+            for item in objects:
+                if item.is_job:
+                    if not self._suitable(
+                            agent, item, unwanted_job_ids, checked, trace):
+                        continue
+                    if item.running():
+                        if (item.can_use_more_agents() and
+                            item.num_assigned_agents() <
+                                (item.maximum_agents or maxsize)):
+                            if PREFER_RUNNING_JOBS:
+                                return item
+                            elif (selected_job is None or
+                                  selected_job.time_submitted >
+                                    item.time_submitted):
+                                selected_job = item
+                        else:
+                            trace.reject_job(item.id, REJECT_MAX_AGENTS)
+                    elif (selected_job is None or
+                          selected_job.time_submitted > item.time_submitted):
+                        # If this job is not running yet, remember it, but keep
+                        # looking for already running or queued but older jobs
+                        selected_job = item
+                elif jobs_only:
+                    continue
+                elif (item.num_assigned_agents() <
+                        (item.maximum_agents or maxsize)):
+                    job = self._select_job(
+                        agent, unwanted_job_ids, item, checked, trace)
+                    if job:
+                        return job
+                    trace.reject_queue(item.id, REJECT_NO_TASKS)
+                else:
+                    trace.reject_queue(item.id, REJECT_MAX_AGENTS)
+            if selected_job:
+                return selected_job
+
+        return None
+
+    def get_job_for_agent(self, agent, unwanted_job_ids=None,
+                          trace=NULL_TRACE):
+        """
+        Drop-in replacement for :meth:`JobQueue.get_job_for_agent` which
+        returns the selected :class:`Job` model or ``None``
+        """
+        job = self.select_job(agent.id, unwanted_job_ids, trace=trace)
+        if job is None:
+            return None
+        return Job.query.filter_by(id=job.id).first()
+
+    def record_assignment(self, job_id, agent_id, num_tasks):
+        """
+        Updates the counters in this snapshot after ``num_tasks`` tasks from
+        the given job were assigned to an agent.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+
+        # Like in the database, an agent is counted only once for a job and
+        # for a queue, no matter how many of their jobs it works on
+        agent = self.agents.get(agent_id)
+        known_job_ids = set()
+        known_queue_ids = set()
+        if agent is not None:
+            known_job_ids = agent.reservation.job_ids
+            for known_job_id in known_job_ids:
+                known_queue_ids.update(self.queue_path(known_job_id))
+
+        job.unassigned_tasks = max(job.unassigned_tasks - num_tasks, 0)
+        if not job.running():
+            job.state = _WorkState.RUNNING
+        if job.id not in known_job_ids:
+            job.assigned_agents += 1
+        self._update_level(self.queues.get(job.queue_id, self.root), job)
+
+        queue = self.queues.get(job.queue_id)
+        while queue is not None and queue is not self.root:
+            if queue.id not in known_queue_ids:
+                queue.assigned_agents += 1
+            self._update_level(queue.parent, queue)
+            queue = queue.parent
+
+        # Resources on the agent are considered taken until the next snapshot
+        if agent is not None:
+            agent.free_ram -= job.ram
+            agent.reservation.add(job.id, job.cpus, job.ram)
+            agent.affinity = AgentAffinity(
+                job.id, job.jobtype_version_id, job.job_group_id,
+                self.queue_path(job.id))
@@ -0,0 +1,157 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler Speculation
+---------------------
+
+Decides which straggling tasks get a speculative copy on another agent.
+Once a job has no tasks left waiting for an agent, a running task is a
+straggler if it has been running for more than
+``scheduler_speculative_runtime_factor`` times the median runtime of the
+job's finished tasks.  The copy is started on an idle agent by
+:func:`.speculate_tasks` while the original keeps running, whichever
+finishes first wins and the other one is stopped.
+
+The speculative copy is an attempt of its own: :attr:`.Task.attempts` is
+incremented when the copy is started and the copy is sent to its agent with
+that new attempt number, so the logs of the original and of the copy are
+kept apart as logs of different attempts.  If the copy finishes first its
+agent becomes the task's agent.  If it fails, only the copy is dropped and
+the task does not count as failed.  If the original finishes or fails first
+the copy is stopped and the task is handled as usual.
+
+Jobs running their tasks in batches are not considered, because the tasks
+of a batch share the time they were started at.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, and_
+
+from pyfarm.core.logger import getLogger
+from pyfarm.core.enums import WorkState, AgentState
+from pyfarm.models.agent import Agent
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+from pyfarm.models.runtimestatistics import TaskRuntimeStatistics
+from pyfarm.master.config import config
+
+SPECULATION_ENABLED = config.get("scheduler_speculative_execution")
+SPECULATION_RUNTIME_FACTOR = config.get(
+    "scheduler_speculative_runtime_factor")
+SPECULATION_MIN_SAMPLES = config.get("scheduler_speculative_min_samples")
+SPECULATION_MAX_TASKS = config.get("scheduler_speculative_max_tasks")
+
+logger = getLogger("pf.scheduler.speculation")
+
+
+def straggler_threshold(job):
+    """
+    Returns the number of seconds after which a running task of `job` is
+    considered a straggler or None if too few of its tasks have finished to
+    tell
+    """
+    statistics = TaskRuntimeStatistics.for_job(job)
+    if statistics is None or statistics.count < SPECULATION_MIN_SAMPLES:
+        return None
+    return statistics.percentile(50) * SPECULATION_RUNTIME_FACTOR
+
+
+def find_stragglers(now=None):
+    """
+    Returns the running tasks without a speculative copy of all running
+    jobs without tasks waiting for an agent which have been running for
+    longer than their job's :func:`straggler_threshold`, longest running
+    first
+    """
+    now = now or datetime.utcnow()
+    jobs = Job.query.filter(
+        Job.state == WorkState.RUNNING,
+        Job.to_be_deleted == False,
+        Job.batch == 1,
+        ~Job.tasks.any(and_(Task.agent_id == None, Task.state == None)))
+
+    stragglers = []
+    for job in jobs:
+        threshold = straggler_threshold(job)
+        if threshold is None:
+            continue
+
+        stragglers.extend(Task.query.filter(
+            Task.job_id == job.id,
+            Task.state == WorkState.RUNNING,
+            Task.agent_id != None,
+            Task.speculative_agent_id == None,
+            Task.time_started < now - timedelta(seconds=threshold)))
+
+    stragglers.sort(key=lambda x: x.time_started)
+    return stragglers
+
+
+def load_idle_agents():
+    """
+    Returns the agents which have neither tasks nor a speculative copy of a
+    task to work on
+    """
+    return Agent.query.filter(
+        Agent.state.in_([AgentState.ONLINE, AgentState.RUNNING]),
+        ~Agent.tasks.any(or_(Task.state == None,
+                             Task.state == WorkState.RUNNING)),
+        ~Agent.id.in_(Task.speculating_agent_ids())).all()
+
+
+def select_agent(task, idle_agents):
+    """
+    Returns an agent among `idle_agents` which may run a speculative copy of
+    `task` or None if there is none.  The selected agent is removed from
+    `idle_agents`.
+    """
+    job = task.job
+    for agent in idle_agents:
+        if agent.id == task.agent_id or task in agent.failed_tasks:
+            continue
+
+        requirement = agent.unsatisfied_job_requirement(job)
+        if requirement is not None:
+            logger.debug("Agent %s cannot run a copy of task %s: %s",
+                         agent.hostname, task.id, requirement)
+            continue
+
+        idle_agents.remove(agent)
+        return agent
+
+
+def find_stale_speculations():
+    """
+    Returns the tasks whose speculative copy is no longer needed, either
+    because the task is not running anymore or because the agent running
+    the copy went away
+    """
+    stale = []
+    for task in Task.query.filter(Task.speculative_agent_id != None):
+        running = (task.state == WorkState.RUNNING and
+                   task.agent_id is not None)
+        if not running:
+            stale.append(task)
+            continue
+
+        agent = Agent.query.filter_by(id=task.speculative_agent_id).first()
+        if agent is None or agent.state in (AgentState.OFFLINE,
+                                            AgentState.DISABLED):
+            stale.append(task)
+
+    return stale
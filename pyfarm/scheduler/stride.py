@@ -0,0 +1,198 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stride Scheduling
+-----------------
+
+Orders the jobs and queues of equal priority below a queue by how far they
+are below the share of agents their weight entitles them to, without
+sorting all of them for every agent.
+
+Every job or queue has a pass value, the number of agents it has divided by
+its weight.  Jobs and queues with the same pass value have the same share
+relative to their weight, so ordering by pass value is the same as ordering
+by the ratio of the share of agents they have to the share their weight
+entitles them to.  A :class:`StrideHeap` keeps the pass values in a heap
+which is updated whenever agents are assigned to or released from one of
+its items, and :meth:`StrideHeap.ordered` walks the heap lazily, so getting
+the next candidate costs ``O(log n)`` instead of sorting all of them.
+
+Jobs and queues with a weight of 0 are not weighted at all, they are kept
+in a heap of their own which is ordered by the number of agents alone.
+"""
+
+from heapq import heapify, heappush, heappop
+from itertools import count
+
+# Indices into the lists used as heap entries.  The sequence number keeps
+# entries from ever being compared by their items.
+(PASS, REMAINING_WORK, KEY, SEQUENCE, ITEM, ASSIGNED, WEIGHT, ACTIVE,
+ VALID) = range(9)
+
+# Shares calculated from different pass values may differ by rounding errors
+# even though the pass values are equal, so items whose shares are closer
+# than this are sorted by their exact keys
+SHARE_EPSILON = 1e-9
+
+# The remaining work of jobs nothing is known about yet, which puts them
+# after all jobs whose remaining work could be estimated
+UNKNOWN_REMAINING_WORK = float("inf")
+
+
+def fair_share(assigned, weight, total_assigned, weight_sum):
+    """
+    Returns the ratio between the share of ``total_assigned`` agents an item
+    with ``assigned`` agents has and the share its ``weight`` entitles it to
+    among items with a total weight of ``weight_sum``
+    """
+    return (((float(assigned) / total_assigned) if total_assigned else 0) /
+            ((float(weight) / weight_sum) if weight_sum and weight else 1))
+
+
+class StrideHeap(object):
+    """
+    The jobs and queues of one priority below a single queue, ordered by
+    their pass value.  Every item is identified by a unique and sortable
+    key, which also breaks ties between items with the same pass value and
+    remaining work.  :attr:`total_assigned` and :attr:`weight_sum` are kept
+    up to date as items are added and updated.
+    """
+    def __init__(self):
+        self.total_assigned = 0
+        self.weight_sum = 0
+        self.num_unweighted = 0
+        self.entries = {}
+        self.weighted = []
+        self.unweighted = []
+        self.num_stale = 0
+        self.sequence = count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def items(self):
+        return [x[ITEM] for x in self.entries.values()]
+
+    def push(self, key, item, assigned, weight, active, remaining_work=0):
+        """
+        Adds `item` or, if an item with the same `key` was added before,
+        replaces it.
+
+        :param assigned:
+            The number of agents currently working on `item`
+
+        :param active:
+            Whether the weight of `item` counts towards :attr:`weight_sum`,
+            which is not the case for jobs that are not running yet
+
+        :param remaining_work:
+            Breaks ties between items with the same pass value, the item with
+            the least remaining work comes first
+        """
+        old_entry = self.entries.pop(key, None)
+        if old_entry is not None:
+            self.discard(old_entry)
+
+        weight = weight or 0
+        entry = [float(assigned) / weight if weight else assigned,
+                 remaining_work, key, next(self.sequence), item, assigned,
+                 weight, active, True]
+        self.entries[key] = entry
+        self.total_assigned += assigned
+        if active:
+            self.weight_sum += weight
+        if weight:
+            heappush(self.weighted, entry)
+        else:
+            self.num_unweighted += 1
+            heappush(self.unweighted, entry)
+
+        # Updated items leave stale entries behind, get rid of them once
+        # they outnumber the current ones
+        if self.num_stale > len(self.entries):
+            self.weighted = [x for x in self.weighted if x[VALID]]
+            self.unweighted = [x for x in self.unweighted if x[VALID]]
+            heapify(self.weighted)
+            heapify(self.unweighted)
+            self.num_stale = 0
+
+    def discard(self, entry):
+        entry[VALID] = False
+        self.num_stale += 1
+        self.total_assigned -= entry[ASSIGNED]
+        if entry[ACTIVE]:
+            self.weight_sum -= entry[WEIGHT]
+        if not entry[WEIGHT]:
+            self.num_unweighted -= 1
+
+    def ordered(self, total_assigned=None, weight_sum=None):
+        """
+        Yields ``(share, remaining_work, key, item)`` tuples for all items,
+        ordered by their :func:`fair_share` and then by remaining work and
+        key.  The shares are calculated with :attr:`total_assigned` and
+        :attr:`weight_sum` unless other totals are given.  The heaps are
+        walked lazily and must not be changed while iterating.
+        """
+        if total_assigned is None:
+            total_assigned = self.total_assigned
+        if weight_sum is None:
+            weight_sum = self.weight_sum
+
+        # The children of an entry in a heap never come before the entry
+        # itself, so only the entries whose parents were already yielded
+        # have to be looked at
+        heaps = (self.weighted, self.unweighted)
+        frontier = []
+
+        def add(heap_index, index):
+            heap = heaps[heap_index]
+            if index < len(heap):
+                entry = heap[index]
+                heappush(frontier, (
+                    fair_share(entry[ASSIGNED], entry[WEIGHT],
+                               total_assigned, weight_sum),
+                    entry[REMAINING_WORK], entry[KEY], heap_index, index))
+
+        add(0, 0)
+        add(1, 0)
+        while frontier:
+            share, remaining_work, key, heap_index, index = heappop(frontier)
+            add(heap_index, 2 * index + 1)
+            add(heap_index, 2 * index + 2)
+            entry = heaps[heap_index][index]
+            if entry[VALID]:
+                yield share, remaining_work, key, entry[ITEM]
+
+
+def affinity_order(shares, sort_key, max_advantage=0):
+    """
+    Yields the items from `shares`, as produced by
+    :meth:`StrideHeap.ordered`, ordered by ``sort_key(share, item)``, then
+    by their remaining work and key.  `sort_key` may place an item at most
+    `max_advantage` below its share, so only the items within that distance
+    of the share of the next item have to be held back.
+    """
+    pending = []
+    for share, remaining_work, key, item in shares:
+        while (pending and
+               pending[0][0][0] < share - max_advantage - SHARE_EPSILON):
+            yield heappop(pending)[1]
+        heappush(pending, (
+            tuple(sort_key(share, item)) + (remaining_work, key), item))
+
+    while pending:
+        yield heappop(pending)[1]
@@ -24,17 +24,16 @@ This module contains various asynchronous tasks to be run by celery.
 
 from datetime import timedelta, datetime
 from logging import DEBUG
-from json import dumps
 from smtplib import SMTP
 from email.mime.text import MIMEText
-from time import time, sleep
 from os.path import isfile, join
 from os import remove, listdir
 from errno import ENOENT
 from gzip import GzipFile
 from uuid import UUID
 
-from sqlalchemy import or_, desc
+from sqlalchemy import or_, and_, desc, func, distinct
+from sqlalchemy.orm import aliased
 from sqlalchemy.exc import InvalidRequestError
 
 import requests
@@ -44,8 +43,6 @@ from requests.packages.urllib3.exceptions import ProtocolError
 
 from jinja2 import Template
 
-from lockfile import LockFile, AlreadyLocked
-
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import (
     AgentState, _AgentState, WorkState, _WorkState, UseAgentAddress)
@@ -56,7 +53,7 @@ from pyfarm.models.software import (
 from pyfarm.models.tag import Tag
 from pyfarm.models.task import Task
 from pyfarm.models.tasklog import TaskLog, TaskTaskLogAssociation
-from pyfarm.models.job import Job, JobNotifiedUser
+from pyfarm.models.job import Job, JobNotifiedUser, JobDependency
 from pyfarm.models.jobqueue import JobQueue
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.gpu import GPU
@@ -65,10 +62,27 @@ from pyfarm.models.agent import Agent, AgentTagAssociation
 from pyfarm.models.user import User, Role
 from pyfarm.models.jobgroup import JobGroup
 from pyfarm.master.application import db
-from pyfarm.master.utility import default_json_encoder
 from pyfarm.master.config import config
 
 from pyfarm.scheduler.celery_app import celery_app
+from pyfarm.scheduler.agentclient import get_agent_client
+from pyfarm.scheduler.snapshot import SchedulerSnapshot
+from pyfarm.scheduler.locks import get_lock, renew_locks
+from pyfarm.scheduler.tracing import NULL_TRACE, start_trace
+from pyfarm.scheduler.payloads import get_payloads
+from pyfarm.scheduler.poller import (
+    BULK_POLL_ENABLED, PollTarget, poll_concurrently, apply_results)
+from pyfarm.scheduler.preemption import (
+    PREEMPTION_ENABLED, PREEMPTION_MAX_AGENTS, find_starving_jobs,
+    load_busy_agents, select_victims, hand_over)
+from pyfarm.scheduler.sharding import (
+    SHARDING_ENABLED, ROOT_SHARD, partition_agents, shard_queue, get_lease)
+from pyfarm.scheduler.speculation import (
+    SPECULATION_ENABLED, SPECULATION_MAX_TASKS, find_stragglers,
+    load_idle_agents, select_agent, find_stale_speculations)
+from pyfarm.scheduler.triggers import (
+    TRIGGER_DELAY, request_scheduling, pop_triggers, has_pending_triggers,
+    affected_agent_ids)
 
 
 try:
@@ -80,16 +94,17 @@ logger = getLogger("pf.scheduler.tasks")
 # TODO Get logger configuration from pyfarm config
 logger.setLevel(DEBUG)
 
-USERAGENT = config.get("master_user_agent")
 POLL_BUSY_AGENTS_INTERVAL = timedelta(**config.get("poll_busy_agents_interval"))
 POLL_IDLE_AGENTS_INTERVAL = timedelta(**config.get("poll_idle_agents_interval"))
 POLL_OFFLINE_AGENTS_INTERVAL = \
     timedelta(**config.get("poll_offline_agents_interval"))
-SCHEDULER_LOCKFILE_BASE = config.get("scheduler_lockfile_base")
+AGENT_HEARTBEAT_TIMEOUT = timedelta(**config.get("agent_heartbeat_timeout"))
 LOGFILES_DIR = config.get("tasklogs_dir")
 TRANSACTION_RETRIES = config.get("transaction_retries")
-AGENT_REQUEST_TIMEOUT = config.get("agent_request_timeout")
 BASE_URL = config.get("base_url")
+USE_SCHEDULER_SNAPSHOT = config.get("scheduler_use_snapshot")
+BATCH_ASSIGN_TASKS = config.get("scheduler_batch_assign")
+MULTI_SLOT = config.get("scheduler_multi_slot")
 
 # Email settings
 SMTP_SERVER = config.get("smtp_server")
@@ -121,6 +136,18 @@ def send_email(to, message):
         smtp.quit()
 
 
+def remove_assignment(task, agent_id):
+    """
+    Removes the assignment of `task` to `agent_id`, which may also be the
+    agent running a speculative copy of it
+    """
+    if task.speculative_agent_id == agent_id:
+        task.end_speculation()
+    else:
+        task.agent = None
+    task.attempts -= 1
+
+
 @celery_app.task(ignore_result=True, bind=True)
 def send_tasks_to_agent(self, agent_id):
     db.session.rollback()
@@ -139,7 +166,8 @@ def send_tasks_to_agent(self, agent_id):
         return
 
     tasks_query = Task.query.filter(
-        Task.agent == agent, or_(
+        or_(Task.agent == agent,
+            Task.speculative_agent_id == agent.id), or_(
             Task.state == None,
             ~Task.state.in_(
                 [WorkState.DONE, WorkState.FAILED]))).order_by("frame asc")
@@ -154,41 +182,13 @@ def send_tasks_to_agent(self, agent_id):
                      agent.id)
         return
 
+    payloads = get_payloads(list(tasks_in_jobs))
     for job_id, tasks in tasks_in_jobs.items():
-        job = Job.query.filter_by(id=job_id).first()
-        message = {"job": {"id": job.id,
-                           "title": job.title,
-                           "data": job.data if job.data else {},
-                           "environ": job.environ if job.environ else {},
-                           "by": job.by,
-                           "batch": job.batch,
-                           "ram": job.ram,
-                           "ram_warning": job.ram_warning,
-                           "ram_max": job.ram_max,
-                           "cpus": job.cpus,
-                           "notified_users": [],
-                           "priority": job.priority,
-                           "notes": job.notes,
-                           "tags": [],
-                           "num_tiles": job.num_tiles
-                           },
-                   "jobtype": {"name": job.jobtype_version.jobtype.name,
-                               "version": job.jobtype_version.version},
+        job_payload, jobtype_payload = payloads[job_id]
+        message = {"job": job_payload,
+                   "jobtype": jobtype_payload,
                    "tasks": []}
 
-        if job.user:
-            message["job"]["user"] = job.user.username
-
-        for notified_user in job.notified_users:
-            message["job"]["notified_users"].append(
-                {"username": notified_user.user.username,
-                 "on_success": notified_user.on_success,
-                 "on_failure": notified_user.on_failure,
-                 "on_deletion": notified_user.on_deletion})
-
-        for tag in job.tags:
-            message["job"]["tags"].append(tag.tag)
-
         for task in tasks:
             message["tasks"].append({"id": task.id,
                                      "frame": task.frame,
@@ -196,15 +196,9 @@ def send_tasks_to_agent(self, agent_id):
                                      "tile": task.tile})
 
         logger.info("Sending a batch of %s tasks for job %s (%s) to agent %s",
-                    len(tasks), job.title, job.id, agent.hostname)
+                    len(tasks), job_payload["title"], job_id, agent.hostname)
         try:
-            response = requests.post(agent.api_url() + "/assign",
-                                     data=dumps(message,
-                                                default=default_json_encoder),
-                                     headers={
-                                         "Content-Type": "application/json",
-                                         "User-Agent": USERAGENT},
-                                     timeout=AGENT_REQUEST_TIMEOUT)
+            response = get_agent_client().post(agent, "/assign", message)
 
             logger.debug("Return code after sending batch to agent: %s",
                          response.status_code)
@@ -222,16 +216,14 @@ def send_tasks_to_agent(self, agent_id):
                     agent.state = AgentState.OFFLINE
                     db.session.add(agent)
                     for task in tasks:
-                        task.agent = None
-                        task.attempts -= 1
+                        remove_assignment(task, agent.id)
                         db.session.add(task)
                     db.session.commit()
             elif response.status_code == requests.codes.bad_request:
                 logger.error("Agent %s, (id %s), answered BAD_REQUEST, "
                              "removing assignment", agent.hostname, agent.id)
                 for task in tasks:
-                    task.agent = None
-                    task.attempts -= 1
+                    remove_assignment(task, agent.id)
                     db.session.add(task)
                 db.session.commit()
             elif response.status_code == requests.codes.conflict:
@@ -248,11 +240,10 @@ def send_tasks_to_agent(self, agent_id):
                                          "(id %s)", task_id, task.frame,
                                          task.job.title, agent.hostname,
                                          agent.id)
-                            task.agent = None
-                            task.attempts -= 1
+                            remove_assignment(task, agent.id)
                             db.session.add(task)
                     db.session.flush()
-                    job.update_state()
+                    Job.query.filter_by(id=job_id).one().update_state()
                     db.session.commit()
                 else:
                     logger.error("CONFLICT response from agent %s (id %s) did "
@@ -312,11 +303,7 @@ def restart_agent(self, agent_id):
 
     logger.info("Restarting agent %s (id %s)", agent.hostname, agent.id)
     try:
-        response = requests.post(agent.api_url() + "/restart",
-                                    data=dumps({}),
-                                    headers={
-                                        "User-Agent": USERAGENT},
-                                    timeout=AGENT_REQUEST_TIMEOUT)
+        response = get_agent_client().post(agent, "/restart", {})
 
         logger.debug("Return code after sending restart to agent: %s",
                         response.status_code)
@@ -351,164 +338,485 @@ def restart_agent(self, agent_id):
 
 
 @celery_app.task(ignore_result=True)
-def assign_tasks():
-    db.session.rollback()
-    idle_agents = Agent.query.filter(or_(Agent.state == AgentState.ONLINE,
-                                         Agent.state == AgentState.RUNNING),
-                                     ~Agent.tasks.any(
-                                        or_(
-                                        Task.state == None,
-                                        ~Task.state.in_(
-                                            [WorkState.DONE,
-                                             WorkState.FAILED]))))
+def assign_tasks(triggered=False):
+    """
+    Starts assigning work to idle agents.  Periodic runs consider all idle
+    agents, runs started by :func:`.request_scheduling` (``triggered``) only
+    those affected by the pending triggers.  Only one run happens at a time.
+    """
+    run_lock = get_lock("assign-tasks")
+    if not run_lock.acquire():
+        logger.debug("assign_tasks is already running")
+        if not triggered:
+            # Make sure the run in progress is followed by a full one
+            request_scheduling()
+        return
 
-    for agent in idle_agents:
-        assign_tasks_to_agent.delay(agent.id)
+    try:
+        triggers = pop_triggers()
+        if triggered and triggers is None:
+            return
+
+        db.session.rollback()
+        if MULTI_SLOT:
+            agents = db.session.query(
+                Agent.id, Agent.cpus, Agent.ram, Agent.cpu_allocation,
+                Agent.ram_allocation).filter(
+                    or_(Agent.state == AgentState.ONLINE,
+                        Agent.state == AgentState.RUNNING)).all()
+            reservations = Agent.load_reservations(x.id for x in agents)
+            idle_agent_ids = [x.id for x in agents
+                              if reservations[x.id].has_capacity(x)]
+        else:
+            idle_agent_ids = [x[0] for x in db.session.query(Agent.id).filter(
+                or_(Agent.state == AgentState.ONLINE,
+                    Agent.state == AgentState.RUNNING),
+                ~Agent.tasks.any(or_(Task.state == None,
+                                     ~Task.state.in_([WorkState.DONE,
+                                                      WorkState.FAILED]))),
+                ~Agent.id.in_(Task.speculating_agent_ids()))]
+
+        if triggered and triggers != (None, None):
+            agent_ids, queue_ids = triggers
+            affected = affected_agent_ids(idle_agent_ids, agent_ids, queue_ids)
+            db.session.commit()
+            logger.debug("Triggered run for %s of %s idle agents",
+                         len(affected), len(idle_agent_ids))
+            idle_agent_ids = [x for x in idle_agent_ids if x in affected]
 
+        if not idle_agent_ids:
+            return
 
-@celery_app.task(ignore_result=True)
-def assign_tasks_to_agent(agent_id):
-    agent_lockfile_name = SCHEDULER_LOCKFILE_BASE + "-" + str(agent_id)
-    agent_lock = LockFile(agent_lockfile_name)
+        if SHARDING_ENABLED:
+            snapshot = SchedulerSnapshot.load(agent_ids=idle_agent_ids)
+            db.session.commit()
+            for shard, agent_ids in partition_agents(
+                    snapshot, idle_agent_ids).items():
+                assign_tasks_batch.delay(agent_ids, shard=shard)
+        elif BATCH_ASSIGN_TASKS:
+            assign_tasks_batch.delay(idle_agent_ids)
+        else:
+            for agent_id in idle_agent_ids:
+                assign_tasks_to_agent.delay(agent_id)
+    finally:
+        run_lock.release()
+
+        # Triggers created while this run was in progress may have relied on
+        # it to start the next one
+        if has_pending_triggers():
+            assign_tasks.apply_async(kwargs={"triggered": True},
+                                     countdown=TRIGGER_DELAY)
 
+
+@celery_app.task(ignore_result=True)
+def assign_tasks_batch(agent_ids, shard=None):
+    """
+    Matches all of the given agents to jobs in one pass over a single
+    :class:`.SchedulerSnapshot` and commits all of the resulting assignments
+    in one transaction.  Agents which are currently being handled by
+    :func:`assign_tasks_to_agent` are skipped instead of waited for.
+
+    :param shard:
+        Only assign work from the jobs of this shard, see
+        :mod:`pyfarm.scheduler.sharding`.  The lease of the shard is held
+        while doing so.  If another worker holds it, the agents are handed
+        back to the scheduler.
+    """
+    lease = None
+    if shard is not None:
+        lease = get_lease(shard)
+        if not lease.acquire():
+            logger.debug("The lease for shard %s is held by another worker",
+                         shard)
+            request_scheduling(agent_ids=agent_ids)
+            return
+
+    agent_locks = {}
+    job_locks = {}
     try:
-        agent_lock.acquire(timeout=-1)
-        with agent_lock:
-            with open(agent_lockfile_name, "w") as lockfile:
-                lockfile.write(str(time()))
+        for agent_id in agent_ids:
+            agent_lock = get_lock("agent-%s" % agent_id)
+            if not agent_lock.acquire():
+                logger.debug("The scheduler lock for agent %s is held, "
+                             "skipping it in this batch", agent_id)
+                continue
+            agent_locks[agent_id] = agent_lock
+
+        if not agent_locks:
+            return
+
+        db.session.rollback()
+
+        # Check again now that we hold the locks, the agents might have gotten
+        # work since the list of idle agents was built.  With multiple slots
+        # per agent, the snapshot takes care of the agents' capacity.
+        agents_query = Agent.query.filter(
+            Agent.id.in_(list(agent_locks)),
+            or_(Agent.state == AgentState.ONLINE,
+                Agent.state == AgentState.RUNNING))
+        if not MULTI_SLOT:
+            agents_query = agents_query.filter(
+                ~Agent.tasks.any(or_(Task.state == None,
+                                     Task.state == WorkState.RUNNING)),
+                ~Agent.id.in_(Task.speculating_agent_ids()))
+        agents = agents_query.order_by(Agent.id).all()
+        if not agents:
+            return
+
+        snapshot = SchedulerSnapshot.load(agent_ids=[x.id for x in agents])
+        queue = None
+        if shard is not None:
+            queue = shard_queue(snapshot, shard)
+            if queue is None:
+                logger.debug("Shard %s does not exist anymore", shard)
+                return
 
+        # The batch may take longer than the locks live, they are renewed
+        # for every agent.  If one of them was lost already, somebody else
+        # may be assigning the same agents or tasks, so the batch is dropped.
+        def locks_held():
+            locks = list(agent_locks.values()) + list(job_locks.values())
+            if lease is not None:
+                locks.append(lease)
+            if renew_locks(locks):
+                return True
             db.session.rollback()
-
-            agent = Agent.query.filter_by(id=agent_id).first()
-            if not agent:
-                raise ValueError("No agent with id %s" % agent_id)
-            if agent.state == _AgentState.OFFLINE:
-                raise ValueError("Agent %s (id %s) is offline" %
-                                 (agent.hostname, agent_id))
-            if agent.state == _AgentState.DISABLED:
-                raise ValueError("Agent %s (id %s) is disabled" %
-                                 (agent.hostname, agent_id))
-
-            task_count = Task.query.filter(Task.agent == agent,
-                                        or_(Task.state == None,
-                                            Task.state == WorkState.RUNNING)).\
-                                                order_by(Task.job_id,
-                                                         Task.frame).\
-                                                    count()
-            if task_count > 0:
-                logger.debug("Agent %s already has %s tasks assigned, not "
-                             "assigning any more", agent.hostname, task_count)
+            logger.error("Lost a scheduler lock, discarding the assignments "
+                         "of this batch")
+            request_scheduling(agent_ids=[x.id for x in agents])
+            return False
+
+        jobs = {}
+        assigned_agent_ids = []
+        for agent in agents:
+            if not locks_held():
                 return
+            unwanted_job_ids = []
+            while True:
+                selected = snapshot.select_job(
+                    agent.id, unwanted_job_ids, queue,
+                    jobs_only=shard == ROOT_SHARD)
+                if selected is None:
+                    logger.debug("Did not find a job for agent %s",
+                                 agent.hostname)
+                    break
+
+                if selected.id not in job_locks:
+                    job_lock = get_lock("job-%s" % selected.id)
+                    if not job_lock.acquire():
+                        logger.debug("The lock for job %s is held, skipping "
+                                     "it", selected.id)
+                        unwanted_job_ids.append(selected.id)
+                        continue
+                    job_locks[selected.id] = job_lock
+
+                if selected.id not in jobs:
+                    jobs[selected.id] = Job.query.filter_by(
+                        id=selected.id).first()
+                job = jobs[selected.id]
+
+                batch = job.get_batch(agent) if job else None
+                if not batch:
+                    unwanted_job_ids.append(selected.id)
+                    continue
+
+                for task in batch:
+                    task.agent = agent
+                    task.sent_to_agent = False
+                    logger.info("Assigned agent %s (id %s) to task %s (frame "
+                                "%s) from job %s (id %s)", agent.hostname,
+                                agent.id, task.id, task.frame, job.title,
+                                job.id)
+                    db.session.add(task)
+
+                if job.state != _WorkState.RUNNING:
+                    job.state = WorkState.RUNNING
+                    db.session.add(job)
+                agent.record_assignment(job)
+                db.session.add(agent)
+                snapshot.record_assignment(job.id, agent.id, len(batch))
+                if agent.id not in assigned_agent_ids:
+                    assigned_agent_ids.append(agent.id)
+                if not MULTI_SLOT:
+                    break
+
+        if not locks_held():
+            return
+        db.session.commit()
+        logger.info("Assigned work to %s of %s agents in one batch",
+                    len(assigned_agent_ids), len(agents))
+
+        for agent_id in assigned_agent_ids:
+            send_tasks_to_agent.delay(agent_id)
+
+    finally:
+        for job_lock in job_locks.values():
+            job_lock.release()
+        for agent_lock in agent_locks.values():
+            agent_lock.release()
+        if lease is not None:
+            lease.release()
+
+
+@celery_app.task(ignore_result=True)
+def assign_tasks_to_agent(agent_id):
+    agent_lock = get_lock("agent-%s" % agent_id)
+    if not agent_lock.acquire():
+        logger.debug("The scheduler lock for agent %s is held, the scheduler "
+                     "seems to already be running for it", agent_id)
+        return
 
+    trace = NULL_TRACE
+    try:
+        db.session.rollback()
+
+        agent = Agent.query.filter_by(id=agent_id).first()
+        if not agent:
+            raise ValueError("No agent with id %s" % agent_id)
+        if agent.state == _AgentState.OFFLINE:
+            raise ValueError("Agent %s (id %s) is offline" %
+                             (agent.hostname, agent_id))
+        if agent.state == _AgentState.DISABLED:
+            raise ValueError("Agent %s (id %s) is disabled" %
+                             (agent.hostname, agent_id))
+        agent.clear_scheduling_cache()
+
+        task_count = Task.query.filter(Task.agent == agent,
+                                       or_(Task.state == None,
+                                           Task.state == WorkState.RUNNING)).\
+                                            order_by(Task.job_id,
+                                                     Task.frame).\
+                                                count()
+        task_count += Task.query.filter(
+            Task.speculative_agent_id == agent.id).count()
+        if task_count > 0 and not MULTI_SLOT:
+            logger.debug("Agent %s already has %s tasks assigned, not "
+                         "assigning any more", agent.hostname, task_count)
+            return
+
+        trace = start_trace(agent.id)
+        if USE_SCHEDULER_SNAPSHOT:
+            with trace.phase("candidate_query"):
+                queue = SchedulerSnapshot.load(agent_ids=[agent.id])
+        else:
             queue = JobQueue()
-            unwanted_job_ids = []
-            assigned_job = False
-            while not assigned_job:
-                job = queue.get_job_for_agent(agent, unwanted_job_ids)
+        unwanted_job_ids = []
+        assigned_tasks = {}
+        while True:
+            job = queue.get_job_for_agent(agent, unwanted_job_ids, trace)
+            with trace.phase("commit"):
                 db.session.commit()
 
-                if not job:
+            if not job:
+                if not assigned_tasks:
                     logger.debug("Did not find a job for agent %s",
                                  agent.hostname)
-                    return
+                break
+
+            job_lock = get_lock("job-%s" % job.id)
+            if not job_lock.acquire():
+                # Somebody else is working on this job right now, so do not
+                # wait for it and try the next best job instead
+                logger.debug("The lock for job %s is held, skipping it",
+                             job.id)
+                unwanted_job_ids.append(job.id)
+                continue
+
+            try:
+                with trace.phase("batch_selection"):
+                    batch = job.get_batch(agent)
+                if batch:
+                    for task in batch:
+                        task.agent = agent
+                        task.sent_to_agent = False
+                        logger.info("Assigned agent %s (id %s) to task "
+                                    "%s (frame %s) from job %s (id %s)",
+                                    agent.hostname, agent.id, task.id,
+                                    task.frame, job.title, job.id)
+                        db.session.add(task)
 
-                job_lockfile_name = SCHEDULER_LOCKFILE_BASE + "-job-" +\
-                    str(job.id)
-                job_lock = LockFile(job_lockfile_name)
-                try:
-                    job_lock.acquire(timeout=-1)
-                    with job_lock:
-                        with open(job_lockfile_name, "w") as lockfile:
-                             lockfile.write(str(time()))
-
-                        batch = job.get_batch(agent)
-                        if batch:
-                            for task in batch:
-                                task.agent = agent
-                                task.sent_to_agent = False
-                                logger.info("Assigned agent %s (id %s) to task "
-                                            "%s (frame %s) from job %s (id %s)",
-                                            agent.hostname, agent.id, task.id,
-                                            task.frame, job.title, job.id)
-                                db.session.add(task)
-
-                            if job.state != _WorkState.RUNNING:
-                                job.state = WorkState.RUNNING
-                                db.session.add(job)
-                            job.clear_assigned_counts()
-                            db.session.commit()
-                            assigned_job = True
-
-                            send_tasks_to_agent.delay(agent.id)
-                        else:
-                            unwanted_job_ids.append(job.id)
-                except AlreadyLocked:
-                    logger.debug("The lockfile for job %s is locked", job.id)
-                    try:
-                        with open(job_lockfile_name, "r") as lockfile:
-                            locktime = float(lockfile.read())
-                            if locktime < time() - 60:
-                                logger.error("The old lock on job %s was held "
-                                             "for more than 60 seconds. "
-                                             "Breaking the lock.", job.id)
-                                job_lock.break_lock()
-                            assign_tasks_to_agent.apply_async(args=[agent_id],
-                                                              countdown=1)
-                    except (IOError, OSError, ValueError) as e:
-                        logger.warning("Could not read a time value from the "
-                                       "lockfile for job %s. Waiting 1 second "
-                                       "before trying again. Error: %s",
-                                       job.id, e)
-                        sleep(1)
-                    try:
-                        with open(job_lockfile_name, "r") as lockfile:
-                            locktime = float(lockfile.read())
-                            if locktime < time() - 60:
-                                logger.error("The old lock on job %s was held "
-                                             "for more than 60 seconds. "
-                                             "Breaking the lock.", job.id)
-                                agent_lock.break_lock()
-                            assign_tasks_to_agent.apply_async(args=[agent_id],
-                                                              countdown=1)
-                            return
-                    except(IOError, OSError, ValueError):
-                        logger.error("Could not read a time value from the "
-                                     "lockfile even after waiting 1s. Breaking "
-                                     "the lock.")
-                        agent_lock.break_lock()
-                        assign_tasks_to_agent.delay(agent_id)
-                        return
-
-    except AlreadyLocked:
-        logger.debug("The scheduler lockfile is locked, the scheduler seems to "
-                     "already be running for agent %s", agent_id)
-        try:
-            with open(agent_lockfile_name, "r") as lockfile:
-                locktime = float(lockfile.read())
-                if locktime < time() - 60:
-                    logger.error("The old lock was held for more than 60 "
-                                 "seconds. Breaking the lock.")
-                    agent_lock.break_lock()
-        except (IOError, OSError, ValueError) as e:
-            # It is possible that we tried to read the file in the narrow window
-            # between lock acquisition and actually writing the time
-            logger.warning("Could not read a time value from the scheduler "
-                           "lockfile. Waiting 1 second before trying again. "
-                           "Error: %s", e)
-            sleep(1)
-        try:
-            with open(agent_lockfile_name, "r") as lockfile:
-                locktime = float(lockfile.read())
-                if locktime < time() - 60:
-                    logger.error("The old lock was held for more than 60 "
-                                 "seconds. Breaking the lock.")
-                    agent_lock.break_lock()
-        except(IOError, OSError, ValueError):
-            # If we still cannot read a time value from the file after 1s,
-            # there was something wrong with the process holding the lock
-            logger.error("Could not read a time value from the scheduler "
-                         "lockfile even after waiting 1s. Breaking the lock")
-            agent_lock.break_lock()
+                    if job.state != _WorkState.RUNNING:
+                        job.state = WorkState.RUNNING
+                        db.session.add(job)
+                    agent.record_assignment(job)
+                    db.session.add(agent)
+                    job_id, job_cpus, job_ram = job.id, job.cpus, job.ram
+                    with trace.phase("commit"):
+                        db.session.commit()
+                    assigned_tasks[job_id] = len(batch)
+
+                    # The next job has to fit next to this one
+                    if USE_SCHEDULER_SNAPSHOT:
+                        queue.record_assignment(job_id, agent.id, len(batch))
+                    else:
+                        agent.get_reservation().add(job_id, job_cpus, job_ram)
+                    if not MULTI_SLOT:
+                        break
+                else:
+                    unwanted_job_ids.append(job.id)
+            finally:
+                job_lock.release()
+
+        if assigned_tasks:
+            trace.finish(job_ids=sorted(assigned_tasks),
+                         tasks=sum(assigned_tasks.values()))
+            send_tasks_to_agent.delay(agent.id)
+    finally:
+        trace.finish(job_ids=[], tasks=0)
+        agent_lock.release()
+
+
+@celery_app.task(ignore_result=True)
+def preempt_tasks():
+    """
+    Stops and requeues the tasks of lower priority jobs on up to
+    ``scheduler_preemption_max_agents`` busy agents so that starving jobs of
+    higher priority can run on them.  Does nothing unless
+    ``scheduler_preemption`` is enabled.
+    """
+    if not PREEMPTION_ENABLED:
+        return
+
+    run_lock = get_lock("preempt-tasks")
+    if not run_lock.acquire():
+        logger.debug("preempt_tasks is already running")
+        return
+
+    try:
+        db.session.rollback()
+        starving_jobs = find_starving_jobs()
+        if not starving_jobs:
+            return
+
+        idle_agents = Agent.query.filter(
+            or_(Agent.state == AgentState.ONLINE,
+                Agent.state == AgentState.RUNNING),
+            ~Agent.tasks.any(or_(Task.state == None,
+                                 ~Task.state.in_([WorkState.DONE,
+                                                  WorkState.FAILED])))).all()
+        busy_agents = load_busy_agents()
+
+        victims = []
+        for job, deficit in starving_jobs:
+            budget = PREEMPTION_MAX_AGENTS - len(victims)
+            if budget <= 0:
+                break
+
+            # The regular scheduler will hand this job to an idle agent
+            if any(x.satisfies_job_requirements(job) for x in idle_agents):
+                continue
+
+            for agent_id in select_victims(
+                    job, min(deficit, budget), busy_agents):
+                victims.append((agent_id, job.id))
+
+        stopped_tasks = []
+        preempted_agent_ids = []
+        for agent_id, job_id in victims:
+            agent_lock = get_lock("agent-%s" % agent_id)
+            if not agent_lock.acquire():
+                logger.debug("Agent %s is being handled by another worker, "
+                             "not preempting it", agent_id)
+                continue
+            job_lock = get_lock("job-%s" % job_id)
+            if not job_lock.acquire():
+                logger.debug("The lock for job %s is held, not preempting "
+                             "agent %s for it", job_id, agent_id)
+                agent_lock.release()
+                continue
+            try:
+                agent = Agent.query.filter_by(id=agent_id).one()
+                job = Job.query.filter_by(id=job_id).one()
+                stopped_task_ids = hand_over(agent, job)
+                if stopped_task_ids is None:
+                    logger.debug("Job %s has no tasks left for agent %s, not "
+                                 "preempting it", job_id, agent_id)
+                    db.session.rollback()
+                    continue
+
+                logger.info("Preempted agent %s in favour of job %s (%s)",
+                            agent_id, job.id, job.title)
+                db.session.commit()
+                stopped_tasks.extend((x, agent_id) for x in stopped_task_ids)
+                preempted_agent_ids.append(agent_id)
+            finally:
+                job_lock.release()
+                agent_lock.release()
+
+        for task_id, agent_id in stopped_tasks:
+            stop_task.delay(task_id, agent_id, dissociate_agent=False)
+
+        for agent_id in preempted_agent_ids:
+            send_tasks_to_agent.delay(agent_id)
+    finally:
+        run_lock.release()
+
+
+@celery_app.task(ignore_result=True)
+def speculate_tasks():
+    """
+    Starts speculative copies of up to ``scheduler_speculative_max_tasks``
+    straggling tasks on idle agents and stops copies which are no longer
+    needed.  Does nothing unless ``scheduler_speculative_execution`` is
+    enabled.
+    """
+    if not SPECULATION_ENABLED:
+        return
+
+    run_lock = get_lock("speculate-tasks")
+    if not run_lock.acquire():
+        logger.debug("speculate_tasks is already running")
+        return
+
+    try:
+        db.session.rollback()
+        stopped_tasks = []
+        for task in find_stale_speculations():
+            logger.info("Dropping speculative copy of task %s on agent %s",
+                        task.id, task.speculative_agent_id)
+            stopped_tasks.append((task.id, task.end_speculation()))
+            db.session.add(task)
+        db.session.commit()
+
+        for task_id, agent_id in stopped_tasks:
+            stop_task.delay(task_id, agent_id, dissociate_agent=False)
+
+        stragglers = find_stragglers()
+        if not stragglers:
+            return
+
+        idle_agents = load_idle_agents()
+        speculating_agent_ids = []
+        for task in stragglers:
+            if (not idle_agents or
+                    len(speculating_agent_ids) >= SPECULATION_MAX_TASKS):
+                break
+
+            agent = select_agent(task, idle_agents)
+            if agent is None:
+                continue
+
+            agent_lock = get_lock("agent-%s" % agent.id)
+            if not agent_lock.acquire():
+                logger.debug("Agent %s is being handled by another worker, "
+                             "not using it for speculation", agent.id)
+                continue
+            try:
+                logger.info("Starting a speculative copy of task %s (frame "
+                            "%s) from job %s (id %s) on agent %s (id %s)",
+                            task.id, task.frame, task.job.title, task.job_id,
+                            agent.hostname, agent.id)
+                task.start_speculation(agent.id)
+                db.session.add(task)
+                db.session.commit()
+                speculating_agent_ids.append(agent.id)
+            finally:
+                agent_lock.release()
+
+        for agent_id in speculating_agent_ids:
+            send_tasks_to_agent.delay(agent_id)
+    finally:
+        run_lock.release()
 
 
 @celery_app.task(ignore_results=True, bind=True)
@@ -536,10 +844,7 @@ def poll_agent(self, agent_id):
 
     try:
         logger.info("Polling agent %s", agent.hostname)
-        status_response = requests.get(
-            agent.api_url() + "/status",
-            headers={"User-Agent": USERAGENT},
-            timeout=AGENT_REQUEST_TIMEOUT)
+        status_response = get_agent_client().get(agent, "/status")
 
         if status_response.status_code != requests.codes.ok:
             raise ValueError(
@@ -567,10 +872,7 @@ def poll_agent(self, agent_id):
         agent.state = status_json["state"]
         agent.free_ram = status_json["free_ram"]
 
-        tasks_response = requests.get(
-            agent.api_url() + "/tasks/",
-            headers={"User-Agent": USERAGENT},
-            timeout=AGENT_REQUEST_TIMEOUT)
+        tasks_response = get_agent_client().get(agent, "/tasks/")
 
         if tasks_response.status_code != requests.codes.ok:
             raise ValueError(
@@ -617,7 +919,8 @@ def poll_agent(self, agent_id):
     else:
         present_task_ids = [x["id"] for x in tasks_json]
         assigned_task_ids = db.session.query(Task.id).filter(
-            Task.agent == agent,
+            or_(Task.agent == agent,
+                Task.speculative_agent_id == agent.id),
             or_(Task.state == None,
                 Task.state == WorkState.RUNNING)).all()
         assigned_task_ids = [x[0] for x in assigned_task_ids]
@@ -651,33 +954,53 @@ def poll_agent(self, agent_id):
 
 @celery_app.task(ignore_results=True)
 def poll_agents():
+    """
+    Polls all agents which are due.  If ``scheduler_bulk_poll`` is enabled
+    they are polled together by this task, see :mod:`.poller`, otherwise a
+    :func:`poll_agent` task is started for each of them.
+    """
     db.session.rollback()
+    agents_to_poll = []
+
+    # Agents sending heartbeats are not polled while the heartbeats keep
+    # coming, but right away once they stop
+    heartbeat_cutoff = datetime.utcnow() - AGENT_HEARTBEAT_TIMEOUT
+    heartbeat_fresh = and_(Agent.last_heartbeat != None,
+                           Agent.last_heartbeat > heartbeat_cutoff)
+    heartbeat_stopped = and_(Agent.last_heartbeat != None,
+                             Agent.last_heartbeat <= heartbeat_cutoff,
+                             Agent.last_heard_from <= heartbeat_cutoff)
+
     idle_agents_to_poll_query = Agent.query.filter(
         Agent.state != AgentState.OFFLINE,
         Agent.state != AgentState.DISABLED,
         or_(Agent.last_heard_from == None,
             Agent.last_heard_from +
-                POLL_IDLE_AGENTS_INTERVAL < datetime.utcnow()),
+                POLL_IDLE_AGENTS_INTERVAL < datetime.utcnow(),
+            heartbeat_stopped),
+        ~heartbeat_fresh,
         ~Agent.tasks.any(or_(Task.state == None,
                              Task.state == WorkState.RUNNING)),
         Agent.use_address != UseAgentAddress.PASSIVE)
 
     for agent in idle_agents_to_poll_query:
         logger.debug("Polling idle agent %s", agent.hostname)
-        poll_agent.delay(agent.id)
+        agents_to_poll.append(agent)
 
     busy_agents_to_poll_query = Agent.query.filter(
         Agent.state != AgentState.OFFLINE,
         or_(Agent.last_heard_from == None,
             Agent.last_heard_from +
-                POLL_BUSY_AGENTS_INTERVAL < datetime.utcnow()),
+                POLL_BUSY_AGENTS_INTERVAL < datetime.utcnow(),
+            heartbeat_stopped),
+        ~heartbeat_fresh,
         Agent.tasks.any(or_(Task.state == None,
                             Task.state == WorkState.RUNNING)),
         Agent.use_address != UseAgentAddress.PASSIVE)
 
     for agent in busy_agents_to_poll_query:
         logger.debug("Polling busy agent %s", agent.hostname)
-        poll_agent.delay(agent.id)
+        agents_to_poll.append(agent)
 
     offline_agents_to_poll_query = Agent.query.filter(
         Agent.state == AgentState.OFFLINE,
@@ -688,7 +1011,31 @@ def poll_agents():
 
     for agent in offline_agents_to_poll_query:
         logger.debug("Polling offline agent %s", agent.hostname)
-        poll_agent.delay(agent.id)
+        agents_to_poll.append(agent)
+
+    if not BULK_POLL_ENABLED:
+        for agent in agents_to_poll:
+            poll_agent.delay(agent.id)
+        return
+
+    run_lock = get_lock("poll-agents")
+    if not run_lock.acquire():
+        logger.debug("poll_agents is already polling agents")
+        return
+
+    try:
+        targets = [PollTarget.from_agent(x) for x in agents_to_poll]
+        # Do not keep the transaction open while waiting for the agents
+        db.session.rollback()
+        agents_missing_tasks, tasks_to_stop = apply_results(
+            poll_concurrently(targets))
+    finally:
+        run_lock.release()
+
+    for agent_id in agents_missing_tasks:
+        send_tasks_to_agent.delay(agent_id)
+    for task_id, agent_id in tasks_to_stop:
+        stop_task.delay(task_id, agent_id, dissociate_agent=False)
 
 
 @celery_app.task(ignore_results=True)
@@ -696,127 +1043,98 @@ def send_job_completion_mail(job_id, successful=True):
     if not SMTP_SERVER:
         return
 
-    job_lockfile_name = SCHEDULER_LOCKFILE_BASE + "-job-" + str(job_id)
-    job_lock = LockFile(job_lockfile_name)
+    job_lock = get_lock("job-%s" % job_id)
+    if not job_lock.acquire():
+        logger.debug("The lock for job %s is held, something is already "
+                     "working on it.  Trying again in 5 seconds.", job_id)
+        send_job_completion_mail.apply_async(args=[job_id, successful],
+                                             countdown=5)
+        return
 
     try:
-        job_lock.acquire(timeout=-1)
-        with job_lock:
-            with open(job_lockfile_name, "w") as lockfile:
-                lockfile.write(str(time()))
-
-            db.session.rollback()
-            job = Job.query.filter_by(id=job_id).one()
-            if job.completion_notify_sent:
-                return
-
-            job.url = BASE_URL
-            if job.url[-1] != "/":
-                job.url += "/"
-            job.url+= "jobs/%s" % job.id
-
-            failed_tasks = Task.query.filter(Task.job == job,
-                                             Task.state == WorkState.FAILED).\
-                                                 order_by(desc(Task.frame))
-            failed_log_urls = []
-            for task in failed_tasks:
-                last_log_assoc = TaskTaskLogAssociation.query.filter_by(
-                    task=task).order_by(desc(
-                        TaskTaskLogAssociation.attempt)).limit(1).first()
-                if last_log_assoc:
-                    log = last_log_assoc.log
-                    log_url = BASE_URL
-                    if not log_url.endswith("/"):
-                        log_url += "/"
-                    log_url += ("api/v1/jobs/%s/tasks/%s/attempts/%s/"
-                                "logs/%s/logfile" %
-                                (job.id, task.id, last_log_assoc.attempt,
-                                 log.identifier))
-                    failed_log_urls.append(log_url)
-
-            notified_users_query = JobNotifiedUser.query.filter_by(job=job)
-            if successful:
-                notified_users_query = notified_users_query.filter_by(
-                    on_success=True)
+        db.session.rollback()
+        job = Job.query.filter_by(id=job_id).one()
+        if job.completion_notify_sent:
+            return
+
+        job.url = BASE_URL
+        if job.url[-1] != "/":
+            job.url += "/"
+        job.url+= "jobs/%s" % job.id
+
+        failed_tasks = Task.query.filter(Task.job == job,
+                                         Task.state == WorkState.FAILED).\
+                                             order_by(desc(Task.frame))
+        failed_log_urls = []
+        for task in failed_tasks:
+            last_log_assoc = TaskTaskLogAssociation.query.filter_by(
+                task=task).order_by(desc(
+                    TaskTaskLogAssociation.attempt)).limit(1).first()
+            if last_log_assoc:
+                log = last_log_assoc.log
+                log_url = BASE_URL
+                if not log_url.endswith("/"):
+                    log_url += "/"
+                log_url += ("api/v1/jobs/%s/tasks/%s/attempts/%s/"
+                            "logs/%s/logfile" %
+                            (job.id, task.id, last_log_assoc.attempt,
+                             log.identifier))
+                failed_log_urls.append(log_url)
+
+        notified_users_query = JobNotifiedUser.query.filter_by(job=job)
+        if successful:
+            notified_users_query = notified_users_query.filter_by(
+                on_success=True)
+        else:
+            notified_users_query = notified_users_query.filter_by(
+                on_failure=True)
+        notified_users = notified_users_query.all()
+        if not notified_users:
+            return
+
+        body_template = None
+        subject_template = None
+        if successful:
+            if job.jobtype_version.jobtype.success_body:
+                body_template = Template(
+                    job.jobtype_version.jobtype.success_body)
             else:
-                notified_users_query = notified_users_query.filter_by(
-                    on_failure=True)
-            notified_users = notified_users_query.all()
-            if not notified_users:
-                return
-
-            body_template = None
-            subject_template = None
-            if successful:
-                if job.jobtype_version.jobtype.success_body:
-                    body_template = Template(
-                        job.jobtype_version.jobtype.success_body)
-                else:
-                    body_template = DEFAULT_SUCCESS_BODY
-                if job.jobtype_version.jobtype.success_subject:
-                    subject_template = Template(
-                        job.jobtype_version.jobtype.success_subject)
-                else:
-                    subject_template = DEFAULT_SUCCESS_SUBJECT
+                body_template = DEFAULT_SUCCESS_BODY
+            if job.jobtype_version.jobtype.success_subject:
+                subject_template = Template(
+                    job.jobtype_version.jobtype.success_subject)
             else:
-                if job.jobtype_version.jobtype.fail_body:
-                    body_template = Template(
-                        job.jobtype_version.jobtype.fail_body)
-                else:
-                    body_template = DEFAULT_FAIL_BODY
-                if job.jobtype_version.jobtype.fail_subject:
-                    subject_template = Template(
-                        job.jobtype_version.jobtype.fail_subject)
-                else:
-                    subject_template = DEFAULT_FAIL_SUBJECT
-
-            message = MIMEText(
-                body_template.render(job=job, failed_log_urls=failed_log_urls))
-            message["Subject"] = subject_template.render(job=job)
-            message["From"] = FROM_ADDRESS
+                subject_template = DEFAULT_SUCCESS_SUBJECT
+        else:
+            if job.jobtype_version.jobtype.fail_body:
+                body_template = Template(
+                    job.jobtype_version.jobtype.fail_body)
+            else:
+                body_template = DEFAULT_FAIL_BODY
+            if job.jobtype_version.jobtype.fail_subject:
+                subject_template = Template(
+                    job.jobtype_version.jobtype.fail_subject)
+            else:
+                subject_template = DEFAULT_FAIL_SUBJECT
 
-            to = [x.user.email for x in notified_users if x.user.email]
-            message["To"] = ",".join(to)
+        message = MIMEText(
+            body_template.render(job=job, failed_log_urls=failed_log_urls))
+        message["Subject"] = subject_template.render(job=job)
+        message["From"] = FROM_ADDRESS
 
-            if to:
-                send_email(to, message.as_string())
-                logger.info("Job completion mail for job %s (id %s) sent to %s",
-                            job.title, job.id, to)
+        to = [x.user.email for x in notified_users if x.user.email]
+        message["To"] = ",".join(to)
 
-            job.completion_notify_sent = True
-            db.session.add(job)
-            db.session.commit()
+        if to:
+            send_email(to, message.as_string())
+            logger.info("Job completion mail for job %s (id %s) sent to %s",
+                        job.title, job.id, to)
 
-    except AlreadyLocked:
-        logger.debug("The job lockfile is locked, something is already working "
-                     "on job %s", job_id)
-        try:
-            with open(job_lockfile_name, "r") as lockfile:
-                locktime = float(lockfile.read())
-                if locktime < time() - 60:
-                    logger.error("The old lock was held for more than 60 "
-                                 "seconds. Breaking the lock.")
-                    job_lock.break_lock()
-        except (IOError, OSError, ValueError) as e:
-            # It is possible that we tried to read the file in the narrow window
-            # between lock acquisition and actually writing the time
-            logger.warning("Could not read a time value from the scheduler "
-                           "lockfile. Waiting 1 second before trying again. "
-                           "Error: %s", e)
-            sleep(1)
-        try:
-            with open(job_lockfile_name, "r") as lockfile:
-                locktime = float(lockfile.read())
-                if locktime < time() - 60:
-                    logger.error("The old lock was held for more than 60 "
-                                 "seconds. Breaking the lock.")
-                    job_lock.break_lock()
-        except(IOError, OSError, ValueError):
-            # If we still cannot read a time value from the file after 1s,
-            # there was something wrong with the process holding the lock
-            logger.error("Could not read a time value from the scheduler "
-                         "lockfile even after waiting 1s. Breaking the lock")
-            job_lock.break_lock()
+        job.completion_notify_sent = True
+        db.session.add(job)
+        db.session.commit()
+    finally:
+        job_lock.release()
 
 
 @celery_app.task(ignore_results=True)
@@ -848,10 +1166,8 @@ def update_agent(self, agent_id):
         return True
 
     try:
-        response = requests.post(agent.api_url() + "/update",
-                                 dumps({"version": agent.upgrade_to}),
-                                 headers={"User-Agent": USERAGENT},
-                                 timeout=AGENT_REQUEST_TIMEOUT)
+        response = get_agent_client().post(
+            agent, "/update", {"version": agent.upgrade_to})
 
         logger.debug("Return code after sending update request for %s "
                      "to agent: %s", agent.upgrade_to, response.status_code)
@@ -974,10 +1290,8 @@ def delete_task(self, task_id):
     if (agent is not None and
         task.state not in [WorkState.DONE, WorkState.FAILED]):
         try:
-            response = requests.delete("%s/tasks/%s" %
-                                            (agent.api_url(), task.id),
-                                       headers={"User-Agent": USERAGENT},
-                                       timeout=AGENT_REQUEST_TIMEOUT)
+            response = get_agent_client().delete(
+                agent, "/tasks/%s" % task.id)
 
             logger.info("Deleting task %s (job %s - %r) from agent %s (id %s)",
                         task.id, job.id, job.title, agent.hostname, agent.id)
@@ -1015,10 +1329,8 @@ def stop_task(self, task_id, agent_id=None, dissociate_agent=True):
         else:
             agent = task.agent
         try:
-            response = requests.delete("%s/tasks/%s" %
-                                            (agent.api_url(), task.id),
-                                       headers={"User-Agent": USERAGENT},
-                                       timeout=AGENT_REQUEST_TIMEOUT)
+            response = get_agent_client().delete(
+                agent, "/tasks/%s" % task.id)
 
             logger.info("Stopping task %s (job %s - \"%s\") on agent %s (id %s)",
                         task.id, job.id, job.title, agent.hostname, agent.id)
@@ -1230,6 +1542,53 @@ def cache_jobqueue_path(jobqueue_id):
     db.session.commit()
 
 
+@celery_app.task(ignore_results=True)
+def reconcile_assigned_agents():
+    """
+    Recounts the agents assigned to every job and job queue and repairs the
+    ``assigned_agents`` counters wherever they have drifted.
+    """
+    db.session.rollback()
+
+    counts = dict(db.session.query(
+        Task.job_id, func.count(distinct(Task.agent_id))).\
+            join(Agent, Task.agent_id == Agent.id).filter(
+                or_(Task.state == None, Task.state == WorkState.RUNNING),
+                Agent.state != AgentState.OFFLINE,
+                Agent.state != AgentState.DISABLED).group_by(Task.job_id))
+
+    job_table = Job.__table__
+    repaired_jobs = 0
+    jobs = db.session.query(Job.id, Job.assigned_agents).all()
+    for job_id, stored_count in jobs:
+        count = counts.get(job_id, 0)
+        if count != stored_count:
+            logger.debug("Job %s has %s assigned agents, not %s", job_id,
+                         count, stored_count)
+            db.session.execute(job_table.update().where(
+                job_table.c.id == job_id).values(assigned_agents=count))
+            repaired_jobs += 1
+
+    totals = JobQueue.count_assigned_agents(db.session)
+    queue_table = JobQueue.__table__
+    repaired_queues = 0
+    queues = db.session.query(JobQueue.id, JobQueue.assigned_agents).all()
+    for queue_id, stored_count in queues:
+        count = totals.get(queue_id, 0)
+        if count != stored_count:
+            logger.debug("Job queue %s has %s assigned agents, not %s",
+                         queue_id, count, stored_count)
+            db.session.execute(queue_table.update().where(
+                queue_table.c.id == queue_id).values(assigned_agents=count))
+            repaired_queues += 1
+
+    db.session.commit()
+
+    if repaired_jobs or repaired_queues:
+        logger.warning("Repaired the assigned agents counters of %s jobs and "
+                       "%s job queues", repaired_jobs, repaired_queues)
+
+
 @celery_app.task(ignore_results=True, bind=True)
 def check_software_version_on_agent(self, agent_id, version_id):
     db.session.rollback()
@@ -1246,13 +1605,7 @@ def check_software_version_on_agent(self, agent_id, version_id):
             "version": software_version.version}
 
     try:
-        response = requests.post(
-            agent.api_url() + "/check_software",
-            data=dumps(data),
-            headers={
-                "Content-Type": "application/json",
-                "User-Agent": USERAGENT},
-            timeout=AGENT_REQUEST_TIMEOUT)
+        response = get_agent_client().post(agent, "/check_software", data)
 
         if response.status_code == requests.codes.bad_request:
             logger.error("On requesting check for software %s, version %s, "
@@ -1302,3 +1655,82 @@ def check_all_software_on_agent(agent_id):
     for version in software_versions_query:
         if version.discovery_code and version.discovery_function_name:
             check_software_version_on_agent.delay(agent_id, version.id)
+
+
+@celery_app.task(ignore_results=True)
+def reconcile_task_counts():
+    """
+    Recounts the tasks in each state for every job and repairs the
+    ``num_tasks_*`` counters wherever they have drifted.
+    """
+    db.session.rollback()
+
+    counts = {}
+    counts_query = db.session.query(
+        Task.job_id, Task.state, func.count(Task.id)).group_by(
+            Task.job_id, Task.state)
+    for job_id, state, count in counts_query:
+        job_counts = counts.setdefault(job_id, {})
+        column = Job.task_count_column(state)
+        job_counts[column] = job_counts.get(column, 0) + count
+
+    job_table = Job.__table__
+    repaired_jobs = 0
+    jobs_query = db.session.query(
+        Job.id, Job.num_tasks_queued, Job.num_tasks_running,
+        Job.num_tasks_done, Job.num_tasks_failed)
+    for row in jobs_query:
+        job_id = row[0]
+        stored = dict(zip(Job.TASK_COUNT_COLUMNS, row[1:]))
+        actual = dict((column, counts.get(job_id, {}).get(column, 0))
+                      for column in Job.TASK_COUNT_COLUMNS)
+        if stored != actual:
+            logger.debug("Job %s has task counts %r, not %r", job_id, actual,
+                         stored)
+            db.session.execute(job_table.update().where(
+                job_table.c.id == job_id).values(**actual))
+            repaired_jobs += 1
+
+    db.session.commit()
+
+    if repaired_jobs:
+        logger.warning("Repaired the task counters of %s jobs", repaired_jobs)
+
+
+@celery_app.task(ignore_results=True)
+def reconcile_unfinished_parents():
+    """
+    Recounts the parents which are not done yet for every job and repairs the
+    ``unfinished_parents`` counters wherever they have drifted.
+    """
+    db.session.rollback()
+
+    parent = aliased(Job)
+    counts = dict(db.session.query(
+        JobDependency.c.childid, func.count(parent.id)).\
+            join(parent, parent.id == JobDependency.c.parentid).filter(
+                or_(parent.state == None, parent.state != WorkState.DONE)).\
+                    group_by(JobDependency.c.childid))
+
+    job_table = Job.__table__
+    repaired_jobs = 0
+    ready_jobs = 0
+    for job_id, stored_count in db.session.query(Job.id,
+                                                 Job.unfinished_parents):
+        count = counts.get(job_id, 0)
+        if count != stored_count:
+            logger.debug("Job %s has %s unfinished parents, not %s", job_id,
+                         count, stored_count)
+            db.session.execute(job_table.update().where(
+                job_table.c.id == job_id).values(unfinished_parents=count))
+            repaired_jobs += 1
+            if count == 0:
+                ready_jobs += 1
+
+    db.session.commit()
+
+    if repaired_jobs:
+        logger.warning("Repaired the unfinished parents counters of %s jobs",
+                       repaired_jobs)
+    if ready_jobs:
+        request_scheduling()
@@ -0,0 +1,265 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler Tracing
+-----------------
+
+Opt-in instrumentation of the scheduler.  When ``scheduler_trace`` is
+enabled, every run of the scheduler for an agent produces one trace which
+records the wall time and the number of SQL statements of each phase, every
+job and queue that was rejected together with the reason and the final
+decision.  Traces are written as JSON lines to ``scheduler_trace_file``,
+which is rotated once it grows beyond ``scheduler_trace_max_bytes``, and can
+be read back with :func:`read_traces`.
+
+The phases currently recorded are ``candidate_query``,
+``requirement_checks``, ``batch_selection`` and ``commit``.  Rejections use
+one of the ``REJECT_*`` reasons defined in this module.
+
+Statements are counted by listening on the engine, which is shared by the
+whole process.  Only the statements executed by the thread, or the
+greenlet with eventlet or gevent pools, which started a trace count
+towards it, so traces running concurrently do not count each other's.
+"""
+
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from errno import ENOENT, EEXIST
+from logging.handlers import RotatingFileHandler
+from os import makedirs
+from os.path import dirname, isfile
+from time import time
+from uuid import uuid4
+
+from sqlalchemy import event
+
+from pyfarm.core.logger import getLogger
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+
+TRACE_ENABLED = config.get("scheduler_trace")
+TRACE_FILE = config.get("scheduler_trace_file")
+TRACE_MAX_BYTES = config.get("scheduler_trace_max_bytes")
+TRACE_BACKUP_COUNT = config.get("scheduler_trace_backup_count")
+
+REJECT_RAM = "ram"
+REJECT_CPUS = "cpus"
+REJECT_SOFTWARE = "software"
+REJECT_CAPACITY = "capacity"
+REJECT_TAGS = "tags"
+REJECT_MAX_AGENTS = "max_agents"
+REJECT_NO_TASKS = "no_tasks"
+REJECT_UNWANTED = "unwanted"
+
+logger = getLogger("pf.scheduler.tracing")
+
+_trace_logger = None
+
+
+def get_trace_logger():
+    """
+    Returns the logger the traces are written to, setting it up on first
+    use.  The trace logger does not propagate, so traces never show up in
+    the regular logs.
+    """
+    global _trace_logger
+
+    if _trace_logger is None:
+        try:
+            makedirs(dirname(TRACE_FILE))
+        except OSError as e:  # pragma: no cover
+            if e.errno != EEXIST:
+                raise
+
+        handler = RotatingFileHandler(
+            TRACE_FILE, maxBytes=TRACE_MAX_BYTES,
+            backupCount=TRACE_BACKUP_COUNT)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        trace_logger = logging.getLogger("pf.scheduler.tracing.traces")
+        trace_logger.propagate = False
+        trace_logger.setLevel(logging.INFO)
+        trace_logger.addHandler(handler)
+        _trace_logger = trace_logger
+
+    return _trace_logger
+
+
+class QueryCounter(object):
+    """
+    Counts the statements the thread which created the counter executes on
+    the database engine
+    """
+    def __init__(self):
+        self.count = 0
+        # Looked up on every call, so this returns the current greenlet
+        # instead if threading has been monkey patched
+        self.thread = threading.current_thread()
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        if threading.current_thread() is self.thread:
+            self.count += 1
+
+    @contextmanager
+    def counting(self):
+        event.listen(db.engine, "before_cursor_execute", self)
+        try:
+            yield self
+        finally:
+            event.remove(db.engine, "before_cursor_execute", self)
+
+
+class NullTrace(object):
+    """
+    Stand-in for :class:`SchedulerTrace` used when tracing is disabled, all
+    methods do nothing
+    """
+    enabled = False
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def reject_job(self, job_id, reason):
+        pass
+
+    def reject_queue(self, queue_id, reason):
+        pass
+
+    def finish(self, **result):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class SchedulerTrace(object):
+    """
+    The trace of one run of the scheduler for one agent.  Use
+    :meth:`phase` as a context manager around the work being measured,
+    :meth:`reject_job` and :meth:`reject_queue` for everything that was not
+    selected and :meth:`finish` once the run is done to write the trace.
+    """
+    enabled = True
+
+    def __init__(self, agent_id, cycle_id=None):
+        self.agent_id = agent_id
+        self.cycle_id = cycle_id or uuid4().hex
+        self.started = datetime.utcnow()
+        self.phases = {}
+        self.rejections = []
+        self.counter = QueryCounter()
+        self.finished = False
+        self._start_time = time()
+        event.listen(db.engine, "before_cursor_execute", self.counter)
+
+    @contextmanager
+    def phase(self, name):
+        start_time = time()
+        start_queries = self.counter.count
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {"time": 0.0, "queries": 0})
+            phase["time"] += time() - start_time
+            phase["queries"] += self.counter.count - start_queries
+
+    def reject_job(self, job_id, reason):
+        self.rejections.append({"type": "job", "id": job_id,
+                                "reason": reason})
+
+    def reject_queue(self, queue_id, reason):
+        self.rejections.append({"type": "queue", "id": queue_id,
+                                "reason": reason})
+
+    def to_dict(self, **result):
+        data = {
+            "cycle_id": self.cycle_id,
+            "agent_id": str(self.agent_id),
+            "time_started": self.started.isoformat(),
+            "time": time() - self._start_time,
+            "queries": self.counter.count,
+            "phases": self.phases,
+            "rejections": self.rejections}
+        data.update(result)
+        return data
+
+    def finish(self, **result):
+        """
+        Writes the trace, `result` is merged into it, usually the id of the
+        selected job and the number of assigned tasks.  Only the first call
+        has an effect.
+        """
+        if self.finished:
+            return
+        self.finished = True
+
+        event.remove(db.engine, "before_cursor_execute", self.counter)
+        try:
+            get_trace_logger().info(json.dumps(self.to_dict(**result),
+                                               default=str))
+        except Exception as e:  # pragma: no cover
+            logger.error("Could not write scheduler trace: %r", e)
+
+
+def start_trace(agent_id, cycle_id=None):
+    """
+    Returns a new :class:`SchedulerTrace` for the given agent or
+    :const:`NULL_TRACE` if tracing is disabled
+    """
+    if not TRACE_ENABLED:
+        return NULL_TRACE
+    return SchedulerTrace(agent_id, cycle_id=cycle_id)
+
+
+def read_traces(limit=100, agent_id=None, cycle_id=None):
+    """
+    Returns up to `limit` traces, newest first, optionally only those for the
+    given agent or cycle
+    """
+    paths = [TRACE_FILE] + ["%s.%s" % (TRACE_FILE, i)
+                            for i in range(1, TRACE_BACKUP_COUNT + 1)]
+    traces = []
+    for path in paths:
+        if not isfile(path):
+            continue
+
+        try:
+            with open(path, "r") as trace_file:
+                lines = trace_file.readlines()
+        except (IOError, OSError) as e:  # pragma: no cover
+            if e.errno != ENOENT:
+                raise
+            continue
+
+        for line in reversed(lines):
+            try:
+                trace = json.loads(line)
+            except ValueError:
+                continue
+            if agent_id is not None and trace["agent_id"] != str(agent_id):
+                continue
+            if cycle_id is not None and trace["cycle_id"] != cycle_id:
+                continue
+            traces.append(trace)
+            if len(traces) >= limit:
+                return traces
+
+    return traces
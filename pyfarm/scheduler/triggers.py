@@ -0,0 +1,148 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler Triggers
+------------------
+
+Coalesces requests to run the scheduler.  Instead of starting a run of
+:func:`.assign_tasks` over all idle agents for every new agent, job or
+finished task, callers use :func:`request_scheduling`, which records the
+request as a :class:`.SchedulerTrigger`.  Only the first trigger while none
+are pending starts a run, ``scheduler_trigger_delay`` seconds later, and that
+run handles all the triggers which arrived in the meantime at once.
+
+A trigger can name the agents and job queues affected by it, a run which
+only has such triggers pending considers just those agents and the idle
+agents able to work on the jobs in those queues.
+"""
+
+from uuid import UUID
+
+from sqlalchemy import func, or_, select, distinct
+
+from pyfarm.core.logger import getLogger
+from pyfarm.core.enums import WorkState
+from pyfarm.models.agent import Agent
+from pyfarm.models.job import Job
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.schedulertrigger import SchedulerTrigger
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+
+TRIGGER_DELAY = config.get("scheduler_trigger_delay")
+
+logger = getLogger("pf.scheduler.triggers")
+
+
+def request_scheduling(agent_ids=None, queue_ids=None):
+    """
+    Requests a run of :func:`.assign_tasks`.  If `agent_ids` or `queue_ids`
+    are given, the run may be restricted to those agents and the agents able
+    to work on the jobs in those queues.  Jobs which are not part of any
+    queue are represented by a queue id of None and require a run over all
+    idle agents.
+    """
+    # Import here instead of at the top to avoid circular import
+    from pyfarm.scheduler.tasks import assign_tasks
+
+    agent_ids = [str(x) for x in agent_ids or ()]
+    queue_ids = list(queue_ids or ())
+    if None in queue_ids or not (agent_ids or queue_ids):
+        agent_ids = queue_ids = None
+
+    table = SchedulerTrigger.__table__
+    with db.engine.begin() as connection:
+        trigger_id = connection.execute(table.insert().values(
+            agent_ids=agent_ids, queue_ids=queue_ids)).inserted_primary_key[0]
+
+    # Whoever created the oldest pending trigger has already started a run
+    # which will handle this trigger as well
+    with db.engine.begin() as connection:
+        earlier_triggers = connection.execute(
+            select([func.count(table.c.id)]).where(
+                table.c.id < trigger_id)).scalar()
+
+    if not earlier_triggers:
+        assign_tasks.apply_async(kwargs={"triggered": True},
+                                 countdown=TRIGGER_DELAY)
+
+
+def pop_triggers():
+    """
+    Removes all pending triggers.  Returns None if there were no triggers,
+    ``(None, None)`` if one of them requires a run over all idle agents and a
+    tuple of the sets of affected agent ids and queue ids otherwise.
+    """
+    table = SchedulerTrigger.__table__
+    with db.engine.begin() as connection:
+        rows = connection.execute(select(
+            [table.c.id, table.c.agent_ids, table.c.queue_ids])).fetchall()
+        if not rows:
+            return None
+
+        connection.execute(table.delete().where(
+            table.c.id.in_([row[0] for row in rows])))
+
+    agent_ids = set()
+    queue_ids = set()
+    for _, trigger_agent_ids, trigger_queue_ids in rows:
+        if trigger_agent_ids is None and trigger_queue_ids is None:
+            return None, None
+        agent_ids.update(UUID(x) for x in trigger_agent_ids or ())
+        queue_ids.update(trigger_queue_ids or ())
+
+    return agent_ids, queue_ids
+
+
+def has_pending_triggers():
+    """Returns True if there are triggers which have not been handled yet"""
+    table = SchedulerTrigger.__table__
+    with db.engine.begin() as connection:
+        return connection.execute(
+            select([func.count(table.c.id)])).scalar() > 0
+
+
+def affected_agent_ids(idle_agent_ids, agent_ids, queue_ids):
+    """
+    Returns the ids of the agents among `idle_agent_ids` which are either
+    listed in `agent_ids` or are able to run one of the runnable jobs in the
+    queues `queue_ids` or their sub-queues
+    """
+    idle_agent_ids = set(idle_agent_ids)
+    affected = idle_agent_ids & set(agent_ids)
+    candidates = idle_agent_ids - affected
+    if not queue_ids or not candidates:
+        return affected
+
+    queue_ids = set(queue_ids)
+    parent_ids = list(queue_ids)
+    while parent_ids:
+        parent_ids = [x[0] for x in db.session.query(JobQueue.id).filter(
+            JobQueue.parent_jobqueue_id.in_(parent_ids))
+                      if x[0] not in queue_ids]
+        queue_ids.update(parent_ids)
+
+    jobtype_version_ids = [x[0] for x in db.session.query(
+        distinct(Job.jobtype_version_id)).filter(
+            Job.job_queue_id.in_(list(queue_ids)),
+            or_(Job.state == None, Job.state == WorkState.RUNNING),
+            Job.unfinished_parents == 0)]
+
+    capabilities = Agent.get_capabilities(candidates, jobtype_version_ids)
+    affected.update(agent_id for agent_id, supported in capabilities.items()
+                    if supported)
+    return affected
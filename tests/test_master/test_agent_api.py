@@ -26,10 +26,15 @@ except ImportError:
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
+from pyfarm.core.enums import WorkState
 from pyfarm.master.utility import dumps
 from pyfarm.master.application import get_api_blueprint
 from pyfarm.master.entrypoints import load_api
+from pyfarm.master.application import db
 from pyfarm.models.agent import Agent
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
 
 
 class TestAgentAPI(BaseTestCase):
@@ -258,6 +263,158 @@ class TestAgentAPI(BaseTestCase):
         response4 = self.client.get("/api/v1/agents/%s" % id)
         self.assert_not_found(response4)
 
+    def test_agent_heartbeat(self):
+        agent_id = uuid.uuid4()
+        response1 = self.client.post(
+            "/api/v1/agents/",
+            content_type="application/json",
+            data=dumps({
+                "id": agent_id,
+                "cpu_allocation": 1.0,
+                "cpus": 16,
+                "free_ram": 133,
+                "hostname": "testagent5",
+                "remote_ip": "10.0.200.6",
+                "port": 64994,
+                "ram": 2048,
+                "ram_allocation": 0.8,
+                "state": "online"}))
+        self.assert_created(response1)
+
+        response2 = self.client.post(
+            "/api/v1/agents/%s/heartbeat" % agent_id,
+            content_type="application/json",
+            data=dumps({"state": "running", "free_ram": 100,
+                        "task_ids": []}))
+        self.assert_no_content(response2)
+
+        response3 = self.client.get("/api/v1/agents/%s" % agent_id)
+        self.assert_ok(response3)
+        self.assertEqual(response3.json["state"], "running")
+        self.assertEqual(response3.json["free_ram"], 100)
+        agent = Agent.query.filter_by(id=agent_id).one()
+        self.assertIsNotNone(agent.last_heartbeat)
+        self.assertEqual(agent.last_heartbeat, agent.last_heard_from)
+
+    def test_agent_heartbeat_errors(self):
+        response1 = self.client.post(
+            "/api/v1/agents/%s/heartbeat" % uuid.uuid4(),
+            content_type="application/json",
+            data=dumps({"free_ram": 100}))
+        self.assert_not_found(response1)
+
+        response2 = self.client.post(
+            "/api/v1/agents/%s/heartbeat" % uuid.uuid4(),
+            content_type="application/json",
+            data=dumps({"task_ids": ["foo"]}))
+        self.assert_bad_request(response2)
+
+        response3 = self.client.post(
+            "/api/v1/agents/%s/heartbeat" % uuid.uuid4(),
+            content_type="application/json",
+            data=dumps({"ram": 1024}))
+        self.assert_bad_request(response3)
+
+        # Agents may only send heartbeats for themselves
+        agent = Agent(hostname="testagent5", id=uuid.uuid4(), ram=2048,
+                      free_ram=2048, cpus=16, port=64994,
+                      remote_ip="10.0.200.6")
+        db.session.add(agent)
+        db.session.commit()
+        response4 = self.client.post(
+            "/api/v1/agents/%s/heartbeat" % agent.id,
+            content_type="application/json",
+            headers={"User-Agent": "PyFarm/1.0 (agent)"},
+            data=dumps({"task_ids": []}))
+        self.assert_bad_request(response4)
+
+    def test_agent_heartbeat_offline(self):
+        jobtype = JobType(name="foo", description="this is a job type")
+        jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="class Foobar(JobType): pass".encode("utf-8"))
+        job = Job(title="job", jobtype_version=jobtype_version)
+        agent = Agent(hostname="testagent6", id=uuid.uuid4(), ram=2048,
+                      free_ram=2048, cpus=16, port=64994,
+                      remote_ip="10.0.200.7")
+        unstarted_task = Task(job=job, frame=1, agent=agent, attempts=0)
+        running_task = Task(job=job, frame=2, agent=agent, attempts=0,
+                            state=WorkState.RUNNING)
+        db.session.add_all([unstarted_task, running_task])
+        db.session.commit()
+        agent_id = agent.id
+        task_ids = [unstarted_task.id, running_task.id]
+
+        response = self.client.post(
+            "/api/v1/agents/%s/heartbeat" % agent_id,
+            content_type="application/json",
+            data=dumps({"state": "offline"}))
+        self.assert_no_content(response)
+        for task_id in task_ids:
+            task = Task.query.filter_by(id=task_id).one()
+            self.assertIsNone(task.agent_id)
+            self.assertIsNone(task.state)
+
+    def test_task_updates(self):
+        jobtype = JobType(name="foo", description="this is a job type")
+        jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="class Foobar(JobType): pass".encode("utf-8"))
+        job = Job(title="job", jobtype_version=jobtype_version, requeue=0)
+        agent = Agent(hostname="testagent6", id=uuid.uuid4(), ram=2048,
+                      free_ram=2048, cpus=16, port=64994,
+                      remote_ip="10.0.200.7")
+        other_agent = Agent(hostname="testagent7", id=uuid.uuid4(),
+                            ram=2048, free_ram=2048, cpus=16, port=64994,
+                            remote_ip="10.0.200.8")
+        tasks = [Task(job=job, frame=i, agent=agent, attempts=0)
+                 for i in range(3)]
+        foreign_task = Task(job=job, frame=3, agent=other_agent, attempts=0)
+        db.session.add_all(tasks + [foreign_task])
+        db.session.commit()
+        agent_id = agent.id
+        task_ids = [x.id for x in tasks]
+
+        response = self.client.post(
+            "/api/v1/agents/%s/tasks/updates" % agent_id,
+            content_type="application/json",
+            data=dumps([
+                {"task_id": task_ids[0], "state": "done"},
+                {"task_id": task_ids[1], "state": "running",
+                 "progress": 0.5},
+                {"task_id": task_ids[2], "state": "failed",
+                 "last_error": "Segmentation fault"},
+                {"task_id": task_ids[2] + 100, "state": "done"},
+                {"task_id": foreign_task.id, "state": "done"},
+                {"task_id": task_ids[1], "progress": 2.0}]))
+        self.assert_ok(response)
+        self.assertEqual(
+            [x.get("state", x.get("error")) for x in response.json],
+            ["done", "running", "failed", "Task not found",
+             "Task is not assigned to this agent",
+             "`progress` must be a number between 0.0 and 1.0"])
+
+        task = Task.query.filter_by(id=task_ids[1]).one()
+        self.assertEqual(task.progress, 0.5)
+        task = Task.query.filter_by(id=task_ids[2]).one()
+        self.assertEqual(task.last_error, "Segmentation fault")
+        job = Job.query.filter_by(title="job").one()
+        self.assertEqual(job.num_tasks_done, 1)
+        self.assertEqual(job.num_tasks_running, 1)
+
+    def test_task_updates_errors(self):
+        response1 = self.client.post(
+            "/api/v1/agents/%s/tasks/updates" % uuid.uuid4(),
+            content_type="application/json",
+            data=dumps([{"task_id": 1, "state": "done"}]))
+        self.assert_not_found(response1)
+
+        response2 = self.client.post(
+            "/api/v1/agents/%s/tasks/updates" % uuid.uuid4(),
+            content_type="application/json",
+            data=dumps({"task_id": 1, "state": "done"}))
+        self.assert_bad_request(response2)
+
 
 class TestAgentAPIFilter(BaseTestCase):
     def setup_app(self):
@@ -25,9 +25,13 @@ BaseTestCase.build_environment()
 
 from pyfarm.core.enums import AgentState, UseAgentAddress
 from pyfarm.master.application import db
-from pyfarm.models.software import Software, SoftwareVersion
+from pyfarm.models.software import (
+    Software, SoftwareVersion, JobTypeSoftwareRequirement)
 from pyfarm.models.tag import Tag
-from pyfarm.models.agent import Agent
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.job import Job
+from pyfarm.models import agent as agent_module
+from pyfarm.models.agent import Agent, AgentReservation, AgentAffinity
 
 try:
     from itertools import product
@@ -141,6 +145,104 @@ class TestAgentSoftware(AgentTestCase, BaseTestCase):
                 db.session.commit()
             db.session.rollback()
 
+    def test_capabilities(self):
+        for agent_foobar in self.models(limit=1):
+            db.session.add(agent_foobar)
+            software = Software(software="foo")
+            version1 = SoftwareVersion(software=software, version="1", rank=1)
+            version2 = SoftwareVersion(software=software, version="2", rank=2)
+            agent_foobar.software_versions.append(version1)
+
+            jobtype = JobType(name="foo", description="this is a job type")
+            jobtype_version = JobTypeVersion(
+                jobtype=jobtype, version=1, classname="Foobar",
+                code="class Foobar(JobType): pass".encode("utf-8"))
+            requirement = JobTypeSoftwareRequirement(
+                jobtype_version=jobtype_version, software=software,
+                min_version=version2)
+            db.session.add_all([software, version2, jobtype_version,
+                                requirement])
+            db.session.commit()
+
+            capabilities = Agent.get_capabilities(
+                [agent_foobar.id], [jobtype_version.id])
+            self.assertEqual(capabilities, {agent_foobar.id: set()})
+            db.session.commit()
+
+            # Changing the agent's software invalidates the index
+            agent_foobar.software_versions.append(version2)
+            db.session.commit()
+            capabilities = Agent.get_capabilities(
+                [agent_foobar.id], [jobtype_version.id])
+            self.assertEqual(capabilities,
+                             {agent_foobar.id: set([jobtype_version.id])})
+            db.session.commit()
+
+            # So does changing the requirements of the jobtype version
+            requirement.min_version = None
+            requirement.max_version = version1
+            db.session.commit()
+            capabilities = Agent.get_capabilities(
+                [agent_foobar.id], [jobtype_version.id])
+            self.assertEqual(capabilities,
+                             {agent_foobar.id: set([jobtype_version.id])})
+            agent_foobar.software_versions.remove(version1)
+            db.session.commit()
+            self.assertFalse(
+                agent_foobar.satisfies_jobtype_requirements(jobtype_version))
+
+    def test_capabilities_revisions(self):
+        for agent_foobar in self.models(limit=1):
+            db.session.add(agent_foobar)
+            software = Software(software="foo")
+            version = SoftwareVersion(software=software, version="1", rank=1)
+            jobtype = JobType(name="foo", description="this is a job type")
+            jobtype_version = JobTypeVersion(
+                jobtype=jobtype, version=1, classname="Foobar",
+                code="class Foobar(JobType): pass".encode("utf-8"))
+            requirement = JobTypeSoftwareRequirement(
+                jobtype_version=jobtype_version, software=software)
+            db.session.add_all([software, version, jobtype_version,
+                                requirement])
+            db.session.commit()
+
+            agent_foobar.software_versions.append(version)
+            db.session.commit()
+            self.assertEqual(agent_foobar.capability_revision, 1)
+
+            # An entry computed from the software the agent had before is
+            # replaced instead of being used
+            Agent.store_capabilities([
+                {"agent_id": agent_foobar.id,
+                 "jobtype_version_id": jobtype_version.id,
+                 "supported": False, "agent_revision": 0,
+                 "jobtype_version_revision": 0}])
+            db.session.commit()
+            capabilities = Agent.get_capabilities(
+                [agent_foobar.id], [jobtype_version.id])
+            self.assertEqual(capabilities,
+                             {agent_foobar.id: set([jobtype_version.id])})
+            db.session.commit()
+
+            # Storing an entry which exists already does not break the
+            # transaction
+            Agent.store_capabilities([
+                {"agent_id": agent_foobar.id,
+                 "jobtype_version_id": jobtype_version.id,
+                 "supported": True, "agent_revision": 1,
+                 "jobtype_version_revision": 0}])
+            capabilities = Agent.get_capabilities(
+                [agent_foobar.id], [jobtype_version.id])
+            self.assertEqual(capabilities,
+                             {agent_foobar.id: set([jobtype_version.id])})
+            db.session.commit()
+
+            # Changing the rank of a version invalidates the entries of all
+            # jobtype versions requiring its software
+            version.rank = 2
+            db.session.commit()
+            self.assertEqual(jobtype_version.capability_revision, 1)
+
 
 class TestAgentTags(AgentTestCase, BaseTestCase):
     def test_tags_validation(self):
@@ -184,6 +286,29 @@ class TestAgentTags(AgentTestCase, BaseTestCase):
             agent_tags.sort()
             self.assertListEqual(agent_tags, tags)
 
+    def test_tag_bits(self):
+        for agent_foobar in self.models(limit=1):
+            db.session.add(agent_foobar)
+            tag1 = Tag(tag="foo")
+            tag2 = Tag(tag="bar")
+            tag3 = Tag(tag="baz")
+            agent_foobar.tags.append(tag1)
+            agent_foobar.tags.append(tag3)
+            db.session.add(tag2)
+            db.session.commit()
+
+            tag_bits = agent_foobar.get_tag_bits()
+            self.assertEqual(tag_bits, Tag.bitset([tag1.id, tag3.id]))
+            self.assertTrue(tag_bits & Tag.bitset([tag1.id]))
+            self.assertFalse(tag_bits & Tag.bitset([tag2.id]))
+
+            agent_foobar.tags.append(tag2)
+            db.session.commit()
+            self.assertEqual(agent_foobar.get_tag_bits(), tag_bits)
+            agent_foobar.clear_scheduling_cache()
+            self.assertEqual(agent_foobar.get_tag_bits(),
+                             Tag.bitset([tag1.id, tag2.id, tag3.id]))
+
 
 class TestAgentModel(AgentTestCase, BaseTestCase):
     def test_basic_insert(self):
@@ -267,6 +392,82 @@ class TestAgentModel(AgentTestCase, BaseTestCase):
         with self.assertRaises(ValueError):
             model.api_url()
 
+    def test_reservation(self):
+        agent = Agent(hostname="foo", port=12345, ram=1024, free_ram=1024,
+                      cpus=4, cpu_allocation=1.0, ram_allocation=0.5)
+        small_job = Job(id=1, cpus=2, ram=256)
+        large_job = Job(id=2, cpus=3, ram=256)
+        exclusive_job = Job(id=3, cpus=-1, ram=256)
+
+        multi_slot = agent_module.MULTI_SLOT
+        agent_module.MULTI_SLOT = True
+        try:
+            reservation = AgentReservation()
+            self.assertTrue(reservation.fits(agent, large_job))
+            reservation.add(small_job.id, small_job.cpus, small_job.ram)
+            self.assertTrue(reservation.has_capacity(agent))
+            self.assertFalse(reservation.fits(agent, small_job))
+            self.assertFalse(reservation.fits(agent, large_job))
+            self.assertFalse(reservation.fits(agent, exclusive_job))
+            self.assertTrue(
+                reservation.fits(agent, Job(id=4, cpus=2, ram=256)))
+            self.assertFalse(
+                reservation.fits(agent, Job(id=5, cpus=1, ram=512)))
+
+            reservation = AgentReservation()
+            reservation.add(exclusive_job.id, exclusive_job.cpus,
+                            exclusive_job.ram)
+            self.assertFalse(reservation.has_capacity(agent))
+            self.assertFalse(reservation.fits(agent, small_job))
+
+            agent_module.MULTI_SLOT = False
+            reservation = AgentReservation()
+            reservation.add(small_job.id, small_job.cpus, small_job.ram)
+            self.assertFalse(reservation.has_capacity(agent))
+            self.assertFalse(
+                reservation.fits(agent, Job(id=4, cpus=1, ram=16)))
+        finally:
+            agent_module.MULTI_SLOT = multi_slot
+
+    def test_affinity(self):
+        agent = Agent(hostname="foo", port=12345, ram=1024, free_ram=1024,
+                      cpus=4)
+        self.assertEqual(agent.get_affinity().score_job(Job(id=1)), 0)
+
+        agent.record_assignment(
+            Job(id=1, jobtype_version_id=1, job_group_id=1))
+        self.assertEqual(agent.affinity_hits or 0, 0)
+        affinity = agent.get_affinity()
+        self.assertEqual(affinity.score_job(
+            Job(id=1, jobtype_version_id=1, job_group_id=1)), 3)
+        self.assertEqual(affinity.score_job(
+            Job(id=2, jobtype_version_id=2, job_group_id=1)), 2)
+        self.assertEqual(affinity.score_job(
+            Job(id=3, jobtype_version_id=1, job_group_id=2)), 1)
+        self.assertEqual(affinity.score_job(
+            Job(id=4, jobtype_version_id=2, job_group_id=None)), 0)
+
+        agent.record_assignment(
+            Job(id=2, jobtype_version_id=2, job_group_id=1))
+        agent.record_assignment(
+            Job(id=3, jobtype_version_id=1, job_group_id=2))
+        self.assertEqual(agent.affinity_hits, 1)
+        self.assertEqual(agent.get_affinity().job_id, 3)
+
+        tolerance = agent_module.AFFINITY_TOLERANCE
+        try:
+            agent_module.AFFINITY_TOLERANCE = 0.25
+            self.assertLess(AgentAffinity.sort_key(1.2, 1),
+                            AgentAffinity.sort_key(1.0, 0))
+            self.assertGreater(AgentAffinity.sort_key(1.3, 3),
+                               AgentAffinity.sort_key(1.0, 0))
+
+            agent_module.AFFINITY_TOLERANCE = None
+            self.assertEqual(AgentAffinity.sort_key(1.0, 3),
+                             AgentAffinity.sort_key(1.0, 0))
+        finally:
+            agent_module.AFFINITY_TOLERANCE = tolerance
+
 
 class TestModelValidation(AgentTestCase):
     def test_hostname(self):
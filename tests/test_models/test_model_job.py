@@ -19,23 +19,55 @@ Basic job model testing, the majority of testing for jobs is tested using
 relationships.
 """
 
+import sqlite3
+import uuid
 from textwrap import dedent
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy.exc import DatabaseError
 
 # test class must be loaded first
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
-from pyfarm.core.enums import WorkState
+from pyfarm.core.enums import WorkState, AgentState
 from pyfarm.master.application import db
 from pyfarm.models.tag import Tag
 from pyfarm.models.software import Software, JobSoftwareRequirement
 from pyfarm.models.agent import Agent
+from pyfarm.models import job as job_module
 from pyfarm.models.job import Job
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.task import Task
+from pyfarm.models.runtimestatistics import TaskRuntimeStatistics
+from pyfarm.scheduler.tasks import (
+    reconcile_assigned_agents, reconcile_task_counts)
+
+
+def create_job(title="Test Job", jobtype_version=None, batch_contiguous=True,
+               max_batch=1, **kwargs):
+    """
+    Creates a job and adds it to the session, along with a new jobtype for
+    it unless `jobtype_version` is given
+    """
+    if jobtype_version is None:
+        jobtype = JobType()
+        jobtype.name = "foo"
+        jobtype.description = "this is a job type"
+        jobtype_version = JobTypeVersion()
+        jobtype_version.jobtype = jobtype
+        jobtype_version.version = 1
+        jobtype_version.classname = "Foobar"
+        jobtype_version.batch_contiguous = batch_contiguous
+        jobtype_version.max_batch = max_batch
+        jobtype_version.code = ("""
+            class Foobar(JobType):
+                pass""").encode("utf-8")
+
+    job = Job(title=title, jobtype_version=jobtype_version, **kwargs)
+    db.session.add(job)
+    return job
 
 
 class TestTags(BaseTestCase):
@@ -206,6 +238,15 @@ class TestJobEventsAndValidation(BaseTestCase):
         with self.assertRaises(ValueError):
             model.cpus = Agent.MAX_CPUS + 10
 
+    def test_exclusive_resources(self):
+        model = Job()
+        model.cpus = -1
+        model.ram = -1
+        with self.assertRaises(ValueError):
+            model.cpus = -2
+        with self.assertRaises(ValueError):
+            model.ram = -2
+
     def test_priority(self):
         model = Job()
         model.priority = Job.MIN_PRIORITY
@@ -221,3 +262,272 @@ class TestJobEventsAndValidation(BaseTestCase):
         self.assertIsNone(model.time_started)
         model.state = WorkState.RUNNING
         self.assertIsInstance(model.time_started, datetime)
+
+
+class TestAssignedAgents(BaseTestCase):
+    def create_queued_job(self):
+        parent_queue = JobQueue(name="ParentQueue")
+        queue = JobQueue(name="ChildQueue", parent=parent_queue)
+        job = create_job(queue=queue, state=WorkState.RUNNING)
+        tasks = [Task(job=job, frame=i) for i in range(0, 5)]
+        db.session.add_all([parent_queue, queue] + tasks)
+        db.session.commit()
+
+        return parent_queue, queue, job, tasks
+
+    def create_agent(self, hostname):
+        agent = Agent(hostname=hostname, id=uuid.uuid4(), ram=32,
+                      free_ram=32, cpus=1, port=50000)
+        db.session.add(agent)
+        return agent
+
+    def test_counters_follow_assignments(self):
+        parent_queue, queue, job, tasks = self.create_queued_job()
+        agent1 = self.create_agent("agent1")
+        agent2 = self.create_agent("agent2")
+        tasks[0].agent = agent1
+        tasks[1].agent = agent1
+        tasks[2].agent = agent2
+        db.session.commit()
+
+        self.assertEqual(job.num_assigned_agents(), 2)
+        self.assertEqual(queue.num_assigned_agents(), 2)
+        self.assertEqual(parent_queue.num_assigned_agents(), 2)
+
+        tasks[2].state = WorkState.DONE
+        db.session.commit()
+        self.assertEqual(job.num_assigned_agents(), 1)
+        self.assertEqual(parent_queue.num_assigned_agents(), 1)
+
+        agent1.state = AgentState.OFFLINE
+        db.session.commit()
+        self.assertEqual(job.num_assigned_agents(), 0)
+        self.assertEqual(queue.num_assigned_agents(), 0)
+        self.assertEqual(parent_queue.num_assigned_agents(), 0)
+
+    def test_agent_counted_once_per_queue(self):
+        parent_queue, queue, job, tasks = self.create_queued_job()
+        other_job = create_job("Other Job",
+                               jobtype_version=job.jobtype_version,
+                               queue=queue, state=WorkState.RUNNING)
+        other_task = Task(job=other_job, frame=1)
+        db.session.add(other_task)
+        db.session.commit()
+
+        agent = self.create_agent("agent1")
+        tasks[0].agent = agent
+        other_task.agent = agent
+        db.session.commit()
+
+        self.assertEqual(job.num_assigned_agents(), 1)
+        self.assertEqual(other_job.num_assigned_agents(), 1)
+        self.assertEqual(queue.num_assigned_agents(), 1)
+        self.assertEqual(parent_queue.num_assigned_agents(), 1)
+
+        other_task.state = WorkState.DONE
+        db.session.commit()
+        self.assertEqual(other_job.num_assigned_agents(), 0)
+        self.assertEqual(queue.num_assigned_agents(), 1)
+        self.assertEqual(parent_queue.num_assigned_agents(), 1)
+
+        db.session.execute(JobQueue.__table__.update().values(
+            assigned_agents=2))
+        db.session.commit()
+        reconcile_assigned_agents()
+        self.assertEqual(queue.num_assigned_agents(), 1)
+        self.assertEqual(parent_queue.num_assigned_agents(), 1)
+
+    def test_reconcile(self):
+        parent_queue, queue, job, tasks = self.create_queued_job()
+        agent = self.create_agent("agent1")
+        tasks[0].agent = agent
+        db.session.commit()
+
+        db.session.execute(JobQueue.__table__.update().values(
+            assigned_agents=42))
+        db.session.execute(Job.__table__.update().values(assigned_agents=0))
+        db.session.commit()
+        self.assertEqual(parent_queue.num_assigned_agents(), 42)
+
+        reconcile_assigned_agents()
+        self.assertEqual(job.num_assigned_agents(), 1)
+        self.assertEqual(queue.num_assigned_agents(), 1)
+        self.assertEqual(parent_queue.num_assigned_agents(), 1)
+
+
+class TestTaskCounts(BaseTestCase):
+    def create_job_with_tasks(self):
+        job = create_job(requeue=0)
+        tasks = [Task(job=job, frame=i) for i in range(0, 5)]
+        db.session.add_all(tasks)
+        db.session.commit()
+
+        return job, tasks
+
+    def assertTaskCounts(self, job, queued, running, done, failed):
+        self.assertEqual(
+            (job.num_tasks_queued, job.num_tasks_running, job.num_tasks_done,
+             job.num_tasks_failed),
+            (queued, running, done, failed))
+
+    def test_counters_follow_state_changes(self):
+        job, tasks = self.create_job_with_tasks()
+        self.assertTaskCounts(job, 5, 0, 0, 0)
+
+        tasks[0].state = WorkState.RUNNING
+        tasks[1].state = WorkState.RUNNING
+        db.session.commit()
+        self.assertTaskCounts(job, 3, 2, 0, 0)
+
+        # Failed tasks are remembered on the agent they failed on
+        tasks[1].agent = Agent(hostname="agent1", id=uuid.uuid4(), ram=32,
+                               free_ram=32, cpus=1, port=50000)
+        tasks[0].state = WorkState.DONE
+        tasks[1].state = WorkState.FAILED
+        tasks[2].state = WorkState.DONE
+        db.session.commit()
+        self.assertTaskCounts(job, 2, 0, 2, 1)
+
+        db.session.delete(tasks[3])
+        db.session.commit()
+        self.assertTaskCounts(job, 1, 0, 2, 1)
+
+    def test_reconcile(self):
+        job, tasks = self.create_job_with_tasks()
+        db.session.execute(Job.__table__.update().values(
+            num_tasks_queued=0, num_tasks_done=42))
+        db.session.commit()
+        self.assertTaskCounts(job, 0, 0, 42, 0)
+
+        reconcile_task_counts()
+        self.assertTaskCounts(job, 5, 0, 0, 0)
+
+
+class TestGetBatch(BaseTestCase):
+    def create_batch_job(self, frames, batch, contiguous=True):
+        job = create_job(batch_contiguous=contiguous, max_batch=100,
+                         batch=batch, by=1)
+        tasks = [Task(job=job, frame=frame) for frame in frames]
+        agent = Agent(hostname="agent1", id=uuid.uuid4(), ram=32,
+                      free_ram=32, cpus=1, port=50000)
+        db.session.add_all([agent] + tasks)
+        db.session.commit()
+
+        return job, agent
+
+    def test_first_tasks(self):
+        job, agent = self.create_batch_job([1, 2, 4, 5, 6, 7, 8], 3, False)
+        batch = job.get_batch(agent)
+        self.assertEqual([x.frame for x in batch], [1, 2, 4])
+
+    def test_first_contiguous_window(self):
+        job, agent = self.create_batch_job([1, 2, 4, 5, 6, 7, 8], 3)
+        batch = job.get_batch(agent)
+        self.assertEqual([x.frame for x in batch], [4, 5, 6])
+
+    def test_no_full_window(self):
+        job, agent = self.create_batch_job([1, 2, 4, 6], 3)
+        batch = job.get_batch(agent)
+        self.assertEqual([x.frame for x in batch], [1, 2])
+
+    def test_contiguous_batch_methods(self):
+        job, agent = self.create_batch_job([1, 2, 4, 5, 6, 7, 8, 10], 3)
+        tasks_query = job.batchable_tasks_query(agent)
+        methods = [job.get_contiguous_batch_scan]
+        # The windowed query needs window functions, which sqlite only
+        # supports since 3.25
+        if (db.engine.name != "sqlite" or
+                sqlite3.sqlite_version_info >= (3, 25, 0)):
+            methods.append(job.get_contiguous_batch_windowed)
+
+        for method in methods:
+            self.assertEqual(
+                [x.frame for x in method(tasks_query, 3)], [4, 5, 6])
+            self.assertEqual(
+                [x.frame for x in method(tasks_query, 5)], [4, 5, 6, 7, 8])
+            self.assertEqual(
+                [x.frame for x in method(tasks_query, 6)], [1, 2])
+
+    def test_scan_limit(self):
+        job, agent = self.create_batch_job([1, 2, 4, 5, 6, 7, 8], 3)
+        scan_limit = job_module.BATCH_SCAN_LIMIT
+        try:
+            job_module.BATCH_SCAN_LIMIT = 4
+            batch = job.get_contiguous_batch_scan(
+                job.batchable_tasks_query(agent), 3)
+            self.assertEqual([x.frame for x in batch], [1, 2])
+
+            job_module.BATCH_SCAN_LIMIT = 5
+            batch = job.get_contiguous_batch_scan(
+                job.batchable_tasks_query(agent), 3)
+            self.assertEqual([x.frame for x in batch], [4, 5, 6])
+        finally:
+            job_module.BATCH_SCAN_LIMIT = scan_limit
+
+    def test_skip_failed_on_agent(self):
+        job, agent = self.create_batch_job([1, 2, 3, 4, 5], 3)
+        task = Task.query.filter_by(job=job, frame=2).one()
+        agent.failed_tasks.append(task)
+        db.session.commit()
+        batch = job.get_batch(agent)
+        self.assertEqual([x.frame for x in batch], [3, 4, 5])
+
+    def test_adaptive_batch_size(self):
+        job, agent = self.create_batch_job(range(1, 41), 2)
+        self.assertIsNone(TaskRuntimeStatistics.for_job(job))
+
+        # Finish three tasks which ran for ten seconds each, the
+        # statistics are recorded when the tasks are set to done
+        finished = Task.query.filter(Task.job == job, Task.frame <= 3).all()
+        for task in finished:
+            task.agent = agent
+            task.state = WorkState.RUNNING
+        db.session.commit()
+        for task in finished:
+            task.state = WorkState.DONE
+            task.time_finished = task.time_started + timedelta(seconds=10)
+        db.session.commit()
+        statistics = TaskRuntimeStatistics.for_job(job)
+        self.assertEqual(statistics.count, 3)
+        self.assertAlmostEqual(statistics.mean, 10, places=0)
+
+        target_duration = job_module.BATCH_TARGET_DURATION
+        try:
+            job_module.BATCH_TARGET_DURATION = None
+            self.assertEqual(job.get_batch_size(), 2)
+
+            job_module.BATCH_TARGET_DURATION = 60
+            self.assertEqual(job.get_batch_size(), 6)
+            self.assertEqual(len(job.get_batch(agent)), 6)
+
+            job.jobtype_version.max_batch = 4
+            self.assertEqual(job.get_batch_size(), 4)
+        finally:
+            job_module.BATCH_TARGET_DURATION = target_duration
+
+
+class TestUnfinishedParents(BaseTestCase):
+    def test_counter_follows_parents(self):
+        parent1 = create_job("Parent 1")
+        jobtype_version = parent1.jobtype_version
+        parent2 = create_job("Parent 2", jobtype_version=jobtype_version)
+        child = create_job("Child", jobtype_version=jobtype_version,
+                           parents=[parent1, parent2])
+        db.session.commit()
+        self.assertEqual(child.unfinished_parents, 2)
+
+        parent1.state = WorkState.DONE
+        db.session.commit()
+        self.assertEqual(child.unfinished_parents, 1)
+
+        parent2.state = WorkState.DONE
+        db.session.commit()
+        self.assertEqual(child.unfinished_parents, 0)
+
+        parent1.state = None
+        db.session.commit()
+        self.assertEqual(child.unfinished_parents, 1)
+
+        child.parents = [parent2]
+        db.session.commit()
+        self.assertEqual(child.unfinished_parents, 0)
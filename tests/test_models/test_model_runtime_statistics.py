@@ -0,0 +1,86 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import timedelta
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.core.enums import WorkState
+from pyfarm.master.application import db
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+from pyfarm.models.runtimestatistics import (
+    TaskRuntimeStatistics, JobTypeVersionRuntimeStatistics)
+
+
+class TestTaskRuntimeStatistics(BaseTestCase):
+    def create_job(self, frames):
+        jobtype = JobType(name="foo", description="this is a job type")
+        jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="class Foobar(JobType): pass".encode("utf-8"))
+        job = Job(title="Test Job", jobtype_version=jobtype_version)
+        tasks = [Task(job=job, frame=i) for i in range(frames)]
+        db.session.add_all([job] + tasks)
+        db.session.commit()
+        return job, tasks
+
+    def test_add(self):
+        statistics = TaskRuntimeStatistics()
+        self.assertIsNone(statistics.percentile(50))
+
+        for runtime in (10, 20, 30, 40, 1000):
+            statistics.add(runtime)
+
+        self.assertEqual(statistics.count, 5)
+        self.assertAlmostEqual(statistics.mean, 220)
+        self.assertAlmostEqual(statistics.variance(), 190250)
+        self.assertTrue(16 <= statistics.percentile(50) <= 32)
+        self.assertTrue(512 <= statistics.percentile(99) <= 1024)
+
+    def test_finished_tasks(self):
+        job, tasks = self.create_job(5)
+        for task in tasks[:3]:
+            task.state = WorkState.RUNNING
+            task.time_started = task.time_started - timedelta(seconds=60)
+            task.state = WorkState.DONE
+        db.session.commit()
+
+        statistics = TaskRuntimeStatistics.query.filter_by(
+            job_id=job.id).one()
+        self.assertEqual(statistics.count, 3)
+        self.assertAlmostEqual(statistics.mean, 60, places=0)
+        jobtype_statistics = JobTypeVersionRuntimeStatistics.query.filter_by(
+            jobtype_version_id=job.jobtype_version_id).one()
+        self.assertEqual(jobtype_statistics.count, 3)
+
+        # Finishing a task again does not count it twice
+        tasks[0].state = WorkState.DONE
+        db.session.commit()
+        self.assertEqual(TaskRuntimeStatistics.for_job(job).count, 3)
+
+        # Two tasks left to do on no agents
+        self.assertAlmostEqual(job.predict_remaining_time(), 120, places=0)
+        self.assertIsNotNone(job.predict_time_finished())
+
+    def test_no_statistics(self):
+        job, _ = self.create_job(2)
+        self.assertIsNone(TaskRuntimeStatistics.for_job(job))
+        self.assertIsNone(job.predict_remaining_time())
+        self.assertIsNone(job.predict_time_finished())
+        self.assertEqual(TaskRuntimeStatistics.load_means([job]), {})
@@ -0,0 +1,51 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.config import config
+from pyfarm.scheduler.agentclient import AgentClient, get_agent_client
+
+
+class TestAgentClient(BaseTestCase):
+    def test_session(self):
+        client = AgentClient(pool_agents=5, pool_connections=3, timeout=7,
+                             connect_timeout=2)
+        self.assertEqual(client.session.headers["User-Agent"],
+                         config.get("master_user_agent"))
+        self.assertEqual(client.timeout, (2, 7))
+
+        adapter = client.session.get_adapter("http://127.0.0.1:50000")
+        self.assertIs(client.session.get_adapter("https://127.0.0.1"),
+                      adapter)
+        self.assertEqual(adapter._pool_connections, 5)
+        self.assertEqual(adapter._pool_maxsize, 3)
+        client.close()
+
+    def test_timeout_without_connect_timeout(self):
+        client = AgentClient(timeout=7, connect_timeout=None)
+        if config.get("agent_connect_timeout") is None:
+            self.assertEqual(client.timeout, 7)
+        client.close()
+
+    def test_get_agent_client(self):
+        client = get_agent_client()
+        self.assertIs(get_agent_client(), client)
+
+        # A forked worker must not reuse the connections of its parent
+        client.pid = -1
+        self.assertIsNot(get_agent_client(), client)
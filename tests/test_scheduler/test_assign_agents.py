@@ -25,7 +25,9 @@ from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.job import Job
 from pyfarm.models.task import Task
 from pyfarm.models.jobqueue import JobQueue
-from pyfarm.scheduler.tasks import assign_tasks_to_agent
+from pyfarm.models import agent as agent_module
+from pyfarm.scheduler import tasks
+from pyfarm.scheduler.tasks import assign_tasks_to_agent, assign_tasks_batch
 
 class TestAssignAgent(BaseTestCase):
     def create_jobtype_version(self):
@@ -57,6 +59,52 @@ class TestAssignAgent(BaseTestCase):
 
         return queue
 
+    def test_assign_multiple_slots(self):
+        jobtype_version = self.create_jobtype_version()
+        for i in range(0, 3):
+            self.create_queue_with_job("queue%s" % i, jobtype_version)
+        agent = Agent(hostname="agent0", id=uuid.uuid4(), ram=128,
+                      free_ram=128, cpus=2, port=50000, cpu_allocation=1.0,
+                      ram_allocation=1.0)
+        db.session.add(agent)
+        db.session.commit()
+
+        multi_slot = agent_module.MULTI_SLOT, tasks.MULTI_SLOT
+        agent_module.MULTI_SLOT = tasks.MULTI_SLOT = True
+        try:
+            assign_tasks_to_agent(agent.id)
+            # Every job requires one cpu, so the agent has room for two
+            job_ids = set(x.job_id for x in
+                          Task.query.filter_by(agent_id=agent.id))
+            self.assertEqual(len(job_ids), 2)
+
+            # Nothing else fits until one of them is done
+            assign_tasks_to_agent(agent.id)
+            self.assertEqual(Task.query.filter_by(agent_id=agent.id).count(),
+                             2)
+        finally:
+            agent_module.MULTI_SLOT, tasks.MULTI_SLOT = multi_slot
+
+    def test_assign_by_affinity(self):
+        jobtype_version = self.create_jobtype_version()
+        self.create_queue_with_job("first", jobtype_version)
+        second_queue = self.create_queue_with_job("second", jobtype_version)
+        second_job = Job.query.filter_by(queue=second_queue).one()
+        agent = Agent(hostname="agent0", id=uuid.uuid4(), ram=32,
+                      free_ram=32, cpus=1, port=50000,
+                      last_job_id=second_job.id,
+                      last_jobtype_version_id=jobtype_version.id)
+        db.session.add(agent)
+        db.session.commit()
+
+        assign_tasks_to_agent(agent.id)
+
+        job_ids = set(x.job_id for x in
+                      Task.query.filter_by(agent_id=agent.id))
+        self.assertEqual(job_ids, set([second_job.id]))
+        agent = Agent.query.filter_by(id=agent.id).one()
+        self.assertEqual(agent.affinity_hits, 1)
+
     def test_assign_by_weight(self):
         jobtype_version = self.create_jobtype_version()
         high_queue = self.create_queue_with_job("heavyweight", jobtype_version)
@@ -127,3 +175,36 @@ class TestAssignAgent(BaseTestCase):
 
         self.assertGreaterEqual(low_queue.num_assigned_agents(), 9)
         self.assertLessEqual(low_queue.num_assigned_agents(), 11)
+
+    def test_assign_batch_by_weight(self):
+        jobtype_version = self.create_jobtype_version()
+        high_queue = self.create_queue_with_job("heavyweight", jobtype_version)
+        high_queue.weight = 60
+        mid_queue = self.create_queue_with_job("mediumweight", jobtype_version)
+        mid_queue.weight = 30
+        low_queue = self.create_queue_with_job("lightweight", jobtype_version)
+        low_queue.weight = 10
+        db.session.add_all([high_queue, mid_queue, low_queue])
+        db.session.commit()
+
+        agents = []
+        for i in range(0, 100):
+            agent = Agent(hostname="agent%s" % i, id=uuid.uuid4(), ram=32,
+                          free_ram=32, cpus=1, port=50000)
+            db.session.add(agent)
+            agents.append(agent)
+        db.session.commit()
+
+        assign_tasks_batch([agent.id for agent in agents])
+
+        for agent in agents:
+            self.assertEqual(Task.query.filter_by(agent=agent).count(), 1)
+
+        self.assertGreaterEqual(high_queue.num_assigned_agents(), 59)
+        self.assertLessEqual(high_queue.num_assigned_agents(), 61)
+
+        self.assertGreaterEqual(mid_queue.num_assigned_agents(), 29)
+        self.assertLessEqual(mid_queue.num_assigned_agents(), 31)
+
+        self.assertGreaterEqual(low_queue.num_assigned_agents(), 9)
+        self.assertLessEqual(low_queue.num_assigned_agents(), 11)
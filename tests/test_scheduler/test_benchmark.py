@@ -0,0 +1,66 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.models.agent import Agent
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+from pyfarm.scheduler.benchmark import (
+    generate_farm, run_benchmark, compare_reports, percentile)
+
+
+class TestBenchmark(BaseTestCase):
+    def test_generate_farm(self):
+        parameters = generate_farm(agents=5, queues=3, jobs=4,
+                                   tasks_per_job=10)
+        self.assertEqual(parameters["agents"], 5)
+        self.assertEqual(Agent.query.count(), 5)
+        self.assertEqual(Job.query.count(), 4)
+        self.assertEqual(Task.query.count(), 40)
+
+    def test_run_select(self):
+        generate_farm(agents=5, queues=3, jobs=4, tasks_per_job=10)
+        report = run_benchmark(mode="select")
+        self.assertEqual(report["agents"], 5)
+        self.assertEqual(Task.query.filter(Task.agent_id != None).count(), 0)
+        self.assertGreater(report["queries"], 0)
+
+    def test_run_assign(self):
+        generate_farm(agents=5, queues=3, jobs=4, tasks_per_job=10,
+                      software=0, tags=0)
+        report = run_benchmark(mode="assign", use_snapshot=True)
+        self.assertGreater(report["assignments"], 0)
+        self.assertEqual(Task.query.filter(Task.agent_id != None).count(),
+                         report["assignments"])
+
+    def test_compare_reports(self):
+        base = {"assignments_per_second": 100, "queries_per_assignment": 10,
+                "latency_p50": 0.01, "latency_p99": None}
+        new = {"assignments_per_second": 150, "queries_per_assignment": 5,
+               "latency_p50": 0.02, "latency_p99": 0.1}
+        changes = compare_reports(base, new)
+        self.assertAlmostEqual(changes["assignments_per_second"], 0.5)
+        self.assertAlmostEqual(changes["queries_per_assignment"], 0.5)
+        self.assertAlmostEqual(changes["latency_p50"], -1.0)
+        self.assertIsNone(changes["latency_p99"])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertIsNone(percentile([], 50))
@@ -0,0 +1,79 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.scheduler.locks import FileLock, DatabaseLock, renew_locks
+
+
+class LockTestMixin(object):
+    lock_class = NotImplemented
+
+    def test_acquire_release(self):
+        name = "test-%s" % uuid.uuid4().hex
+        lock = self.lock_class(name)
+        self.assertTrue(lock.acquire())
+        lock.release()
+        self.assertFalse(lock.locked)
+
+        other_lock = self.lock_class(name)
+        self.assertTrue(other_lock.acquire())
+        other_lock.release()
+
+    def test_contended(self):
+        name = "test-%s" % uuid.uuid4().hex
+        lock = self.lock_class(name)
+        other_lock = self.lock_class(name)
+        self.assertTrue(lock.acquire())
+        try:
+            self.assertFalse(other_lock.acquire())
+        finally:
+            lock.release()
+
+    def test_stale(self):
+        name = "test-%s" % uuid.uuid4().hex
+        lock = self.lock_class(name, ttl=-1)
+        other_lock = self.lock_class(name, ttl=-1)
+        self.assertTrue(lock.acquire())
+        self.assertTrue(other_lock.acquire())
+        other_lock.release()
+
+    def test_renew(self):
+        name = "test-%s" % uuid.uuid4().hex
+        lock = self.lock_class(name, ttl=-1)
+        other_lock = self.lock_class(name, ttl=-1)
+        self.assertTrue(lock.acquire())
+        self.assertTrue(lock.renewal_due())
+        self.assertTrue(renew_locks([lock]))
+
+        # A stale lock which was taken over can not be renewed anymore
+        self.assertTrue(other_lock.acquire())
+        try:
+            self.assertFalse(renew_locks([lock]))
+            self.assertFalse(lock.locked)
+        finally:
+            other_lock.release()
+
+
+class TestFileLock(BaseTestCase, LockTestMixin):
+    lock_class = FileLock
+
+
+class TestDatabaseLock(BaseTestCase, LockTestMixin):
+    lock_class = DatabaseLock
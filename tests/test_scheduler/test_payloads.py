@@ -0,0 +1,122 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.application import db
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.job import Job, JobNotifiedUser
+from pyfarm.models.tag import Tag
+from pyfarm.models.user import User
+from pyfarm.scheduler import payloads as payloads_module
+from pyfarm.scheduler.payloads import get_payloads
+
+
+class TestPayloads(BaseTestCase):
+    def setUp(self):
+        super(TestPayloads, self).setUp()
+        jobtype = JobType(name="foo", description="this is a job type")
+        jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="class Foobar(JobType): pass".encode("utf-8"))
+        self.user = User(username="someone", password="secret")
+        self.job = Job(title="job", jobtype_version=jobtype_version,
+                       user=self.user, data={"foo": "bar"})
+        self.job.tags.append(Tag(tag="tag1"))
+        db.session.add_all([self.job, JobNotifiedUser(
+            job=self.job, user=self.user, on_success=True, on_failure=False,
+            on_deletion=False)])
+        db.session.commit()
+
+    def test_payload(self):
+        job_payload, jobtype_payload = get_payloads([self.job.id])[self.job.id]
+        self.assertEqual(jobtype_payload, {"name": "foo", "version": 1})
+        self.assertEqual(job_payload["title"], "job")
+        self.assertEqual(job_payload["user"], "someone")
+        self.assertEqual(job_payload["data"], {"foo": "bar"})
+        self.assertEqual(job_payload["environ"], {})
+        self.assertEqual(job_payload["tags"], ["tag1"])
+        self.assertEqual(job_payload["notified_users"], [
+            {"username": "someone", "on_success": True, "on_failure": False,
+             "on_deletion": False}])
+        self.assertEqual(get_payloads([self.job.id + 1]), {})
+
+    def test_cached_until_edited(self):
+        job_id = self.job.id
+        payload = get_payloads([job_id])[job_id]
+        self.assertIs(get_payloads([job_id])[job_id][0], payload[0])
+
+        # Changes which are not part of the payload keep it
+        self.job.hidden = True
+        db.session.commit()
+        self.assertIs(get_payloads([job_id])[job_id][0], payload[0])
+
+        self.job.title = "renamed job"
+        db.session.commit()
+        self.assertEqual(self.job.payload_revision, 1)
+        job_payload = get_payloads([job_id])[job_id][0]
+        self.assertEqual(job_payload["title"], "renamed job")
+
+        self.job.tags.append(Tag(tag="tag2"))
+        db.session.commit()
+        job_payload = get_payloads([job_id])[job_id][0]
+        self.assertEqual(sorted(job_payload["tags"]), ["tag1", "tag2"])
+
+        db.session.delete(self.job.notified_users.one())
+        db.session.commit()
+        job_payload = get_payloads([job_id])[job_id][0]
+        self.assertEqual(job_payload["notified_users"], [])
+        self.assertEqual(self.job.payload_revision, 3)
+
+    def test_referenced_rows_edited(self):
+        job_id = self.job.id
+
+        self.user.username = "someone else"
+        db.session.commit()
+        job_payload = get_payloads([job_id])[job_id][0]
+        self.assertEqual(job_payload["user"], "someone else")
+        self.assertEqual(job_payload["notified_users"][0]["username"],
+                         "someone else")
+
+        self.job.tags.one().tag = "renamed tag"
+        db.session.commit()
+        job_payload = get_payloads([job_id])[job_id][0]
+        self.assertEqual(job_payload["tags"], ["renamed tag"])
+
+        tag = Tag(tag="tag2")
+        tag.jobs.append(self.job)
+        db.session.add(tag)
+        db.session.commit()
+        job_payload = get_payloads([job_id])[job_id][0]
+        self.assertEqual(sorted(job_payload["tags"]), ["renamed tag", "tag2"])
+
+        self.job.jobtype_version.jobtype.name = "bar"
+        db.session.commit()
+        jobtype_payload = get_payloads([job_id])[job_id][1]
+        self.assertEqual(jobtype_payload["name"], "bar")
+        self.assertEqual(self.job.payload_revision, 4)
+
+    def test_cache_max_age(self):
+        job_id = self.job.id
+        payload = get_payloads([job_id])[job_id]
+
+        max_age = payloads_module.PAYLOAD_CACHE_MAX_AGE
+        payloads_module.PAYLOAD_CACHE_MAX_AGE = -1
+        try:
+            self.assertIsNot(get_payloads([job_id])[job_id][0], payload[0])
+        finally:
+            payloads_module.PAYLOAD_CACHE_MAX_AGE = max_age
@@ -0,0 +1,191 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import uuid
+from json import dumps
+from threading import Thread
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.core.enums import AgentState, UseAgentAddress, WorkState
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.models.agent import Agent
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+from pyfarm.scheduler.poller import (
+    PollTarget, poll_concurrently, apply_results)
+
+
+class StubAgent(object):
+    """An HTTP server answering the requests the poller makes to agents"""
+    def __init__(self, agent_id, state="running", task_ids=()):
+        self.responses = {
+            "/api/v1/status": {"agent_id": str(agent_id), "state": state,
+                               "free_ram": 16,
+                               "farm_name": config.get("farm_name")},
+            "/api/v1/tasks/": [{"id": x} for x in task_ids]}
+
+        responses = self.responses
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = dumps(responses[self.path]).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("localhost", 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestPoller(BaseTestCase):
+    def setUp(self):
+        super(TestPoller, self).setUp()
+        jobtype = JobType(name="foo", description="this is a job type")
+        jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="class Foobar(JobType): pass".encode("utf-8"))
+        self.job = Job(title="job", jobtype_version=jobtype_version)
+        db.session.add(self.job)
+        self.stubs = []
+
+    def tearDown(self):
+        for stub in self.stubs:
+            stub.stop()
+        super(TestPoller, self).tearDown()
+
+    def create_agent(self, port, agent_id=None):
+        agent = Agent(hostname="localhost", id=agent_id or uuid.uuid4(),
+                      port=port, ram=32, free_ram=32, cpus=1,
+                      state=AgentState.ONLINE,
+                      use_address=UseAgentAddress.HOSTNAME)
+        db.session.add(agent)
+        return agent
+
+    def create_stub(self, agent_id, **kwargs):
+        stub = StubAgent(agent_id, **kwargs)
+        self.stubs.append(stub)
+        return stub
+
+    def poll(self, agents):
+        targets = [PollTarget.from_agent(x) for x in agents]
+        return apply_results(poll_concurrently(targets, retries=0))
+
+    def test_poll(self):
+        agent_id = uuid.uuid4()
+        other_agent = self.create_agent(50000)
+        missing_task = Task(job=self.job, frame=1, state=WorkState.RUNNING)
+        present_task = Task(job=self.job, frame=2, state=WorkState.RUNNING)
+        foreign_task = Task(job=self.job, frame=3, state=WorkState.RUNNING)
+        db.session.add_all([missing_task, present_task, foreign_task])
+        db.session.flush()
+        foreign_task.agent = other_agent
+        stub = self.create_stub(
+            agent_id, task_ids=[present_task.id, foreign_task.id])
+        agent = self.create_agent(stub.port, agent_id)
+        missing_task.agent = agent
+        present_task.agent = agent
+        db.session.commit()
+
+        agents_missing_tasks, tasks_to_stop = self.poll([agent])
+        self.assertEqual(agents_missing_tasks, [agent_id])
+        self.assertEqual(tasks_to_stop, [(foreign_task.id, agent_id)])
+
+        agent = Agent.query.filter_by(id=agent_id).one()
+        self.assertEqual(agent.state, AgentState.RUNNING)
+        self.assertEqual(agent.free_ram, 16)
+        self.assertIsNotNone(agent.last_heard_from)
+
+    def test_many_agents(self):
+        agents = []
+        for _ in range(10):
+            agent_id = uuid.uuid4()
+            agents.append(self.create_agent(
+                self.create_stub(agent_id).port, agent_id))
+        db.session.commit()
+
+        self.assertEqual(self.poll(agents), ([], []))
+        for agent in Agent.query:
+            self.assertIsNotNone(agent.last_heard_from)
+
+    def free_port(self):
+        # Nothing listens on a port which was just released
+        sock = socket.socket()
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def test_unreachable(self):
+        agent = self.create_agent(self.free_port())
+        task = Task(job=self.job, frame=1, state=WorkState.RUNNING)
+        db.session.add(task)
+        db.session.flush()
+        task.agent = agent
+        db.session.commit()
+        agent_id, task_id = agent.id, task.id
+
+        self.assertEqual(self.poll([agent]), ([], []))
+        agent = Agent.query.filter_by(id=agent_id).one()
+        self.assertEqual(agent.state, AgentState.OFFLINE)
+        self.assertIsNotNone(agent.last_polled)
+        self.assertIsNone(Task.query.filter_by(id=task_id).one().state)
+
+    def test_retry_unreachable(self):
+        agent_id = uuid.uuid4()
+        agent = self.create_agent(self.create_stub(agent_id).port, agent_id)
+        unreachable_agent = self.create_agent(self.free_port())
+        db.session.commit()
+
+        targets = [PollTarget.from_agent(x)
+                   for x in (unreachable_agent, agent)]
+        results = poll_concurrently(targets, retries=2, retry_delay=0)
+        self.assertEqual([x.target for x in results], targets)
+        self.assertTrue(results[0].unreachable)
+        self.assertFalse(results[1].unreachable)
+        self.assertIsNone(results[1].error)
+
+    def test_wrong_agent(self):
+        stub = self.create_stub(uuid.uuid4())
+        agent = self.create_agent(stub.port)
+        db.session.commit()
+        agent_id, last_heard_from = agent.id, agent.last_heard_from
+
+        self.assertEqual(self.poll([agent]), ([], []))
+        agent = Agent.query.filter_by(id=agent_id).one()
+        self.assertEqual(agent.state, AgentState.ONLINE)
+        self.assertEqual(agent.last_heard_from, last_heard_from)
@@ -0,0 +1,122 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+from datetime import datetime, timedelta
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.core.enums import WorkState
+from pyfarm.master.application import db
+from pyfarm.models.agent import Agent
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.scheduler.preemption import (
+    agent_deficit, find_starving_jobs, load_busy_agents, select_victims,
+    hand_over)
+
+
+class TestPreemption(BaseTestCase):
+    def setUp(self):
+        super(TestPreemption, self).setUp()
+        jobtype = JobType(name="foo", description="this is a job type")
+        self.jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="class Foobar(JobType): pass".encode("utf-8"))
+        db.session.add(self.jobtype_version)
+
+    def create_job(self, title, priority, frames=1, **kwargs):
+        job = Job(title=title, jobtype_version=self.jobtype_version,
+                  priority=priority, **kwargs)
+        db.session.add_all(Task(job=job, frame=i) for i in range(frames))
+        db.session.add(job)
+        return job
+
+    def create_busy_agent(self, i, job, progress, age):
+        agent = Agent(hostname="agent%s" % i, id=uuid.uuid4(), ram=32,
+                      free_ram=32, cpus=1, port=50000)
+        db.session.add(agent)
+        task = Task(job=job, frame=100 + i, agent=agent, attempts=0,
+                    progress=progress)
+        task.state = WorkState.RUNNING
+        task.time_started = datetime.utcnow() - age
+        db.session.add(task)
+        return agent
+
+    def test_agent_deficit(self):
+        queue = JobQueue(name="queue", minimum_agents=3)
+        no_agents = self.create_job("no agents", 0)
+        below_minimum = self.create_job("below minimum", 0, minimum_agents=2)
+        queued = self.create_job("queued", 0, queue=queue)
+        capped = self.create_job("capped", 0, queue=queue, maximum_agents=1)
+        db.session.commit()
+
+        self.assertEqual(agent_deficit(no_agents), 1)
+        self.assertEqual(agent_deficit(below_minimum), 2)
+        self.assertEqual(agent_deficit(queued), 3)
+        self.assertEqual(agent_deficit(capped), 1)
+
+    def test_find_starving_jobs(self):
+        low = self.create_job("low", 0, frames=0)
+        high = self.create_job("high", 10)
+        self.create_busy_agent(0, low, 0.5, timedelta(hours=1))
+        db.session.commit()
+
+        self.assertEqual(find_starving_jobs(), [(high, 1)])
+
+    def test_select_victims(self):
+        low = self.create_job("low", 0, frames=0)
+        lower = self.create_job("lower", -10, frames=0)
+        equal = self.create_job("equal", 10, frames=0)
+        high = self.create_job("high", 10)
+        advanced = self.create_busy_agent(0, lower, 0.9, timedelta(hours=1))
+        behind = self.create_busy_agent(1, lower, 0.1, timedelta(hours=1))
+        less_important = self.create_busy_agent(
+            2, low, 0.0, timedelta(hours=1))
+        self.create_busy_agent(3, lower, 0.0, timedelta(seconds=1))
+        self.create_busy_agent(4, equal, 0.0, timedelta(hours=1))
+        db.session.commit()
+
+        busy_agents = load_busy_agents()
+        self.assertEqual(len(busy_agents), 5)
+        self.assertEqual(select_victims(high, 1, busy_agents), [behind.id])
+        self.assertEqual(select_victims(high, 5, busy_agents),
+                         [advanced.id, less_important.id])
+        self.assertEqual(select_victims(high, 5, busy_agents), [])
+
+    def test_hand_over(self):
+        low = self.create_job("low", 0, frames=0)
+        high = self.create_job("high", 10, frames=3)
+        agent = self.create_busy_agent(0, low, 0.5, timedelta(hours=1))
+        db.session.commit()
+        low_task = low.tasks.one()
+
+        self.assertEqual(hand_over(agent, high), [low_task.id])
+        db.session.commit()
+        self.assertIsNone(low_task.agent_id)
+        self.assertIsNone(low_task.state)
+        self.assertEqual(high.state, WorkState.RUNNING)
+        self.assertEqual(
+            [x.frame for x in Task.query.filter_by(agent_id=agent.id)], [0])
+
+        # Nothing changes if the job has no tasks left for the agent
+        empty = self.create_job("empty", 10, frames=0)
+        db.session.commit()
+        self.assertIsNone(hand_over(agent, empty))
+        self.assertEqual(Task.query.filter_by(agent_id=agent.id).count(), 1)
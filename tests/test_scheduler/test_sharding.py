@@ -0,0 +1,105 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.application import db
+from pyfarm.models.agent import Agent
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.scheduler.snapshot import SchedulerSnapshot
+from pyfarm.scheduler.sharding import (
+    ROOT_SHARD, shard_of, shard_queue, partition_agents, get_lease)
+
+
+class TestSharding(BaseTestCase):
+    def setUp(self):
+        super(TestSharding, self).setUp()
+        jobtype = JobType(name="foo", description="this is a job type")
+        self.jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="class Foobar(JobType): pass".encode("utf-8"))
+        db.session.add(self.jobtype_version)
+
+    def create_job(self, title, queue=None):
+        job = Job(title=title, jobtype_version=self.jobtype_version,
+                  queue=queue)
+        db.session.add_all(Task(job=job, frame=i) for i in range(100))
+        db.session.add(job)
+        return job
+
+    def create_agents(self, num_agents):
+        agents = [Agent(hostname="agent%s" % i, id=uuid.uuid4(), ram=32,
+                        free_ram=32, cpus=1, port=50000)
+                  for i in range(num_agents)]
+        db.session.add_all(agents)
+        return agents
+
+    def test_shard_of(self):
+        top = JobQueue(name="top")
+        sub = JobQueue(name="sub", parent=top)
+        top_job = self.create_job("top job", top)
+        sub_job = self.create_job("sub job", sub)
+        root_job = self.create_job("root job")
+        db.session.commit()
+
+        snapshot = SchedulerSnapshot.load()
+        self.assertEqual(shard_of(snapshot, top_job.id), top.id)
+        self.assertEqual(shard_of(snapshot, sub_job.id), top.id)
+        self.assertEqual(shard_of(snapshot, root_job.id), ROOT_SHARD)
+        self.assertIs(shard_queue(snapshot, top.id), snapshot.queues[top.id])
+        self.assertIs(shard_queue(snapshot, ROOT_SHARD), snapshot.root)
+        self.assertIsNone(shard_queue(snapshot, sub.id + 100))
+
+    def test_partition_agents(self):
+        heavy = JobQueue(name="heavy", weight=3)
+        light = JobQueue(name="light", weight=1)
+        self.create_job("heavy job", heavy)
+        self.create_job("light job", light)
+        agents = self.create_agents(8)
+        db.session.commit()
+
+        snapshot = SchedulerSnapshot.load()
+        shards = partition_agents(snapshot, [x.id for x in agents])
+        self.assertEqual(len(shards[heavy.id]), 6)
+        self.assertEqual(len(shards[light.id]), 2)
+
+    def test_root_shard_jobs_only(self):
+        queue = JobQueue(name="queue", priority=10)
+        self.create_job("queued job", queue)
+        root_job = self.create_job("root job")
+        agent = self.create_agents(1)[0]
+        db.session.commit()
+
+        snapshot = SchedulerSnapshot.load()
+        self.assertNotEqual(snapshot.select_job(agent.id).id, root_job.id)
+        self.assertEqual(snapshot.select_job(
+            agent.id, queue=shard_queue(snapshot, ROOT_SHARD),
+            jobs_only=True).id, root_job.id)
+
+    def test_lease(self):
+        lease = get_lease(ROOT_SHARD)
+        self.assertTrue(lease.acquire())
+        self.assertFalse(get_lease(ROOT_SHARD).acquire())
+        lease.release()
+        lease = get_lease(ROOT_SHARD)
+        self.assertTrue(lease.acquire())
+        lease.release()
@@ -0,0 +1,187 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.core.enums import WorkState
+from pyfarm.master.application import db
+from pyfarm.models.agent import Agent
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+from pyfarm.models.tag import Tag, JobTagRequirement
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.runtimestatistics import TaskRuntimeStatistics
+from pyfarm.scheduler import snapshot as snapshot_module
+from pyfarm.scheduler.snapshot import SchedulerSnapshot
+
+
+class TestSchedulerSnapshot(BaseTestCase):
+    def create_jobtype_version(self):
+        jobtype = JobType()
+        jobtype.name = "foo"
+        jobtype.description = "this is a job type"
+        jobtype_version = JobTypeVersion()
+        jobtype_version.jobtype = jobtype
+        jobtype_version.version = 1
+        jobtype_version.classname = "Foobar"
+        jobtype_version.code = ("""
+            class Foobar(JobType):
+                pass""").encode("utf-8")
+        db.session.add(jobtype_version)
+        db.session.flush()
+
+        return jobtype_version
+
+    def create_queue_with_job(self, name, jobtype_version, num_tasks=100):
+        queue = JobQueue(name=name)
+        job = Job(title="Test Job %s" % name, jobtype_version=jobtype_version,
+                  queue=queue)
+
+        for i in range(0, num_tasks):
+            task = Task(job=job, frame=i)
+            db.session.add(task)
+        db.session.add(job)
+        db.session.flush()
+
+        return queue, job
+
+    def create_agent(self, i):
+        agent = Agent(hostname="agent%s" % i, id=uuid.uuid4(), ram=32,
+                      free_ram=32, cpus=1, port=50000)
+        db.session.add(agent)
+        return agent
+
+    def test_load(self):
+        jobtype_version = self.create_jobtype_version()
+        queue, job = self.create_queue_with_job("queue", jobtype_version)
+        agent = self.create_agent(0)
+        db.session.commit()
+
+        snapshot = SchedulerSnapshot.load()
+        self.assertIn(queue.id, snapshot.queues)
+        self.assertIn(job.id, snapshot.jobs)
+        self.assertIn(agent.id, snapshot.agents)
+        self.assertEqual(snapshot.jobs[job.id].unassigned_tasks, 100)
+        self.assertEqual(snapshot.queues[queue.id].num_assigned_agents(), 0)
+
+    def test_same_decision_as_jobqueue(self):
+        jobtype_version = self.create_jobtype_version()
+        high_queue, _ = self.create_queue_with_job("high", jobtype_version)
+        high_queue.priority = 10
+        low_queue, _ = self.create_queue_with_job("low", jobtype_version)
+        agent = self.create_agent(0)
+        db.session.commit()
+
+        expected = JobQueue().get_job_for_agent(agent, [])
+        snapshot = SchedulerSnapshot.load(agent_ids=[agent.id])
+        self.assertEqual(snapshot.get_job_for_agent(agent, []), expected)
+
+    def test_tag_requirements(self):
+        jobtype_version = self.create_jobtype_version()
+        _, job = self.create_queue_with_job("queue", jobtype_version)
+        tag = Tag(tag="gpu")
+        requirement = JobTagRequirement(job=job, tag=tag)
+        db.session.add(requirement)
+        agent = self.create_agent(0)
+        db.session.commit()
+
+        snapshot = SchedulerSnapshot.load(agent_ids=[agent.id])
+        self.assertIsNone(snapshot.select_job(agent.id))
+
+        agent.tags.append(tag)
+        db.session.commit()
+        snapshot = SchedulerSnapshot.load(agent_ids=[agent.id])
+        self.assertEqual(snapshot.select_job(agent.id).id, job.id)
+
+    def test_record_assignment_by_weight(self):
+        jobtype_version = self.create_jobtype_version()
+        high_queue, _ = self.create_queue_with_job("high", jobtype_version)
+        high_queue.weight = 6
+        mid_queue, _ = self.create_queue_with_job("mid", jobtype_version)
+        mid_queue.weight = 3
+        low_queue, _ = self.create_queue_with_job("low", jobtype_version)
+        low_queue.weight = 1
+        agents = [self.create_agent(i) for i in range(0, 100)]
+        db.session.commit()
+
+        snapshot = SchedulerSnapshot.load()
+        for agent in agents:
+            job = snapshot.select_job(agent.id)
+            self.assertIsNotNone(job)
+            snapshot.record_assignment(job.id, agent.id, 1)
+            self.assertEqual(job.state, WorkState.RUNNING)
+
+        high = snapshot.queues[high_queue.id].num_assigned_agents()
+        mid = snapshot.queues[mid_queue.id].num_assigned_agents()
+        low = snapshot.queues[low_queue.id].num_assigned_agents()
+        self.assertGreaterEqual(high, 59)
+        self.assertLessEqual(high, 61)
+        self.assertGreaterEqual(mid, 29)
+        self.assertLessEqual(mid, 31)
+        self.assertGreaterEqual(low, 9)
+        self.assertLessEqual(low, 11)
+
+    def test_shortest_remaining_first(self):
+        jobtype_version = self.create_jobtype_version()
+        queue, unknown = self.create_queue_with_job(
+            "queue", jobtype_version, num_tasks=1)
+        known = Job(title="Known Job", jobtype_version=jobtype_version,
+                    queue=queue)
+        db.session.add_all(Task(job=known, frame=i) for i in range(0, 100))
+        db.session.flush()
+        unknown.state = WorkState.RUNNING
+        known.state = WorkState.RUNNING
+        db.session.add(TaskRuntimeStatistics(
+            job_id=known.id, jobtype_version_id=jobtype_version.id,
+            count=1, mean=10.0))
+        agent = self.create_agent(0)
+        db.session.commit()
+
+        shortest_remaining_first = snapshot_module.SHORTEST_REMAINING_FIRST
+        try:
+            # Jobs without statistics are not assumed to be short
+            snapshot_module.SHORTEST_REMAINING_FIRST = True
+            snapshot = SchedulerSnapshot.load()
+            self.assertEqual(snapshot.jobs[known.id].remaining_work(), 1000)
+            self.assertEqual(snapshot.select_job(agent.id).id, known.id)
+
+            snapshot_module.SHORTEST_REMAINING_FIRST = False
+            snapshot = SchedulerSnapshot.load()
+            self.assertEqual(snapshot.select_job(agent.id).id, unknown.id)
+        finally:
+            snapshot_module.SHORTEST_REMAINING_FIRST = shortest_remaining_first
+
+    def test_record_assignment_counts_agent_once(self):
+        jobtype_version = self.create_jobtype_version()
+        queue, job = self.create_queue_with_job("queue", jobtype_version)
+        other_job = Job(title="Other Job", jobtype_version=jobtype_version,
+                        queue=queue)
+        db.session.add(Task(job=other_job, frame=1))
+        agent = self.create_agent(0)
+        job.tasks.first().agent = agent
+        db.session.commit()
+
+        snapshot = SchedulerSnapshot.load()
+        self.assertEqual(snapshot.queues[queue.id].num_assigned_agents(), 1)
+        snapshot.record_assignment(job.id, agent.id, 1)
+        snapshot.record_assignment(other_job.id, agent.id, 1)
+        self.assertEqual(snapshot.jobs[job.id].num_assigned_agents(), 1)
+        self.assertEqual(snapshot.jobs[other_job.id].num_assigned_agents(), 1)
+        self.assertEqual(snapshot.queues[queue.id].num_assigned_agents(), 1)
@@ -0,0 +1,129 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+from datetime import datetime, timedelta
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.core.enums import WorkState
+from pyfarm.master.application import db
+from pyfarm.models.agent import Agent
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+from pyfarm.scheduler.speculation import (
+    find_stragglers, load_idle_agents, select_agent, find_stale_speculations)
+
+
+class TestSpeculation(BaseTestCase):
+    def setUp(self):
+        super(TestSpeculation, self).setUp()
+        jobtype = JobType(name="foo", description="this is a job type")
+        jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="class Foobar(JobType): pass".encode("utf-8"))
+        self.job = Job(title="Test Job", jobtype_version=jobtype_version)
+        self.job.state = WorkState.RUNNING
+        db.session.add(self.job)
+
+        # Five tasks which took a minute each
+        tasks = [Task(job=self.job, frame=i) for i in range(5)]
+        db.session.add_all(tasks)
+        db.session.commit()
+        for task in tasks:
+            task.state = WorkState.RUNNING
+            task.time_started = task.time_started - timedelta(seconds=60)
+            task.state = WorkState.DONE
+        db.session.commit()
+
+    def create_agent(self, i):
+        agent = Agent(hostname="agent%s" % i, id=uuid.uuid4(), ram=32,
+                      free_ram=32, cpus=1, port=50000)
+        db.session.add(agent)
+        return agent
+
+    def create_running_task(self, frame, agent, age):
+        task = Task(job=self.job, frame=frame)
+        db.session.add(task)
+        db.session.flush()
+        task.agent = agent
+        task.state = WorkState.RUNNING
+        task.time_started = datetime.utcnow() - age
+        return task
+
+    def test_find_stragglers(self):
+        slow = self.create_running_task(
+            10, self.create_agent(0), timedelta(minutes=10))
+        self.create_running_task(
+            11, self.create_agent(1), timedelta(seconds=30))
+        db.session.commit()
+
+        self.assertEqual(find_stragglers(), [slow])
+
+        # Not while there are tasks waiting for an agent
+        db.session.add(Task(job=self.job, frame=12))
+        db.session.commit()
+        self.assertEqual(find_stragglers(), [])
+
+    def test_select_agent(self):
+        owner = self.create_agent(0)
+        failed = self.create_agent(1)
+        idle = self.create_agent(2)
+        task = self.create_running_task(10, owner, timedelta(minutes=10))
+        failed.failed_tasks.append(task)
+        db.session.commit()
+
+        idle_agents = load_idle_agents()
+        self.assertEqual(set(idle_agents), set([failed, idle]))
+        self.assertEqual(select_agent(task, idle_agents), idle)
+        self.assertEqual(idle_agents, [failed])
+        self.assertIsNone(select_agent(task, idle_agents))
+
+    def test_speculation(self):
+        owner = self.create_agent(0)
+        copy = self.create_agent(1)
+        task = self.create_running_task(10, owner, timedelta(minutes=10))
+        db.session.commit()
+        attempts = task.attempts
+
+        # The copy runs as a new attempt
+        task.start_speculation(copy.id)
+        db.session.commit()
+        self.assertEqual(task.attempts, attempts + 1)
+        self.assertEqual(load_idle_agents(), [])
+        self.assertEqual(find_stragglers(), [])
+        self.assertEqual(find_stale_speculations(), [])
+
+        # The agent of the copy owns the task once the copy finished first
+        self.assertEqual(task.promote_speculation(), owner.id)
+        db.session.commit()
+        self.assertEqual(task.agent_id, copy.id)
+        self.assertIsNone(task.speculative_agent_id)
+        self.assertEqual(task.attempts, attempts + 1)
+
+    def test_stale_speculation(self):
+        task = self.create_running_task(
+            10, self.create_agent(0), timedelta(minutes=10))
+        copy = self.create_agent(1)
+        db.session.commit()
+        task.start_speculation(copy.id)
+        task.state = WorkState.DONE
+        db.session.commit()
+
+        self.assertEqual(find_stale_speculations(), [task])
+        self.assertEqual(task.end_speculation(), copy.id)
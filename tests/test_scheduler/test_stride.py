@@ -0,0 +1,90 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from random import Random
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.scheduler.stride import StrideHeap, affinity_order, fair_share
+
+
+class TestStrideHeap(BaseTestCase):
+    def keys(self, heap, *args):
+        return [x[2] for x in heap.ordered(*args)]
+
+    def test_ordered(self):
+        heap = StrideHeap()
+        heap.push("high", "high", 6, 6, True)
+        heap.push("mid", "mid", 2, 3, True)
+        heap.push("low", "low", 2, 1, True)
+        heap.push("new", "new", 0, 10, False)
+        self.assertEqual(heap.total_assigned, 10)
+        self.assertEqual(heap.weight_sum, 10)
+        self.assertEqual(self.keys(heap), ["new", "mid", "high", "low"])
+
+        # The mid job catches up
+        heap.push("mid", "mid", 4, 3, True)
+        self.assertEqual(heap.total_assigned, 12)
+        self.assertEqual(self.keys(heap), ["new", "high", "mid", "low"])
+        self.assertEqual(len(heap), 4)
+
+    def test_unweighted(self):
+        heap = StrideHeap()
+        heap.push("weighted", "weighted", 1, 2, True)
+        heap.push("unweighted", "unweighted", 1, 0, True)
+        self.assertEqual(heap.num_unweighted, 1)
+
+        # Half of the agents for all of the weight is a share of 0.5, just
+        # like half of the agents without any weight
+        self.assertEqual(self.keys(heap), ["unweighted", "weighted"])
+        self.assertEqual(self.keys(heap, 2, 1), ["weighted", "unweighted"])
+        self.assertEqual(self.keys(heap, 2, 10), ["unweighted", "weighted"])
+
+    def test_same_order_as_sorting(self):
+        random = Random(42)
+        for _ in range(100):
+            heap = StrideHeap()
+            items = {}
+            for i in range(random.randint(0, 20)):
+                active = random.random() < 0.8
+                items[i] = [random.randint(0, 10) if active else 0,
+                            random.choice([0, 1, 2, 5, 10]), active,
+                            random.choice([0, 10]), random.choice([0, 0, 1])]
+                heap.push(i, i, *items[i][:4])
+
+            for _ in range(random.randint(0, 20)):
+                if items:
+                    i = random.choice(list(items))
+                    items[i][0] += 1
+                    items[i][2] = True
+                    heap.push(i, i, *items[i][:4])
+
+            total_assigned = sum(x[0] for x in items.values())
+            weight_sum = sum(x[1] for x in items.values() if x[2])
+            tolerance = random.choice([0, 0.5])
+
+            def sort_key(share, i):
+                if not items[i][4]:
+                    return share, 0
+                return share - tolerance, -items[i][4]
+
+            expected = sorted(items, key=lambda i: sort_key(
+                fair_share(items[i][0], items[i][1], total_assigned,
+                           weight_sum), i) + (items[i][3], ))
+            self.assertEqual(
+                list(affinity_order(heap.ordered(), sort_key, tolerance)),
+                expected)
@@ -0,0 +1,149 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+import shutil
+import tempfile
+from os.path import join
+from threading import Thread
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.application import db
+from pyfarm.models.agent import Agent
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.job import Job
+from pyfarm.models.task import Task
+from pyfarm.models.tag import Tag, JobTagRequirement
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.scheduler import tracing
+from pyfarm.scheduler.snapshot import SchedulerSnapshot
+from pyfarm.scheduler.tracing import (
+    SchedulerTrace, NULL_TRACE, start_trace, read_traces, REJECT_TAGS,
+    REJECT_NO_TASKS)
+
+
+class TestSchedulerTrace(BaseTestCase):
+    def setup_app(self):
+        super(TestSchedulerTrace, self).setup_app()
+        self.trace_dir = tempfile.mkdtemp()
+        self.trace_file = tracing.TRACE_FILE
+        self.trace_enabled = tracing.TRACE_ENABLED
+        tracing.TRACE_FILE = join(self.trace_dir, "traces.jsonl")
+        tracing._trace_logger = None
+
+    def teardown_app(self):
+        if tracing._trace_logger is not None:
+            for handler in list(tracing._trace_logger.handlers):
+                tracing._trace_logger.removeHandler(handler)
+                handler.close()
+        tracing._trace_logger = None
+        tracing.TRACE_FILE = self.trace_file
+        tracing.TRACE_ENABLED = self.trace_enabled
+        shutil.rmtree(self.trace_dir, ignore_errors=True)
+        super(TestSchedulerTrace, self).teardown_app()
+
+    def create_queue_with_tagged_job(self):
+        jobtype = JobType(name="foo", description="this is a job type")
+        jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="class Foobar(JobType): pass".encode("utf-8"))
+        queue = JobQueue(name="queue")
+        job = Job(title="Test Job", jobtype_version=jobtype_version,
+                  queue=queue)
+        db.session.add_all(Task(job=job, frame=i) for i in range(10))
+        db.session.add(JobTagRequirement(job=job, tag=Tag(tag="gpu")))
+        agent = Agent(hostname="agent1", id=uuid.uuid4(), ram=32,
+                      free_ram=32, cpus=1, port=50000)
+        db.session.add_all([job, agent])
+        db.session.commit()
+        return queue, job, agent
+
+    def test_disabled(self):
+        tracing.TRACE_ENABLED = False
+        self.assertIs(start_trace(uuid.uuid4()), NULL_TRACE)
+        with NULL_TRACE.phase("commit"):
+            pass
+        NULL_TRACE.reject_job(1, REJECT_TAGS)
+        NULL_TRACE.finish()
+        self.assertEqual(read_traces(), [])
+
+    def test_phases(self):
+        agent_id = uuid.uuid4()
+        trace = SchedulerTrace(agent_id)
+        with trace.phase("commit"):
+            Agent.query.count()
+        trace.finish(job_ids=[], tasks=0)
+
+        traces = read_traces()
+        self.assertEqual(len(traces), 1)
+        self.assertEqual(traces[0]["agent_id"], str(agent_id))
+        self.assertEqual(traces[0]["phases"]["commit"]["queries"], 1)
+        self.assertEqual(traces[0]["tasks"], 0)
+
+        # Only the first call to finish() writes the trace
+        trace.finish(job_ids=[], tasks=0)
+        self.assertEqual(len(read_traces()), 1)
+
+    def test_concurrent_traces(self):
+        trace = SchedulerTrace(uuid.uuid4())
+
+        # Statements of other threads do not count towards the trace
+        engine = db.engine
+        thread = Thread(target=lambda: engine.execute("SELECT 1"))
+        thread.start()
+        thread.join()
+        self.assertEqual(trace.counter.count, 0)
+
+        Agent.query.count()
+        self.assertEqual(trace.counter.count, 1)
+        trace.finish()
+
+    def test_read_traces_filters(self):
+        agent_ids = [uuid.uuid4(), uuid.uuid4()]
+        for agent_id in agent_ids + agent_ids:
+            SchedulerTrace(agent_id).finish()
+
+        self.assertEqual(len(read_traces()), 4)
+        self.assertEqual(len(read_traces(limit=3)), 3)
+        traces = read_traces(agent_id=agent_ids[0])
+        self.assertEqual(len(traces), 2)
+        self.assertEqual(
+            len(read_traces(cycle_id=traces[0]["cycle_id"])), 1)
+
+    def test_jobqueue_rejections(self):
+        queue, job, agent = self.create_queue_with_tagged_job()
+
+        trace = SchedulerTrace(agent.id)
+        self.assertIsNone(JobQueue().get_job_for_agent(agent, [], trace))
+        self.assertIn({"type": "job", "id": job.id, "reason": REJECT_TAGS},
+                      trace.rejections)
+        self.assertIn({"type": "queue", "id": queue.id,
+                       "reason": REJECT_NO_TASKS}, trace.rejections)
+        self.assertIn("candidate_query", trace.phases)
+        self.assertIn("requirement_checks", trace.phases)
+        trace.finish()
+
+    def test_snapshot_rejections(self):
+        queue, job, agent = self.create_queue_with_tagged_job()
+
+        trace = SchedulerTrace(agent.id)
+        snapshot = SchedulerSnapshot.load(agent_ids=[agent.id])
+        self.assertIsNone(snapshot.get_job_for_agent(agent, [], trace))
+        self.assertIn({"type": "job", "id": job.id, "reason": REJECT_TAGS},
+                      trace.rejections)
+        trace.finish()
@@ -0,0 +1,91 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.application import db
+from pyfarm.models.agent import Agent
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.job import Job
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.software import (
+    Software, SoftwareVersion, JobTypeSoftwareRequirement)
+from pyfarm.models.schedulertrigger import SchedulerTrigger
+from pyfarm.scheduler.triggers import (
+    pop_triggers, has_pending_triggers, affected_agent_ids)
+
+
+class TestSchedulerTriggers(BaseTestCase):
+    def create_agent(self, i):
+        agent = Agent(hostname="agent%s" % i, id=uuid.uuid4(), ram=32,
+                      free_ram=32, cpus=1, port=50000)
+        db.session.add(agent)
+        return agent
+
+    def test_pop_coalesces(self):
+        agent_ids = [uuid.uuid4(), uuid.uuid4()]
+        db.session.add_all([
+            SchedulerTrigger(agent_ids=[str(agent_ids[0])]),
+            SchedulerTrigger(agent_ids=[str(agent_ids[1])], queue_ids=[1]),
+            SchedulerTrigger(queue_ids=[1, 2])])
+        db.session.commit()
+
+        self.assertTrue(has_pending_triggers())
+        self.assertEqual(pop_triggers(), (set(agent_ids), set([1, 2])))
+        self.assertFalse(has_pending_triggers())
+        self.assertIsNone(pop_triggers())
+
+    def test_pop_full(self):
+        db.session.add_all([SchedulerTrigger(queue_ids=[1]),
+                            SchedulerTrigger()])
+        db.session.commit()
+
+        self.assertEqual(pop_triggers(), (None, None))
+        self.assertFalse(has_pending_triggers())
+
+    def test_affected_agents(self):
+        software = Software(software="foo")
+        version = SoftwareVersion(software=software, version="1", rank=1)
+        jobtype = JobType(name="foo", description="this is a job type")
+        jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="class Foobar(JobType): pass".encode("utf-8"))
+        db.session.add(JobTypeSoftwareRequirement(
+            jobtype_version=jobtype_version, software=software))
+        parent = JobQueue(name="parent")
+        child = JobQueue(name="child", parent=parent)
+        other = JobQueue(name="other")
+        db.session.add_all([
+            Job(title="Test Job", jobtype_version=jobtype_version,
+                queue=child), other])
+        capable = self.create_agent(0)
+        capable.software_versions.append(version)
+        incapable = self.create_agent(1)
+        named = self.create_agent(2)
+        db.session.commit()
+        idle_agent_ids = [capable.id, incapable.id, named.id]
+
+        self.assertEqual(
+            affected_agent_ids(idle_agent_ids, [named.id], [parent.id]),
+            set([capable.id, named.id]))
+        self.assertEqual(
+            affected_agent_ids(idle_agent_ids, [named.id], [other.id]),
+            set([named.id]))
+        self.assertEqual(
+            affected_agent_ids(idle_agent_ids, [uuid.uuid4()], []), set())